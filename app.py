@@ -1,27 +1,427 @@
-from flask import Flask, request, abort, jsonify
+import hashlib
+import os
+from flask import Flask, request, abort, jsonify, Response, stream_with_context
 from flask_cors import CORS
-from flask_migrate import Migrate
-from models import setup_db, db, Doctor, Patient, Appointment
-from datetime import datetime, timezone
-from auth import requires_auth, AuthError
+from models import setup_db, db, Doctor, Patient, Appointment, AppointmentHistory, fetch_page, stream_rows, projection, expand_keys, existing_ids, version_queries, expand_targets, chunked, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, APPOINTMENT_DURATION
+from datetime import date, datetime, timedelta, timezone
+from auth import requires_auth, check_permissions, AuthError
+from query_plans import check_query_plans_command
+from pool import pool_status
+from metrics import init_metrics, render_metrics
+from json_provider import FastJSONProvider, dumps
+from response_cache import response_cache, pack_entry, unpack_entry
+from replicas import init_replicas, replica_reads, reading_own_writes
+from search import search, DEFAULT_SEARCH_LIMIT
+from rollups import appointment_stats, record_bulk_write, rebuild_stats_command
+from idempotency import idempotent, purge_idempotency_keys_command
+from exports import FORMATS, available_formats, export_chunks, export_criteria
+from importer import import_command
+from archive import archive_appointments_command
+from availability import availability_cache, find_availability, MAX_WINDOW
+from sqlalchemy import select
+from werkzeug.http import http_date
+from validators import ValidationError, parse_id, validate_doctor, validate_patient, validate_appointment
+
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 5000))
+
+
+'''
+    Reads a comma separated query parameter as a list (None when absent).
+'''
+def parse_csv_arg(args, name):
+    value = args.get(name, None)
+    if not value:
+        return None
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+'''
+    Parses the list parameters shared by the collection endpoints:
+        limit: page size (default DEFAULT_PAGE_SIZE, at most MAX_PAGE_SIZE)
+        after: cursor returned as `next_cursor` by the previous page
+        fields: comma separated columns to return (default: all)
+        expand: comma separated relations to embed (e.g. doctor,patient)
+    Raises ValueError on invalid values.
+'''
+def parse_list_args(args):
+    limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    return parse_csv_arg(args, 'fields'), args.get('after', None), limit, parse_csv_arg(args, 'expand') or ()
+
+
+'''
+    Parses an ISO 8601 date/datetime query parameter (None when absent).
+    A value with an offset (`Z`, `+02:00`) is converted to naive UTC, as
+    the dates are stored. Raises ValueError if malformed.
+'''
+def parse_date_arg(args, name):
+    value = args.get(name, None)
+    if value is None:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+'''
+    The appointments a read covers: the current ones, or with
+    `?include_archived=1` the archived ones too (see archive.py).
+'''
+def appointments_model(args):
+    if args.get('include_archived', '').lower() in ('1', 'true'):
+        return AppointmentHistory
+    return Appointment
+
+
+'''
+    Filters of the doctor schedule: from (inclusive), to (exclusive), status.
+    Raises ValueError on malformed dates.
+'''
+def schedule_criteria(doctor_id, args, model=Appointment):
+    return model.schedule_criteria(
+        doctor_id,
+        parse_date_arg(args, 'from'),
+        parse_date_arg(args, 'to'),
+        args.get('status', None)
+    )
+
+
+def get_list_args():
+    try:
+        return parse_list_args(request.args)
+    except ValueError:
+        abort(400)
+
+
+def get_date_arg(name):
+    try:
+        return parse_date_arg(request.args, name)
+    except ValueError:
+        abort(400)
+
+
+'''
+    True when the client asked for the whole collection as NDJSON,
+    either with `?stream=1` or `Accept: application/x-ndjson`.
+'''
+def wants_stream():
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+
+'''
+    Streams every row of `model` as newline-delimited JSON, one row per line.
+'''
+def stream_response(model, fields, expand, *criteria):
+    try:
+        projection(model, fields)
+        expand_keys(model, expand)
+    except ValueError:
+        abort(400)
+
+    def generate():
+        for row in stream_rows(model, fields, *criteria, expand=expand):
+            yield dumps(row) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+'''
+    ETag of a collection response: a hash of the representation (query
+    string, JSON or NDJSON) and the (count, latest updated_at) versions
+    of the tables it reads.
+'''
+def collection_etag(variant, versions):
+    raw = repr((variant, [(count, latest and latest.isoformat()) for count, latest in versions]))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+'''
+    Sets the validators of a collection response: weak ETag,
+    Last-Modified and a Cache-Control asking clients to revalidate.
+'''
+def conditional_headers(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.headers['Last-Modified'] = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+'''
+    Returns one keyset page of `model` as a JSON response under `key`,
+    or the whole collection as NDJSON when the client asks for a stream.
+
+    JSON pages are served from the response cache when possible, keyed by
+    route, query parameters and `scope` (the permission the route requires)
+    and tagged with `tags` (default: the model's table) plus the tables
+    of the expanded relations.
+
+    Clients reading their own recent writes (see replicas.py) skip the
+    cached entry and refresh it from the primary.
+
+    Responses carry a weak ETag built from the collection versions;
+    a request whose If-None-Match matches gets 304 Not Modified before
+    any row is loaded or serialized.
+'''
+def list_response(model, key, *criteria, scope=None, tags=None):
+    fields, after, limit, expand = get_list_args()
+    stream = wants_stream()
+    try:
+        expand_keys(model, expand)
+    except ValueError:
+        abort(400)
+
+    cache_key = None
+    if response_cache.enabled and not stream:
+        tags = list(tags or [model.__tablename__])
+        tags += [target.__tablename__ for target in expand_targets(model, expand)]
+        cache_key = response_cache.key(request.path, request.args, scope, tags)
+        cached = None if reading_own_writes() else response_cache.get(cache_key)
+        if cached is not None:
+            etag, last_modified, body = unpack_entry(cached)
+            if request.if_none_match.contains_weak(etag):
+                return conditional_headers(Response(status=304), etag, last_modified)
+            response = Response(body, mimetype='application/json')
+            return conditional_headers(response, etag, last_modified)
+
+    versions = [db.session.execute(query).one() for query in version_queries(model, expand, *criteria)]
+    etag = collection_etag((request.query_string.decode(), stream), versions)
+    latest = max((latest for _, latest in versions if latest is not None), default=None)
+    last_modified = http_date(latest.replace(tzinfo=timezone.utc)) if latest is not None else None
+    if request.if_none_match.contains_weak(etag):
+        return conditional_headers(Response(status=304), etag, last_modified)
+    if stream:
+        return conditional_headers(stream_response(model, fields, expand, *criteria), etag, last_modified)
+
+    try:
+        rows, next_cursor = fetch_page(model, fields, after, limit, *criteria, expand=expand)
+    except ValueError:
+        abort(400)
+    response = jsonify({
+        'success': True,
+        key: rows,
+        'next_cursor': next_cursor
+    })
+    if cache_key is not None:
+        response_cache.set(cache_key, pack_entry(etag, last_modified, response.get_data()))
+    return conditional_headers(response, etag, last_modified)
+
+
+'''
+    Ranked search results of `model` for `?q=` as a JSON response under
+    `key`, paginated with `limit` (default DEFAULT_SEARCH_LIMIT) and `after`.
+'''
+def search_response(model, key):
+    try:
+        limit = int(request.args.get('limit', DEFAULT_SEARCH_LIMIT))
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+        rows, next_cursor = search(model, request.args.get('q', ''),
+                                   request.args.get('after', None), limit)
+    except ValueError:
+        abort(400)
+    return jsonify({
+        'success': True,
+        key: rows,
+        'next_cursor': next_cursor
+    })
+
+
+'''
+    Aborts with 409 if the doctor already has an active appointment
+    overlapping `date`. The doctor row is locked first (SELECT ... FOR UPDATE
+    on Postgres) so concurrent bookings for the same doctor are serialized
+    until the caller commits.
+'''
+def check_double_booking(doctor_id, date, status, exclude_id=None):
+    if status == 'Canceled':
+        return
+    db.session.execute(select(Doctor.id).where(Doctor.id == doctor_id).with_for_update())
+    if Appointment.conflicting(doctor_id, date, exclude_id) is not None:
+        db.session.rollback()
+        abort(409)
+
+
+'''
+    Invalidates the cached appointment listings and the schedules of
+    `doctor_ids`, after a committed appointment write.
+'''
+def invalidate_appointments(*doctor_ids):
+    response_cache.invalidate('appointments', *[
+        f'appointments:doctor:{doctor_id}' for doctor_id in doctor_ids if doctor_id is not None
+    ])
+
+
+'''
+    Doctors of the stored appointments `ids`.
+'''
+def appointment_doctor_ids(ids):
+    doctor_ids = set()
+    for chunk in chunked(ids):
+        doctor_ids.update(db.session.execute(
+            select(Appointment.doctor_id).where(Appointment.id.in_(chunk))).scalars())
+    return doctor_ids
+
+
+'''
+    Reports appointment items whose doctor or patient does not exist,
+    with one query per referenced table.
+'''
+def check_appointment_references(creates):
+    doctors = existing_ids(Doctor, [values['doctor_id'] for _, values in creates])
+    patients = existing_ids(Patient, [values['patient_id'] for _, values in creates])
+    errors = []
+    for index, values in creates:
+        if values['doctor_id'] not in doctors:
+            errors.append({'index': index, 'status': 422, 'message': 'doctor not found'})
+        elif values['patient_id'] not in patients:
+            errors.append({'index': index, 'status': 422, 'message': 'patient not found'})
+    return errors
+
+
+'''
+    Reports appointment items that would double book their doctor, as
+    check_double_booking does for one appointment: against the stored
+    appointments and against the other items. The doctors are locked
+    (in id order, FOR UPDATE on Postgres) until the write commits.
+'''
+def check_appointment_conflicts(creates, updates):
+    stored = {}
+    for chunk in chunked([values['id'] for _, values in updates if 'date' in values or 'status' in values]):
+        stored.update((row.id, row) for row in db.session.execute(
+            select(Appointment.id, Appointment.date, Appointment.doctor_id, Appointment.status)
+            .where(Appointment.id.in_(chunk))))
+
+    # (doctor_id, date, index, id) of the active appointments the batch writes
+    booked = [(values['doctor_id'], values['date'], index, None)
+              for index, values in creates if values['status'] != 'Canceled']
+    for index, values in updates:
+        row = stored.get(values['id'])
+        if row is not None and values.get('status', row.status) != 'Canceled':
+            booked.append((row.doctor_id, values.get('date', row.date), index, row.id))
+    booked.sort(key=lambda item: item[:3])
+
+    doctor_ids = sorted({doctor_id for doctor_id, *_ in booked})
+    for chunk in chunked(doctor_ids):
+        db.session.execute(select(Doctor.id).where(Doctor.id.in_(chunk)).order_by(Doctor.id).with_for_update())
+
+    # The rows the batch moves are checked at their new dates, not the stored ones
+    moved = list(stored)
+    conflicts = set()
+    for position, (doctor_id, date, index, _) in enumerate(booked):
+        if Appointment.conflicting(doctor_id, date, exclude_ids=moved) is not None:
+            conflicts.add(index)
+        # Sorted by doctor and date: an item overlaps another item of the
+        # batch exactly when it overlaps the one before it
+        if position:
+            previous_doctor_id, previous_date = booked[position - 1][:2]
+            if previous_doctor_id == doctor_id and date - previous_date < APPOINTMENT_DURATION:
+                conflicts.add(index)
+    return [{'index': index, 'status': 409, 'message': 'conflict'} for index in sorted(conflicts)]
+
+
+'''
+    Validates and writes a JSON array of `model` rows in a single transaction.
+    Items carrying an `id` update that row and need `update_permission`,
+    the others are created and need `create_permission`.
+    Every item is checked before anything is written: if any fails, nothing
+    is written and a 422 lists the errors by item index.
+    `check_conflicts(creates, updates)` reports the items clashing with the
+    stored rows or each other, once every item is otherwise valid.
+    `on_write(creates, updates)` runs in the same transaction, just before
+    the rows are written.
+'''
+def bulk_write(payload, model, validate, create_permission, update_permission,
+               check_references=None, check_conflicts=None, on_write=None):
+    items = request.get_json()
+    if not isinstance(items, list) or not items:
+        abort(400)
+    if len(items) > BULK_MAX_ITEMS:
+        abort(413)
+
+    errors, creates, updates = [], [], []
+    for index, item in enumerate(items):
+        is_update = isinstance(item, dict) and item.get('id') is not None
+        try:
+            check_permissions(update_permission if is_update else create_permission, payload)
+            values = validate(item, partial=is_update)
+            if is_update:
+                values['id'] = parse_id('id', item['id'])
+        except AuthError as ex:
+            errors.append({'index': index, 'status': ex.status_code, 'message': ex.error['description']})
+            continue
+        except ValidationError as ex:
+            errors.append({'index': index, 'status': 400, 'message': ex.message})
+            continue
+        (updates if is_update else creates).append((index, values))
+
+    if updates:
+        found = existing_ids(model, [values['id'] for _, values in updates])
+        errors += [
+            {'index': index, 'status': 404, 'message': 'resource not found'}
+            for index, values in updates if values['id'] not in found
+        ]
+    if check_references and creates:
+        errors += check_references(creates)
+    if check_conflicts and not errors:
+        errors += check_conflicts(creates, updates)
+
+    if errors:
+        db.session.rollback()
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': 'unprocessable',
+            'errors': sorted(errors, key=lambda error: error['index'])
+        }), 422
+
+    try:
+        if on_write is not None:
+            on_write(creates, updates)
+        db.session.bulk_insert_mappings(model, [values for _, values in creates])
+        db.session.bulk_update_mappings(model, [values for _, values in updates])
+        db.session.commit()
+    except:
+        db.session.rollback()
+        abort(422)
+
+    return jsonify({
+        'success': True,
+        'created': len(creates),
+        'updated': len(updates)
+    })
 
 
 def create_app(test_config=None):
     app = Flask(__name__)
     app.config['DEBUG'] = True
+    app.json = FastJSONProvider(app)
 
     if test_config is None:
         setup_db(app)
     else:
+        app.config.from_mapping(test_config)
         database_path = test_config.get('SQLALCHEMY_DATABASE_URI')
         setup_db(app, database_path=database_path)
 
     CORS(app)
-    migrate = Migrate(app, db)
-
-    with app.app_context():
-        db.create_all()
-
+    # Flask-Migrate (and alembic) only serve the `flask db` commands:
+    # workers skip importing them
+    if os.environ.get('FLASK_RUN_FROM_CLI'):
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    app.cli.add_command(check_query_plans_command)
+    app.cli.add_command(rebuild_stats_command)
+    app.cli.add_command(purge_idempotency_keys_command)
+    app.cli.add_command(import_command)
+    app.cli.add_command(archive_appointments_command)
+    init_replicas(app)
+    init_metrics(app)
 
     # ======================================
     #  ROUTES
@@ -30,34 +430,29 @@ def create_app(test_config=None):
     # 1. DOCTOR
     # ======================================
     @app.route('/doctors', methods=['GET'])
+    @replica_reads
     def get_doctors():
-        selection = Doctor.query.all()
-        doctors = [doctor.format() for doctor in selection]
-        return jsonify({
-            'success': True,
-            'doctors': doctors
-        })
+        return list_response(Doctor, 'doctors')
     
+    #  GET /doctors/search?q=
+    #  Description: Doctors matching q by name, speciality, phone or email, best match first.
+    @app.route('/doctors/search', methods=['GET'])
+    def search_doctors():
+        return search_response(Doctor, 'doctors')
+
     @app.route('/doctors', methods=['POST'])
     @requires_auth("post:doctors")
     def create_doctor(payload):
-        body = request.get_json()
-        name = body.get('name', None)
-        speciality = body.get('speciality', None)
-        phone = body.get('phone', None)
-        email = body.get('email', None)
-
-        if not name or not speciality:
+        try:
+            values = validate_doctor(request.get_json())
+        except ValidationError:
             abort(400)
 
         try:
-            new_doctor = Doctor(
-                name=name,
-                speciality=speciality,
-                phone=phone,
-                email=email
-            )
+            new_doctor = Doctor(**values)
             new_doctor.insert()
+            availability_cache.invalidate()
+            response_cache.invalidate('doctors')
             return jsonify({
                 'success': True,
                 'doctor': new_doctor.format()
@@ -66,6 +461,14 @@ def create_app(test_config=None):
             db.session.rollback()
             abort(422)
     
+    @app.route('/doctors/bulk', methods=['POST'])
+    @requires_auth(["post:doctors", "patch:doctors"])
+    def bulk_doctors(payload):
+        response = bulk_write(payload, Doctor, validate_doctor, "post:doctors", "patch:doctors")
+        availability_cache.invalidate()
+        response_cache.invalidate('doctors')
+        return response
+
     @app.route('/doctors/<int:doctor_id>', methods=['PATCH'])
     @requires_auth("patch:doctors")
     def update_doctor(payload, doctor_id):
@@ -73,23 +476,22 @@ def create_app(test_config=None):
         if not doctor:
             abort(404)
 
-        body = request.get_json()
-        name = body.get('name', None)
-        speciality = body.get('speciality', None)
-        phone = body.get('phone', None)
-        email = body.get('email', None)
-
-        if name:
-            doctor.name = name
-        if speciality:
-            doctor.speciality = speciality
-        if phone:
-            doctor.phone = phone
-        if email:
-            doctor.email = email
+        try:
+            values = validate_doctor(request.get_json(), partial=True)
+        except ValidationError:
+            abort(400)
+        # validate_doctor only compares the hours when both are sent:
+        # compare what the row will hold
+        if values.get('work_start', doctor.work_start) >= values.get('work_end', doctor.work_end):
+            abort(400)
+
+        for field, value in values.items():
+            setattr(doctor, field, value)
 
         try:
             doctor.update()
+            availability_cache.invalidate()
+            response_cache.invalidate('doctors')
             return jsonify({
                 'success': True,
                 'doctor': doctor.format()
@@ -98,6 +500,9 @@ def create_app(test_config=None):
             db.session.rollback()
             abort(422)
 
+    #  DELETE /doctors/<doctor_id>
+    #  Description: Deletes the doctor with its appointments and statistics,
+    #  in one statement: the database cascades (ON DELETE CASCADE).
     @app.route('/doctors/<int:doctor_id>', methods=['DELETE'])
     @requires_auth("delete:doctors")
     def delete_doctor(payload, doctor_id):
@@ -107,6 +512,9 @@ def create_app(test_config=None):
 
         try:
             doctor.delete()
+            availability_cache.invalidate()
+            response_cache.invalidate('doctors')
+            invalidate_appointments(doctor_id)
             return jsonify({
                 'success': True,
                 'deleted': doctor_id
@@ -120,34 +528,33 @@ def create_app(test_config=None):
     # ======================================
     @app.route('/patients', methods=['GET'])
     @requires_auth("get:patients")
+    @replica_reads
     def get_patients(payload):
-        selection = Patient.query.all()
-        patients = [patient.format() for patient in selection]
-        return jsonify({
-            'success': True,
-            'patients': patients
-        })
+        return list_response(Patient, 'patients', scope='get:patients')
     
+    #  GET /patients/search?q=
+    #  Description: Patients matching q by name or phone, best match first.
+    #  Results leave out medical_history.
+    @app.route('/patients/search', methods=['GET'])
+    @requires_auth("get:patients")
+    def search_patients(payload):
+        return search_response(Patient, 'patients')
+
+    #  POST /patients
+    #  Description: Creates a patient; honours the Idempotency-Key header.
     @app.route('/patients', methods=['POST'])
     @requires_auth("post:patients")
+    @idempotent
     def create_patient(payload):
-        body = request.get_json()
-        name = body.get('name', None)
-        phone = body.get('phone', None)
-        address = body.get('address', None)
-        medical_history = body.get('medical_history', None)
-
-        if not name:
+        try:
+            values = validate_patient(request.get_json())
+        except ValidationError:
             abort(400)
 
         try:
-            new_patient = Patient(
-                name=name,
-                phone=phone,
-                address=address,
-                medical_history=medical_history
-            )
+            new_patient = Patient(**values)
             new_patient.insert()
+            response_cache.invalidate('patients')
             return jsonify({
                 'success': True,
                 'patient': new_patient.format()
@@ -156,6 +563,13 @@ def create_app(test_config=None):
             db.session.rollback()
             abort(422)
 
+    @app.route('/patients/bulk', methods=['POST'])
+    @requires_auth(["post:patients", "patch:patients"])
+    def bulk_patients(payload):
+        response = bulk_write(payload, Patient, validate_patient, "post:patients", "patch:patients")
+        response_cache.invalidate('patients')
+        return response
+
     @app.route('/patients/<int:patient_id>', methods=['PATCH'])
     @requires_auth("patch:patients")
     def update_patient(payload, patient_id):
@@ -163,23 +577,17 @@ def create_app(test_config=None):
         if not patient:
             abort(404)
 
-        body = request.get_json()
-        name = body.get('name', None)
-        phone = body.get('phone', None)
-        address = body.get('address', None)
-        medical_history = body.get('medical_history', None)
-
-        if name:
-            patient.name = name
-        if phone:
-            patient.phone = phone
-        if address:
-            patient.address = address
-        if medical_history:
-            patient.medical_history = medical_history
+        try:
+            values = validate_patient(request.get_json(), partial=True)
+        except ValidationError:
+            abort(400)
+
+        for field, value in values.items():
+            setattr(patient, field, value)
 
         try:
             patient.update()
+            response_cache.invalidate('patients')
             return jsonify({
                 'success': True,
                 'patient': patient.format()
@@ -188,6 +596,10 @@ def create_app(test_config=None):
             db.session.rollback()
             abort(422)
 
+    #  DELETE /patients/<patient_id>
+    #  Description: Deletes the patient with its appointments, which the
+    #  database cascades (ON DELETE CASCADE); the statistics rollup is
+    #  adjusted in the same transaction (see rollups.py).
     @app.route('/patients/<int:patient_id>', methods=['DELETE'])
     @requires_auth("delete:patients")
     def delete_patient(payload, patient_id):
@@ -196,7 +608,12 @@ def create_app(test_config=None):
             abort(404)
 
         try:
+            doctor_ids = set(db.session.execute(
+                select(Appointment.doctor_id).where(Appointment.patient_id == patient_id).distinct()).scalars())
             patient.delete()
+            availability_cache.invalidate()
+            response_cache.invalidate('patients')
+            invalidate_appointments(*doctor_ids)
             return jsonify({
                 'success': True,
                 'patient': patient_id
@@ -210,51 +627,50 @@ def create_app(test_config=None):
     # ======================================
 
     #  GET /appointments
+    #  Description: Appointments ordered by date, paginated with `limit` / `after`.
+    #  `expand=doctor,patient` embeds a summary of the related doctor / patient.
+    #  `include_archived=1` lists the archived appointments too.
     @app.route('/appointments', methods=['GET'])
     @requires_auth("get:appointments")
+    @replica_reads
     def get_appointments(payload):
-        selection = Appointment.query.all()
-        appointments = [appointment.format() for appointment in selection]
-        return jsonify({
-            'success': True,
-            'appointments': appointments
-        })
+        return list_response(appointments_model(request.args), 'appointments',
+                             scope='get:appointments', tags=['appointments'])
     
     #  GET /appointments/doctor/<doctor_id>
-    #  Description: Retrieves all appointments related to a specific doctor by ID.
+    #  Description: Retrieves the appointments of a specific doctor by ID, ordered by date.
+    #  Optional filters: from (inclusive), to (exclusive), status, include_archived.
     @app.route('/appointments/doctor/<int:doctor_id>', methods=['GET'])
     @requires_auth("get:appointments-doctor")
+    @replica_reads
     def get_appointments_by_doctor(payload, doctor_id):
-        appointments = Appointment.query.filter_by(doctor_id=doctor_id).all()
-        result = [appointment.format() for appointment in appointments]
-        return jsonify({
-            'success': True,
-            'appointments': result
-        })
+        model = appointments_model(request.args)
+        try:
+            criteria = schedule_criteria(doctor_id, request.args, model)
+        except ValueError:
+            abort(400)
+        return list_response(model, 'appointments', *criteria,
+                             scope='get:appointments-doctor',
+                             tags=[f'appointments:doctor:{doctor_id}'])
     
+    #  POST /appointments
+    #  Description: Creates an appointment. Retries carrying the same
+    #  Idempotency-Key header get the original response (see idempotency.py).
     @app.route('/appointments', methods=['POST'])
     @requires_auth("post:appointments")
+    @idempotent
     def create_appointment(payload):
-        body = request.get_json()
-        date_str = body.get('date', None)
-        status = body.get('status', None)
-        notes = body.get('notes', None)
-        doctor_id = body.get('doctor_id', None)
-        patient_id = body.get('patient_id', None)
-
-        if not date_str or not doctor_id or not patient_id:
+        try:
+            values = validate_appointment(request.get_json())
+        except ValidationError:
             abort(400)
 
+        check_double_booking(values['doctor_id'], values['date'], values['status'])
         try:
-            date = datetime.fromisoformat(date_str)
-            new_appointment = Appointment(
-                date=date,
-                status=status,
-                notes=notes,
-                doctor_id=doctor_id, 
-                patient_id=patient_id
-            )
+            new_appointment = Appointment(**values)
             new_appointment.insert()
+            availability_cache.invalidate()
+            invalidate_appointments(new_appointment.doctor_id)
             return jsonify({
                 'success': True, 
                 'appointment': new_appointment.format()
@@ -263,6 +679,32 @@ def create_app(test_config=None):
             db.session.rollback()
             abort(422)
 
+    #  POST /appointments/bulk
+    #  Description: Creates (and, for items with an id, updates) many appointments at once.
+    @app.route('/appointments/bulk', methods=['POST'])
+    @requires_auth(["post:appointments", "patch:appointments"])
+    def bulk_appointments(payload):
+        # The doctors of the validated rows written, before and after the
+        # write: only known once bulk_write gets to writing
+        doctor_ids = set()
+
+        def on_write(creates, updates):
+            record_bulk_write(creates, updates)
+            doctor_ids.update(appointment_doctor_ids([values['id'] for _, values in updates]))
+            doctor_ids.update(values['doctor_id'] for _, values in creates + updates if 'doctor_id' in values)
+
+        response = bulk_write(payload, Appointment, validate_appointment,
+                              "post:appointments", "patch:appointments",
+                              check_references=check_appointment_references,
+                              check_conflicts=check_appointment_conflicts,
+                              on_write=on_write)
+        # bulk_write aborts when the write fails, and returns before
+        # on_write when an item is refused: nothing was written then
+        if doctor_ids:
+            availability_cache.invalidate()
+            invalidate_appointments(*doctor_ids)
+        return response
+
     @app.route('/appointments/<int:appointment_id>', methods=['PATCH'])
     @requires_auth("patch:appointments")
     def update_appointments(payload, appointment_id):
@@ -270,23 +712,25 @@ def create_app(test_config=None):
         if not appointment:
             abort(404)
 
-        body = request.get_json()
-        date_str = body.get('date', None)
-        status = body.get('status', None)
-        notes = body.get('notes', None)
-
-        if date_str:
-            try:
-                appointment.date = datetime.fromisoformat(date_str)
-            except:
-                abort(400)
-        if status:
-            appointment.status = status
-        if notes:
-            appointment.notes = notes
+        try:
+            values = validate_appointment(request.get_json(), partial=True)
+        except ValidationError:
+            abort(400)
+
+        if 'date' in values or 'status' in values:
+            check_double_booking(
+                appointment.doctor_id,
+                values.get('date', appointment.date),
+                values.get('status', appointment.status),
+                exclude_id=appointment.id
+            )
+        for field, value in values.items():
+            setattr(appointment, field, value)
 
         try:
             appointment.update()
+            availability_cache.invalidate()
+            invalidate_appointments(appointment.doctor_id)
             return jsonify({
                 'success': True,
                 'appointment': appointment.format()
@@ -303,7 +747,10 @@ def create_app(test_config=None):
             abort(404)
 
         try:
+            doctor_id = appointment.doctor_id
             appointment.delete()
+            availability_cache.invalidate()
+            invalidate_appointments(doctor_id)
             return jsonify({
                 'success': True,
                 'deleted': appointment_id
@@ -313,6 +760,145 @@ def create_app(test_config=None):
             abort(422)
 
 
+    # 4. AVAILABILITY
+    # ======================================
+
+    #  GET /availability?speciality=&from=&to=&duration=
+    #  Description: Open slots of each doctor (optionally of one speciality)
+    #  between from and to, as free intervals of at least `duration` minutes.
+    @app.route('/availability', methods=['GET'])
+    def get_availability():
+        window_start = get_date_arg('from')
+        window_end = get_date_arg('to')
+        if not window_start or not window_end or window_end <= window_start:
+            abort(400)
+        if window_end - window_start > MAX_WINDOW:
+            abort(400)
+
+        default_minutes = int(APPOINTMENT_DURATION.total_seconds() // 60)
+        try:
+            minutes = int(request.args.get('duration', default_minutes))
+        except ValueError:
+            abort(400)
+        if minutes < 1 or minutes > 24 * 60:
+            abort(400)
+
+        speciality = request.args.get('speciality', None)
+        return jsonify({
+            'success': True,
+            'availability': find_availability(
+                speciality, window_start, window_end, timedelta(minutes=minutes))
+        })
+
+
+    # 5. STATISTICS
+    # ======================================
+
+    #  GET /stats/appointments?group_by=&bucket=&from=&to=&doctor_id=&status=&speciality=
+    #  Description: Appointment counts grouped by any of doctor, speciality and
+    #  status (comma separated), per day / week / month when `bucket` is given.
+    #  from (inclusive) and to (exclusive) are dates. Answered from the
+    #  appointment_counts rollup (see rollups.py), never from the appointments.
+    @app.route('/stats/appointments', methods=['GET'])
+    @requires_auth("get:appointments")
+    @replica_reads
+    def get_appointment_stats(payload):
+        try:
+            date_from, date_to = [
+                date.fromisoformat(request.args[name]) if name in request.args else None
+                for name in ('from', 'to')
+            ]
+            doctor_id = request.args.get('doctor_id', None)
+            stats = appointment_stats(
+                group_by=parse_csv_arg(request.args, 'group_by') or [],
+                bucket=request.args.get('bucket', None),
+                date_from=date_from,
+                date_to=date_to,
+                doctor_id=int(doctor_id) if doctor_id is not None else None,
+                status=request.args.get('status', None),
+                speciality=request.args.get('speciality', None)
+            )
+        except ValueError:
+            abort(400)
+        return jsonify({
+            'success': True,
+            'stats': stats,
+            'total': sum(row['count'] for row in stats)
+        })
+
+
+    # 6. EXPORT
+    # ======================================
+
+    #  GET /export/appointments?format=&from=&to=&doctor_id=&include_archived=
+    #  Description: Every appointment matching the filters, ordered by date,
+    #  streamed as CSV (default), Arrow IPC stream or Parquet (with pyarrow)
+    #  for analytics. from (inclusive) and to (exclusive) are dates or
+    #  datetimes. See exports.py.
+    @app.route('/export/appointments', methods=['GET'])
+    @requires_auth("get:appointments")
+    @replica_reads
+    def export_appointments(payload):
+        file_format = request.args.get('format', 'csv')
+        if file_format not in FORMATS:
+            abort(400)
+        if file_format not in available_formats():
+            abort(406)
+        model = appointments_model(request.args)
+        try:
+            doctor_id = request.args.get('doctor_id', None)
+            criteria = export_criteria(
+                parse_date_arg(request.args, 'from'),
+                parse_date_arg(request.args, 'to'),
+                int(doctor_id) if doctor_id is not None else None,
+                model=model
+            )
+        except ValueError:
+            abort(400)
+
+        mimetype, extension = FORMATS[file_format]
+        return Response(
+            stream_with_context(export_chunks(file_format, *criteria, model=model)),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename=appointments.{extension}'}
+        )
+
+
+    # 7. HEALTH
+    # ======================================
+
+    #  GET /health/db
+    #  Description: Connection pool usage of this worker (checked out, idle,
+    #  overflow connections and checkout wait times), and the health, lag
+    #  and pools of the read replicas when there are any.
+    @app.route('/health/db', methods=['GET'])
+    def get_db_health():
+        body = {
+            'success': True,
+            'pool': pool_status(db.engine)
+        }
+        if 'replicas' in app.extensions:
+            body['replicas'] = app.extensions['replicas'].status()
+        return jsonify(body)
+
+    #  GET /health/cache
+    #  Description: Response cache hits, misses, hit ratio and evictions
+    #  (hits and misses are counted per worker).
+    @app.route('/health/cache', methods=['GET'])
+    def get_cache_health():
+        return jsonify({
+            'success': True,
+            'cache': response_cache.stats()
+        })
+
+    #  GET /metrics
+    #  Description: Per-route latency, auth time, SQL statement count, DB time
+    #  and response size histograms of this worker (Prometheus text format).
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
     # ======================================
     #  ERROR HANDLERS
     # ======================================
@@ -338,6 +924,30 @@ def create_app(test_config=None):
             'message': 'resource not found'
         }), 404
 
+    @app.errorhandler(406)
+    def bad_request(error):
+        return jsonify({
+            'success': False,
+            'error': 406,
+            'message': 'not acceptable'
+        }), 406
+
+    @app.errorhandler(409)
+    def bad_request(error):
+        return jsonify({
+            'success': False,
+            'error': 409,
+            'message': 'conflict'
+        }), 409
+
+    @app.errorhandler(413)
+    def bad_request(error):
+        return jsonify({
+            'success': False,
+            'error': 413,
+            'message': 'payload too large'
+        }), 413
+
     @app.errorhandler(422)
     def bad_request(error):
         return jsonify({
@@ -357,6 +967,18 @@ def create_app(test_config=None):
 
     return app
 
-app = create_app()
+
+'''
+    `app` is built on first access (gunicorn app:app, flask run), not at
+    import: importing this module touches neither the environment nor the
+    database. The schema is managed by migrations (`flask db upgrade`).
+'''
+def __getattr__(name):
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 if __name__ == '__main__':
-    app.run()
\ No newline at end of file
+    create_app().run()
\ No newline at end of file
@@ -0,0 +1,101 @@
+import click
+import os
+from datetime import timedelta
+from flask.cli import with_appcontext
+from sqlalchemy import DateTime, literal, select
+from models import db, Appointment, ArchivedAppointment, APPOINTMENT_COLUMNS, utc_now, chunked
+from response_cache import response_cache
+
+'''
+Archival of old appointments, so the appointments table (and its
+indexes) only holds the rows the routes work on.
+
+    ARCHIVE_AFTER_DAYS      appointments dated more than this many days
+                            ago are archived (365)
+    ARCHIVE_STATUSES        comma separated statuses that are archived;
+                            the others stay whatever their age
+                            (Completed,Canceled)
+    ARCHIVE_BATCH_SIZE      rows moved per transaction (5000)
+
+    flask archive-appointments [--older-than DAYS] [--batch-size N]
+        moves the appointments due into appointments_archive; run it
+        daily (cron, Heroku Scheduler)
+
+Each batch locks its rows (skipping the ones a write holds, on Postgres),
+copies them to the archive and deletes them in one transaction, so a row
+is always in exactly one table. Archived appointments keep their id and
+updated_at, and still count in the statistics rollup.
+
+Reads with `?include_archived=1` (the appointment lists and the export)
+cover both tables through models.AppointmentHistory; every other route,
+writes included, only sees the appointments table. Archived rows are
+deleted with their doctor or patient (ON DELETE CASCADE).
+'''
+
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+ARCHIVE_STATUSES = [status.strip() for status in
+                    os.environ.get('ARCHIVE_STATUSES', 'Completed,Canceled').split(',') if status.strip()]
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 5000))
+
+
+def archive_criteria(cutoff, statuses=None):
+    return [Appointment.date < cutoff, Appointment.status.in_(statuses or ARCHIVE_STATUSES)]
+
+
+'''
+    Moves up to `batch_size` appointments matching `criteria` to the
+    archive, in one transaction. Returns the doctor ids of the moved rows
+    (one per row).
+'''
+def archive_batch(criteria, batch_size=ARCHIVE_BATCH_SIZE):
+    table = Appointment.__table__
+    rows = db.session.execute(
+        select(table.c.id, table.c.doctor_id).where(*criteria)
+        .limit(batch_size).with_for_update(skip_locked=True)
+    ).all()
+    archived_at = literal(utc_now(), DateTime)
+    for chunk in chunked([row.id for row in rows]):
+        db.session.execute(ArchivedAppointment.__table__.insert().from_select(
+            APPOINTMENT_COLUMNS + ['archived_at'],
+            select(*[table.c[name] for name in APPOINTMENT_COLUMNS], archived_at)
+            .where(table.c.id.in_(chunk))
+        ))
+        db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+    db.session.commit()
+    return [row.doctor_id for row in rows]
+
+
+'''
+    Archives every appointment older than `older_than_days` in the
+    archived statuses, batch by batch, calling `progress(moved)` after
+    each. Returns the number of rows moved.
+'''
+def archive_appointments(older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE,
+                         statuses=None, progress=None):
+    criteria = archive_criteria(utc_now() - timedelta(days=older_than_days), statuses)
+    moved, doctor_ids = 0, set()
+    while True:
+        batch = archive_batch(criteria, batch_size)
+        moved += len(batch)
+        doctor_ids.update(batch)
+        if batch and progress is not None:
+            progress(moved)
+        if len(batch) < batch_size:
+            break
+    if moved:
+        response_cache.invalidate('appointments', *[f'appointments:doctor:{doctor_id}' for doctor_id in doctor_ids])
+    return moved
+
+
+@click.command('archive-appointments')
+@click.option('--older-than', type=click.IntRange(min=0), default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help='Archive appointments dated more than this many days ago.')
+@click.option('--batch-size', type=click.IntRange(min=1), default=ARCHIVE_BATCH_SIZE, show_default=True,
+              help='Rows moved per transaction.')
+@with_appcontext
+def archive_appointments_command(older_than, batch_size):
+    """Move old finished appointments to the archive table."""
+    moved = archive_appointments(older_than, batch_size,
+                                 progress=lambda moved: click.echo(f'{moved} appointments archived', err=True))
+    click.echo(f'{moved} appointments archived (older than {older_than} days, '
+               f'status {", ".join(ARCHIVE_STATUSES)})')
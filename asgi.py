@@ -0,0 +1,302 @@
+import asyncio
+import re
+import time
+from datetime import timezone
+from urllib.parse import parse_qsl
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.http import http_date, parse_etags, quote_etag
+import auth
+from app import create_app, parse_list_args, schedule_criteria, collection_etag
+from json_provider import dumps_bytes
+from metrics import instrument_engine, record_auth_time, start_native_request, finish_native_request
+from auth import AuthError, get_token_auth_header, check_permissions, verify_decode_jwt
+from models import Doctor, Patient, Appointment, page_query, page_result, version_queries
+from pool import pool_settings
+
+'''
+Async (ASGI) entry point, served next to the WSGI app from `create_app`:
+
+    uvicorn asgi:app --workers 4
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+
+The hot read routes (the collection GETs) run natively on an async engine
+(asyncpg on Postgres, aiosqlite on SQLite: requirements-dev.txt, for the
+tests and benchmarks), so a worker serves other
+requests while it waits on Postgres or on a JWKS fetch. Every other
+request, and any read using options the async path does not implement
+(expand, stream, ..., or a query parameter given twice), is handed to
+the Flask app through WsgiToAsgi, with the same `requires_auth`
+semantics. The native routes are recorded in the metrics.py histograms
+under their Flask route templates, with a Server-Timing header, like the
+Flask routes.
+
+Where the two paths differ:
+
+    - the native routes always read the primary. With read replicas
+      configured (DATABASE_REPLICA_URLS) there are no native routes:
+      every request goes to Flask, which spreads the reads over the
+      replicas with read-your-writes (replicas.py)
+    - the native routes neither read nor fill the response cache
+      (response_cache.py): they answer from the database every time, so
+      they never serve an entry another worker has not invalidated yet.
+      The ETag, and so 304s, are the same on both paths
+'''
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+LIST_ARGS = {'limit', 'after', 'fields'}
+SCHEDULE_ARGS = LIST_ARGS | {'from', 'to', 'status'}
+
+ERROR_MESSAGES = {
+    400: 'bad request',
+    404: 'resource not found',
+    500: 'internal server error',
+}
+
+
+'''
+    Maps a sync database URL to its async driver, e.g.
+    postgresql://... -> postgresql+asyncpg://...
+'''
+def async_database_url(database_path):
+    url = make_url(database_path)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'no async driver configured for {backend}')
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+'''
+    Async engine options from the same environment settings as setup_db.
+    In PgBouncer mode asyncpg's prepared statement caches are disabled,
+    since prepared statements live on a server connection that PgBouncer
+    may hand to another client.
+'''
+def async_engine_options(url, pgbouncer=None):
+    if url.get_backend_name() != 'postgresql':
+        return url, {}
+
+    settings = pool_settings()
+    if pgbouncer is None:
+        pgbouncer = settings['pgbouncer']
+    options = {
+        'pool_size': settings['pool_size'],
+        'max_overflow': settings['max_overflow'],
+        'pool_timeout': settings['pool_timeout'],
+        'pool_recycle': settings['pool_recycle'],
+        'pool_pre_ping': settings['pool_pre_ping'],
+        'connect_args': {},
+    }
+    if pgbouncer:
+        url = url.update_query_dict({'prepared_statement_cache_size': '0'})
+        options['connect_args']['statement_cache_size'] = 0
+    elif settings['statement_timeout_ms']:
+        options['connect_args']['server_settings'] = {
+            'statement_timeout': str(settings['statement_timeout_ms'])
+        }
+    return url, options
+
+
+'''
+    Same checks as `requires_auth`. Tokens already in the verified-token
+    cache are answered inline; a miss (RSA verification, maybe a JWKS
+    fetch) runs in a thread so the event loop keeps serving.
+'''
+async def authenticate(headers, permission):
+    start = time.perf_counter()
+    try:
+        token = get_token_auth_header(headers)
+        payload = auth.token_cache.get(token, auth.jwks_cache.generation, record_miss=False)
+        if payload is None:
+            payload = await asyncio.to_thread(verify_decode_jwt, token)
+        check_permissions(permission, payload)
+    finally:
+        record_auth_time(time.perf_counter() - start)
+    return payload
+
+
+class AsyncApp:
+    def __init__(self, flask_app, engine):
+        self.flask_app = flask_app
+        self.engine = engine
+        self.wsgi = WsgiToAsgi(flask_app)
+        instrument_engine(engine.sync_engine)
+        # (path pattern, Flask route template, permission, model, response key, supported args)
+        self.routes = [
+            (re.compile(r'^/doctors$'), '/doctors', None, Doctor, 'doctors', LIST_ARGS),
+            (re.compile(r'^/patients$'), '/patients', 'get:patients', Patient, 'patients', LIST_ARGS),
+            (re.compile(r'^/appointments$'), '/appointments', 'get:appointments',
+             Appointment, 'appointments', LIST_ARGS),
+            (re.compile(r'^/appointments/doctor/(\d+)$'), '/appointments/doctor/<int:doctor_id>',
+             'get:appointments-doctor', Appointment, 'appointments', SCHEDULE_ARGS),
+        ]
+        if 'replicas' in flask_app.extensions:
+            # The reads belong on the replicas: leave them to replica_reads
+            self.routes = []
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http':
+            route = self.match(scope)
+            if route is not None:
+                return await self.serve_native(scope, send, *route)
+        return await self.wsgi(scope, receive, send)
+
+    '''
+        Serves a native route with the instrumentation the Flask hooks of
+        metrics.py give the Flask routes.
+    '''
+    async def serve_native(self, scope, send, rule, *route):
+        slow_request_ms = self.flask_app.config.get('SLOW_REQUEST_MS', 0)
+        stats = start_native_request(slow_request_ms)
+
+        async def send_timed(message):
+            if message['type'] == 'http.response.start':
+                size = int(dict(message['headers'])[b'content-length'])
+                timing = finish_native_request(stats, rule, scope['method'], message['status'],
+                                               size, slow_request_ms)
+                message = dict(message, headers=[*message['headers'], (b'server-timing', timing.encode())])
+            await send(message)
+
+        await self.list_page(scope, send_timed, *route)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    '''
+        Returns the native route serving this request, or None to fall
+        back to the Flask app.
+    '''
+    def match(self, scope):
+        if scope['method'] != 'GET':
+            return None
+        headers = self.headers(scope)
+        if 'application/x-ndjson' in headers.get('Accept', ''):
+            return None
+        pairs = parse_qsl(scope.get('query_string', b'').decode(), keep_blank_values=True)
+        args = dict(pairs)
+        if len(args) < len(pairs):
+            # A repeated parameter: request.args.get reads the first one
+            return None
+        for pattern, rule, permission, model, key, supported in self.routes:
+            found = pattern.match(scope['path'])
+            if found:
+                if not set(args) <= supported:
+                    return None
+                return rule, permission, model, key, args, headers, found.groups()
+        return None
+
+    @staticmethod
+    def headers(scope):
+        return {
+            name.decode('latin-1').title(): value.decode('latin-1')
+            for name, value in scope.get('headers', [])
+        }
+
+    async def list_page(self, scope, send, permission, model, key, args, headers, groups):
+        try:
+            if permission:
+                await authenticate(headers, permission)
+            fields, after, limit, _ = parse_list_args(args)
+            criteria = schedule_criteria(int(groups[0]), args) if groups else []
+            query, names = page_query(model, fields, after, limit, *criteria)
+        except AuthError as ex:
+            return await self.respond(send, ex.status_code, ex.error)
+        except ValueError:
+            return await self.respond_error(send, 400)
+
+        try:
+            async with self.engine.connect() as connection:
+                versions = [(await connection.execute(version)).one()
+                            for version in version_queries(model, (), *criteria)]
+                etag = collection_etag((scope.get('query_string', b'').decode(), False), versions)
+                conditional = self.conditional_headers(etag, versions)
+                if parse_etags(headers.get('If-None-Match')).contains_weak(etag):
+                    return await self.respond(send, 304, None, conditional)
+                raw_rows = (await connection.execute(query)).all()
+        except Exception:
+            self.flask_app.logger.exception('async list query failed')
+            return await self.respond_error(send, 500)
+
+        rows, next_cursor = page_result(model, raw_rows, names, limit)
+        await self.respond(send, 200, {
+            'success': True,
+            key: rows,
+            'next_cursor': next_cursor
+        }, conditional)
+
+    '''
+        ETag, Last-Modified and Cache-Control headers, as `list_response`
+        sets them.
+    '''
+    @staticmethod
+    def conditional_headers(etag, versions):
+        headers = [
+            (b'etag', quote_etag(etag, weak=True).encode()),
+            (b'cache-control', b'private, no-cache'),
+        ]
+        latest = max((latest for _, latest in versions if latest is not None), default=None)
+        if latest is not None:
+            headers.append((b'last-modified', http_date(latest.replace(tzinfo=timezone.utc)).encode()))
+        return headers
+
+    async def respond_error(self, send, status):
+        await self.respond(send, status, {
+            'success': False,
+            'error': status,
+            'message': ERROR_MESSAGES[status]
+        })
+
+    @staticmethod
+    async def respond(send, status, body, headers=()):
+        content = dumps_bytes(body) if body is not None else b''
+        response_headers = [
+            (b'content-length', str(len(content)).encode()),
+            (b'access-control-allow-origin', b'*'),
+            *headers,
+        ]
+        if body is not None:
+            response_headers.append((b'content-type', b'application/json'))
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': response_headers,
+        })
+        await send({'type': 'http.response.body', 'body': content})
+
+
+'''
+    Builds the ASGI app: the Flask app from `create_app(test_config)` plus
+    an async engine on the same database.
+'''
+def create_async_app(test_config=None):
+    flask_app = create_app(test_config)
+    url, options = async_engine_options(
+        async_database_url(flask_app.config['SQLALCHEMY_DATABASE_URI']),
+        flask_app.config.get('DB_PGBOUNCER')
+    )
+    return AsyncApp(flask_app, create_async_engine(url, **options))
+
+
+
+'''
+    `app` is built on first access (uvicorn asgi:app), like app.app.
+'''
+def __getattr__(name):
+    if name == 'app':
+        globals()['app'] = create_async_app()
+        return globals()['app']
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,8 +1,13 @@
+import hashlib
 import json
+import logging
 import os
+import threading
+import time
 from flask import request
+from collections import OrderedDict
 from functools import wraps
-from jose import jwt
+from metrics import record_auth_time
 from urllib.request import urlopen
 
 
@@ -10,6 +15,17 @@ AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.environ.get('AUTH0_API_AUDIENCE')
 
+# JWKS source and cache tuning. AUTH0_JWKS_URL overrides the Auth0 endpoint
+# (e.g. file:///path/to/jwks.json or a local stub server for tests).
+AUTH0_JWKS_URL = os.environ.get('AUTH0_JWKS_URL')
+JWKS_CACHE_TTL = int(os.environ.get('AUTH0_JWKS_CACHE_TTL', 600))
+JWKS_REFRESH_MARGIN = int(os.environ.get('AUTH0_JWKS_REFRESH_MARGIN', 60))
+JWKS_MIN_REFETCH_INTERVAL = int(os.environ.get('AUTH0_JWKS_MIN_REFETCH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('AUTH0_JWKS_FETCH_TIMEOUT', 5))
+TOKEN_CACHE_SIZE = int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', 4096))
+
+logger = logging.getLogger(__name__)
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -24,19 +40,22 @@ class AuthError(Exception):
 ## 1) VALIDATING REQUEST HEADER FORMAT
 ## ========================================
 '''
-    Attempt to get the header from the request,
+    Attempt to get the header from the request (or from `headers`,
+    a mapping, when called outside a Flask request),
         raise an AuthError if no header is present,
         raise an AuthError if the header is malformed,
     Return the token part of the header
 '''
-def get_token_auth_header():
-    if 'Authorization' not in request.headers:
+def get_token_auth_header(headers=None):
+    if headers is None:
+        headers = request.headers
+    if 'Authorization' not in headers:
         raise AuthError({
             'code': 'authorization_header_missing',
             'description': 'Authorization header is expected.'
         }, 401)
 
-    auth_headers = request.headers['Authorization']
+    auth_headers = headers['Authorization']
 
     # Get the TOKEN:
     header_parts = auth_headers.split(' ')
@@ -56,46 +75,249 @@ def get_token_auth_header():
 
 
 ## ========================================
-## 2) VALIDATING AUTH0 TOKEN
+## 2) JWKS KEY CACHE
+## ========================================
+'''
+JWKSCache
+    Keeps the Auth0 signing keys in memory, indexed by key id (kid).
+
+    - keys are reused for `ttl` seconds, then fetched again
+    - within `refresh_margin` seconds of expiry a background thread
+      refreshes them, so requests never wait on Auth0 in the steady state
+    - an unknown kid triggers a refetch (key rotation), at most once
+      every `min_refetch_interval` seconds
+    - only one fetch runs at a time; concurrent callers wait for it
+    - if Auth0 is unreachable the last known keys keep being served
+    - `generation` changes whenever the published key set changes
+'''
+class JWKSCache:
+    def __init__(self, url=None, ttl=JWKS_CACHE_TTL,
+                 refresh_margin=JWKS_REFRESH_MARGIN,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+                 fetch=None):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.min_refetch_interval = min_refetch_interval
+        self._fetch_jwks = fetch or self._fetch_url
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._refresh_lock = threading.Lock()
+        self.generation = 0
+
+    def source(self):
+        return self.url or AUTH0_JWKS_URL or f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+
+    def _fetch_url(self):
+        with urlopen(self.source(), timeout=JWKS_FETCH_TIMEOUT) as response:
+            return json.loads(response.read())
+
+    def _age(self):
+        if self._fetched_at is None:
+            return float('inf')
+        return time.monotonic() - self._fetched_at
+
+    def refresh(self, max_age=0):
+        '''
+        Fetch the JWKS unless another caller already did so within `max_age`
+        seconds (single-flight: callers queue on the lock and reuse its result).
+        Returns True when the key set is usable afterwards.
+        '''
+        with self._refresh_lock:
+            if self._age() < max_age:
+                return True
+            if self._keys and not self._refetch_allowed():
+                # Rate limit: a fetch was just attempted, keep the known keys.
+                return True
+            self._last_attempt = time.monotonic()
+            try:
+                jwks = self._fetch_jwks()
+            except Exception:
+                logger.exception('Unable to fetch JWKS from %s', self.source())
+                return bool(self._keys)
+
+            keys = {
+                key['kid']: {
+                    'kty': key['kty'],
+                    'kid': key['kid'],
+                    'use': key.get('use'),
+                    'n': key['n'],
+                    'e': key['e']
+                }
+                for key in jwks.get('keys', []) if 'kid' in key
+            }
+            if keys != self._keys:
+                self.generation += 1
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+            return True
+
+    def _refresh_in_background(self):
+        if self._refresh_lock.locked():
+            return
+        threading.Thread(
+            target=self.refresh,
+            kwargs={'max_age': self.ttl - self.refresh_margin},
+            daemon=True
+        ).start()
+
+    def _refetch_allowed(self):
+        if self._last_attempt is None:
+            return True
+        return time.monotonic() - self._last_attempt >= self.min_refetch_interval
+
+    def touch(self):
+        '''Schedule a background refresh if the keys are due for one.'''
+        if self._age() >= self.ttl - self.refresh_margin:
+            self._refresh_in_background()
+
+    def get_key(self, kid):
+        age = self._age()
+        if age >= self.ttl:
+            if not self.refresh(max_age=self.ttl) and not self._keys:
+                raise AuthError({
+                    'code': 'jwks_unavailable',
+                    'description': 'Unable to fetch the signing keys.'
+                }, 503)
+        elif age >= self.ttl - self.refresh_margin:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self._refetch_allowed():
+            # Possibly a rotated key: refetch, unless someone just did.
+            self.refresh(max_age=self.min_refetch_interval)
+            key = self._keys.get(kid)
+        return key
+
+    def clear(self):
+        with self._refresh_lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+
+jwks_cache = JWKSCache()
+
+
+'''
+VerifiedTokenCache
+    Bounded LRU of tokens whose signature and claims were already verified,
+    keyed by the SHA-256 of the raw token and holding the decoded payload.
+
+    - an entry expires at the token's `exp` claim
+    - an entry is dropped when the JWKS generation it was verified
+      against is no longer current (key rotation)
+    - tokens without an `exp` claim are never cached
+'''
+class VerifiedTokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token, generation, record_miss=True):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                payload, expires_at, entry_generation = entry
+                if expires_at > time.time() and entry_generation == generation:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+            if record_miss:
+                self.misses += 1
+            return None
+
+    def put(self, token, payload, generation):
+        expires_at = payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(expires_at, (int, float)):
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, expires_at, generation)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'maxsize': self.maxsize
+            }
+
+
+token_cache = VerifiedTokenCache()
+
+'''
+    Point the JWKS cache at another source (URL, file:// path or callable
+    returning the JWKS dict) and drop every cached key and verified token.
+'''
+def set_jwks_source(source):
+    global jwks_cache
+    if callable(source):
+        jwks_cache = JWKSCache(fetch=source)
+    else:
+        jwks_cache = JWKSCache(url=source)
+    token_cache.clear()
+    return jwks_cache
+
+
+## ========================================
+## 3) VALIDATING AUTH0 TOKEN
 ## ========================================
 '''
     @INPUTS
         token: a json web token (string)
 
     it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
+    it should verify the token using Auth0 /.well-known/jwks.json (cached)
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
+
+    tokens verified before are answered from the verified-token cache
 '''
 def verify_decode_jwt(token):
-    # GET THE PUBLIC KEY FROM AUTH0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    payload = token_cache.get(token, jwks_cache.generation)
+    if payload is not None:
+        jwks_cache.touch()
+        return payload
+
+    # python-jose is imported on the first verification, not at boot
+    from jose import jwt
 
     # GET THE DATA IN THE HEADER
     unverified_header = jwt.get_unverified_header(token)
 
     # CHOOSE OUR KEY
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header', 
             'description': 'Authorization malformed'
         }, 401)
-    
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'], 
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+
+    # GET THE PUBLIC KEY FROM THE JWKS CACHE
+    rsa_key = jwks_cache.get_key(unverified_header['kid'])
     
     # Finally, verify!
     if rsa_key:
+        generation = jwks_cache.generation
         try:
             # USE THE KEY TO VALIDATE THE JWT
             payload = jwt.decode(
@@ -105,6 +327,7 @@ def verify_decode_jwt(token):
                 audience=API_AUDIENCE,
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
+            token_cache.put(token, payload, generation)
             return payload
         
         except jwt.ExpiredSignatureError:
@@ -129,11 +352,12 @@ def verify_decode_jwt(token):
 
 
 ## ========================================
-## 3) CHECKING USER PERMISSIONS
+## 4) CHECKING USER PERMISSIONS
 ## ========================================
 '''
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink'),
+            or a list of them, any one of which grants access
         payload: decoded jwt payload
 
     Raise an AuthError if permissions are not included in the payload,
@@ -146,8 +370,9 @@ def check_permissions(permission, payload):
             'code': 'invalid_claims',
             'description': 'Permissions not included'
         }, 401)
-    
-    if permission not in payload['permissions']:
+
+    required = permission if isinstance(permission, (list, tuple)) else [permission]
+    if not any(p in payload['permissions'] for p in required):
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found'
@@ -158,21 +383,27 @@ def check_permissions(permission, payload):
 
 
 ## ========================================
-## 4) AUTH DECORATOR
+## 5) AUTH DECORATOR
 ## ========================================
 '''
     Use the get_token_auth_header method to get the token,
     Use the verify_decode_jwt method to decode the jwt,
     Use the check_permissions method validate claims and check the requested permission,
     Return the decorator which passes the decoded payload to the decorated method
+
+    the time spent here is reported as the request's auth time (metrics.py)
 '''
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            start = time.perf_counter()
+            try:
+                token = get_token_auth_header()
+                payload = verify_decode_jwt(token)
+                check_permissions(permission, payload)
+            finally:
+                record_auth_time(time.perf_counter() - start)
             return f(payload, *args, **kwargs)
 
         return wrapper
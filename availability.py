@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from models import db, Doctor, Appointment, APPOINTMENT_DURATION
+
+AVAILABILITY_CACHE_TTL = int(os.environ.get('AVAILABILITY_CACHE_TTL', 30))
+MAX_WINDOW = timedelta(days=int(os.environ.get('AVAILABILITY_MAX_WINDOW_DAYS', 62)))
+
+
+'''
+AvailabilityCache
+    Short-lived, in-process cache of availability results.
+    Writes that change a schedule call `invalidate()`; entries written by a
+    computation that started before an invalidation are discarded, so a
+    slow request cannot put stale slots back in the cache.
+'''
+class AvailabilityCache:
+    def __init__(self, ttl=AVAILABILITY_CACHE_TTL):
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def put(self, key, value, generation):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            now = time.monotonic()
+            self._entries = {k: e for k, e in self._entries.items() if e[1] > now}
+            self._entries[key] = (value, now + self.ttl)
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+availability_cache = AvailabilityCache()
+
+
+'''
+    Merges sorted (start, end) intervals that overlap or touch.
+'''
+def merge_intervals(intervals):
+    merged = []
+    for start, end in intervals:
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+
+'''
+    Working-hour intervals of a doctor inside [window_start, window_end).
+'''
+def working_intervals(doctor, window_start, window_end):
+    days = {int(day) for day in doctor.work_days.split(',')}
+    day = window_start.date()
+    while day <= window_end.date():
+        if day.weekday() in days:
+            start = max(datetime.combine(day, doctor.work_start), window_start)
+            end = min(datetime.combine(day, doctor.work_end), window_end)
+            if start < end:
+                yield start, end
+        day += timedelta(days=1)
+
+
+'''
+    Subtracts merged busy intervals from working intervals (both sorted)
+    in a single sweep, keeping the gaps at least `duration` long.
+'''
+def free_intervals(working, busy, duration):
+    free = []
+    i = 0
+    for start, end in working:
+        cursor = start
+        while i < len(busy) and busy[i][1] <= cursor:
+            i += 1
+        j = i
+        while j < len(busy) and busy[j][0] < end:
+            if busy[j][0] - cursor >= duration:
+                free.append((cursor, busy[j][0]))
+            cursor = max(cursor, busy[j][1])
+            j += 1
+        if end - cursor >= duration:
+            free.append((cursor, end))
+    return free
+
+
+'''
+    Open slots of every doctor (optionally of one speciality) between
+    `window_start` and `window_end`, as free intervals of at least `duration`.
+
+    Two queries regardless of the number of doctors: one for the doctors,
+    one for every active appointment of those doctors in the window
+    (ordered by doctor and date, served by the (doctor_id, date) index).
+    The interval arithmetic then runs in memory.
+'''
+def find_availability(speciality, window_start, window_end, duration):
+    key = (speciality, window_start, window_end, duration)
+    cached = availability_cache.get(key)
+    if cached is not None:
+        return cached
+    generation = availability_cache.generation
+
+    doctor_filter = [Doctor.speciality == speciality] if speciality else []
+    doctors = db.session.execute(
+        select(Doctor.id, Doctor.name, Doctor.speciality,
+               Doctor.work_start, Doctor.work_end, Doctor.work_days)
+        .where(*doctor_filter)
+        .order_by(Doctor.id)
+    ).all()
+
+    busy = {}
+    rows = db.session.execute(
+        select(Appointment.doctor_id, Appointment.date)
+        .join(Doctor, Doctor.id == Appointment.doctor_id)
+        .where(
+            *doctor_filter,
+            Appointment.date > window_start - APPOINTMENT_DURATION,
+            Appointment.date < window_end,
+            Appointment.status != 'Canceled'
+        )
+        .order_by(Appointment.doctor_id, Appointment.date)
+    )
+    for doctor_id, date in rows:
+        busy.setdefault(doctor_id, []).append((date, date + APPOINTMENT_DURATION))
+
+    result = []
+    for doctor in doctors:
+        working = list(working_intervals(doctor, window_start, window_end))
+        slots = free_intervals(working, merge_intervals(busy.get(doctor.id, [])), duration)
+        if slots:
+            result.append({
+                'doctor_id': doctor.id,
+                'name': doctor.name,
+                'speciality': doctor.speciality,
+                'slots': [
+                    {'start': start.isoformat(), 'end': end.isoformat()}
+                    for start, end in slots
+                ]
+            })
+
+    availability_cache.put(key, result, generation)
+    return result
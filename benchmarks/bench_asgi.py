@@ -0,0 +1,142 @@
+"""
+Sync (gunicorn, WSGI) vs async (uvicorn, ASGI) serving under a mix of reads
+and writes, reported as requests per second per core.
+
+    DATABASE_URL=postgresql://... python -m benchmarks.bench_asgi \
+        [--workers 2] [--concurrency 64] [--duration 20] [--output bench_asgi.json]
+
+Both servers run against DATABASE_URL (it should hold some doctors and
+patients, e.g. from `flask import`) with the same number of worker processes,
+one core each. Tokens are minted locally and the servers read the JWKS from
+a local file, so `requires_auth` runs for real without reaching Auth0.
+Requests are 80% GET /appointments, 10% GET /doctors, 10% POST /patients.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.tokens import LocalSigner
+
+SERVERS = {
+    'sync': ['gunicorn', '--workers', '{workers}', '--bind', '127.0.0.1:{port}', 'app:app'],
+    'async': ['uvicorn', '--workers', '{workers}', '--host', '127.0.0.1', '--port', '{port}',
+              '--no-access-log', 'asgi:app'],
+}
+
+MIX = [
+    (0.8, 'GET', '/appointments?limit=50', None),
+    (0.1, 'GET', '/doctors?limit=50', None),
+    (0.1, 'POST', '/patients', {'name': 'Load Test', 'phone': '000'}),
+]
+
+
+def pick_request():
+    roll = random.random()
+    for weight, method, path, body in MIX:
+        if roll < weight:
+            return method, path, body
+        roll -= weight
+    return MIX[-1][1:]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/doctors?limit=1')
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+def drive(port, token, concurrency, duration):
+    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+    counts = {'ok': 0, 'error': 0}
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        ok = error = 0
+        while time.time() < deadline:
+            method, path, body = pick_request()
+            try:
+                connection.request(method, path, json.dumps(body) if body else None, headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status < 500:
+                    ok += 1
+                else:
+                    error += 1
+            except (OSError, http.client.HTTPException):
+                error += 1
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        with lock:
+            counts['ok'] += ok
+            counts['error'] += error
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+
+def run_server(kind, args, env):
+    command = [part.format(workers=args.workers, port=args.port) for part in SERVERS[kind]]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(args.port)
+        counts = drive(args.port, args.token, args.concurrency, args.duration)
+    finally:
+        process.terminate()
+        process.wait()
+    rps = counts['ok'] / args.duration
+    return {
+        'requests': counts['ok'],
+        'errors': counts['error'],
+        'rps': round(rps, 1),
+        'rps_per_core': round(rps / args.workers, 1),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--output', default='bench_asgi.json')
+    args = parser.parse_args()
+
+    if 'DATABASE_URL' not in os.environ:
+        sys.exit('DATABASE_URL must point at the database to serve')
+
+    signer = LocalSigner()
+    args.token = signer.token()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, **signer.server_env(os.path.join(tmp, 'jwks.json')))
+        results = {kind: run_server(kind, args, env) for kind in SERVERS}
+
+    results['config'] = {
+        'workers': args.workers,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'mix': [(weight, method, path) for weight, method, path, _ in MIX],
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for kind in SERVERS:
+        print(f"{kind:>5}: {results[kind]['rps']:8.1f} req/s  "
+              f"{results[kind]['rps_per_core']:8.1f} req/s/core  errors={results[kind]['errors']}")
@@ -0,0 +1,87 @@
+"""
+Pulling every appointment out for analytics: paging through the JSON
+`GET /appointments` against `GET /export/appointments` in each format,
+as time, body size and peak Python memory of the worker.
+
+    python -m benchmarks.bench_export [rows]
+
+Runs in process through the test client, against DATABASE_URL when set (on
+Postgres the CSV export is a COPY), otherwise seeds a temporary SQLite
+database with `rows` appointments. Arrow and Parquet need pyarrow.
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import auth
+import exports
+from app import create_app
+from benchmarks.bench_serialization import seed
+from benchmarks.tokens import LocalSigner
+from models import db
+
+
+def json_pages(client, headers):
+    size, after = 0, None
+    while True:
+        query = '?limit=1000' + (f'&after={after}' if after else '')
+        response = client.get(f'/appointments{query}', headers=headers)
+        size += len(response.data)
+        after = response.get_json()['next_cursor']
+        if not after:
+            return size
+
+
+def export(client, headers, file_format):
+    response = client.get(f'/export/appointments?format={file_format}', headers=headers, buffered=False)
+    size = sum(len(chunk) for chunk in response.response)
+    response.close()
+    return size
+
+
+def measure(run):
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = run()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, size, peak
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tmp = None
+    database_path = os.environ.get('DATABASE_URL')
+    if database_path is None:
+        tmp = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        database_path = f'sqlite:///{tmp.name}'
+
+    signer = LocalSigner()
+    auth.AUTH0_DOMAIN = signer.domain
+    auth.API_AUDIENCE = signer.audience
+    auth.set_jwks_source(signer.jwks)
+    headers = {'Authorization': f'Bearer {signer.token()}'}
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_path})
+    client = app.test_client()
+    try:
+        if tmp is not None:
+            with app.app_context():
+                db.create_all()
+                seed(rows)
+
+        paths = [('json pages', lambda: json_pages(client, headers))]
+        paths += [(f'export {name}', lambda name=name: export(client, headers, name))
+                  for name in exports.available_formats()]
+        baseline = None
+        for name, run in paths:
+            elapsed, size, peak = measure(run)
+            baseline = baseline or elapsed
+            print(f'{name:<16} {elapsed * 1000:9.1f} ms ({baseline / elapsed:5.1f}x)  '
+                  f'{size / 1e6:8.1f} MB  peak {peak / 1e6:7.1f} MB')
+    finally:
+        if tmp is not None:
+            os.unlink(tmp.name)
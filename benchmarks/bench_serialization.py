@@ -0,0 +1,107 @@
+"""
+Cost of turning a large appointment list into a JSON body: ORM objects and
+`format()` dicts through Flask's default provider, against column tuples
+through `serialize_rows` and the fast provider.
+
+    python -m benchmarks.bench_serialization [rows]
+
+Runs against DATABASE_URL when set (the appointments table must hold at
+least `rows` rows), otherwise seeds a temporary SQLite database.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+import json_provider
+from models import setup_db, db, Doctor, Patient, Appointment, page_query, serialize_rows
+
+
+def seed(rows):
+    db.session.bulk_insert_mappings(Doctor, [
+        {'id': i + 1, 'name': f'Dr. {i}', 'speciality': 'Cardiology'} for i in range(50)
+    ])
+    db.session.bulk_insert_mappings(Patient, [
+        {'id': i + 1, 'name': f'Patient {i}', 'phone': '555-0100'} for i in range(1000)
+    ])
+    start = datetime(2025, 1, 6, 9)
+    db.session.bulk_insert_mappings(Appointment, [
+        {
+            'date': start + timedelta(minutes=30 * (i // 50)),
+            'doctor_id': i % 50 + 1,
+            'patient_id': i % 1000 + 1,
+            'status': 'Scheduled',
+            'notes': 'Follow-up visit'
+        }
+        for i in range(rows)
+    ])
+    db.session.commit()
+
+
+def timed(step):
+    start = time.perf_counter()
+    result = step()
+    return result, time.perf_counter() - start
+
+
+def format_path(app, rows):
+    appointments, query = timed(
+        lambda: Appointment.query.order_by(Appointment.date, Appointment.id).limit(rows).all())
+    body, encode = timed(lambda: app.json.response(
+        {'success': True, 'appointments': [a.format() for a in appointments]}).get_data())
+    return query, encode, len(body)
+
+
+def rows_path(dumps_bytes, rows):
+    query, names = page_query(Appointment, None, None, rows)
+    raw_rows, query_time = timed(lambda: db.session.execute(query).all())
+    body, encode = timed(lambda: dumps_bytes(
+        {'success': True, 'appointments': serialize_rows(raw_rows[:rows], names)}))
+    return query_time, encode, len(body)
+
+
+def stdlib_dumps_bytes(obj):
+    return json.dumps(obj, default=json_provider._default, separators=(',', ':')).encode()
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tmp = None
+    database_path = os.environ.get('DATABASE_URL')
+    if database_path is None:
+        tmp = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        database_path = f'sqlite:///{tmp.name}'
+
+    app = Flask(__name__)
+    app.json = DefaultJSONProvider(app)
+    setup_db(app, database_path=database_path)
+    try:
+        with app.app_context():
+            if tmp is not None:
+                db.create_all()
+                seed(rows)
+
+            paths = [
+                ('format() + default provider', lambda: format_path(app, rows)),
+                ('rows + stdlib json', lambda: rows_path(stdlib_dumps_bytes, rows)),
+            ]
+            if json_provider.orjson is not None:
+                paths.append(('rows + orjson', lambda: rows_path(json_provider.dumps_bytes, rows)))
+
+            print(f'{rows} appointments')
+            baseline = None
+            for name, run in paths:
+                db.session.expire_all()
+                query, encode, size = run()
+                baseline = baseline or query + encode
+                print(f'{name:<30} query {query * 1000:8.1f} ms  serialize {encode * 1000:8.1f} ms  '
+                      f'total {(query + encode) * 1000:8.1f} ms  ({baseline / (query + encode):.1f}x, '
+                      f'{size / 1e6:.1f} MB)')
+    finally:
+        if tmp is not None:
+            os.unlink(tmp.name)
@@ -0,0 +1,103 @@
+"""
+Cold start: time to import the app module, build the app and answer the
+first (authenticated) request, each run in a fresh interpreter.
+
+    DATABASE_URL=postgresql://... python -m benchmarks.bench_startup \
+        [--runs 10] [--gunicorn] [--workers 2] [--output bench_startup.json]
+
+Reports the median and max of each phase over the runs; the first request
+includes the JWKS fetch and first token verification. --gunicorn also
+times `gunicorn app:app` from launch to its first response, with and
+without preload_app (see gunicorn.conf.py). Tokens are minted locally as
+in bench_asgi.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_asgi import wait_for
+from benchmarks.tokens import LocalSigner
+
+PHASES = ('import', 'create_app', 'first_request')
+
+# Runs in the child interpreter; prints the phase timings (ms) as JSON
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app()
+created = time.perf_counter()
+response = flask_app.test_client().get('/patients?limit=1', headers={'Authorization': 'Bearer ' + sys.argv[1]})
+answered = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({
+    'import': (imported - start) * 1000,
+    'create_app': (created - imported) * 1000,
+    'first_request': (answered - created) * 1000,
+}))
+'''
+
+
+def time_phases(token, env):
+    output = subprocess.run([sys.executable, '-c', CHILD, token], env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+
+def time_gunicorn(args, env, preload):
+    env = dict(env, GUNICORN_PRELOAD='true' if preload else 'false')
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        ['gunicorn', '--workers', str(args.workers), '--bind', f'127.0.0.1:{args.port}', 'app:app'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_for(args.port, timeout=60)
+        return (time.perf_counter() - start) * 1000
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def summarize(samples):
+    return {'median_ms': round(statistics.median(samples), 1), 'max_ms': round(max(samples), 1)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--gunicorn', action='store_true')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--output', default='bench_startup.json')
+    args = parser.parse_args()
+
+    if 'DATABASE_URL' not in os.environ:
+        sys.exit('DATABASE_URL must point at a migrated database')
+
+    signer = LocalSigner()
+    token = signer.token()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, **signer.server_env(os.path.join(tmp, 'jwks.json')))
+        runs = [time_phases(token, env) for _ in range(args.runs)]
+        for phase in PHASES:
+            results[phase] = summarize([run[phase] for run in runs])
+        results['total'] = summarize([sum(run.values()) for run in runs])
+        if args.gunicorn:
+            for preload in (False, True):
+                samples = [time_gunicorn(args, env, preload) for _ in range(args.runs)]
+                results['gunicorn_preload' if preload else 'gunicorn'] = summarize(samples)
+
+    results['config'] = {'runs': args.runs, 'workers': args.workers}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for name, result in results.items():
+        if name != 'config':
+            print(f"{name:>16}: {result['median_ms']:8.1f} ms median  {result['max_ms']:8.1f} ms max")
@@ -0,0 +1,88 @@
+"""
+Compares two reports of `python -m benchmarks.load` and fails on latency
+regressions, for CI.
+
+    python -m benchmarks.compare baseline.json current.json [--threshold 0.2]
+        [--min-requests 50] [--metrics p95_ms,p99_ms]
+
+A route regresses when one of --metrics grew by more than --threshold
+(0.2 = 20%) over the baseline, or when it now returns errors and did not
+before. Routes with fewer than --min-requests requests in either report
+are shown but not judged: their tail percentiles are noise. Exits 1 when
+any route regressed.
+"""
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def change(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) / before
+
+
+'''
+    One row per route present in both reports (plus the total):
+    (route, {metric: (before, after, change)}, judged, regressions).
+'''
+def compare(baseline, current, metrics, threshold, min_requests):
+    rows = []
+    names = [name for name in baseline['routes'] if name in current['routes']]
+    pairs = [(name, baseline['routes'][name], current['routes'][name]) for name in names]
+    pairs.append(('total', baseline['total'], current['total']))
+    for name, before, after in pairs:
+        values = {metric: (before.get(metric), after.get(metric),
+                           change(before.get(metric), after.get(metric))) for metric in metrics}
+        judged = min(before['requests'], after['requests']) >= min_requests
+        regressions = []
+        if judged:
+            regressions = [metric for metric, (_, _, delta) in values.items()
+                           if delta is not None and delta > threshold]
+            if after['errors'] and not before['errors']:
+                regressions.append('errors')
+        rows.append((name, values, judged, regressions))
+    return rows
+
+
+def print_table(rows, metrics):
+    print(f"{'route':<32}" + ''.join(f'{metric:>24}' for metric in metrics) + '  result')
+    for name, values, judged, regressions in rows:
+        cells = ''
+        for metric in metrics:
+            before, after, delta = values[metric]
+            if before is None or after is None:
+                cells += f"{'-':>24}"
+            else:
+                cells += f"{f'{before} -> {after}':>16}{f'{delta:+.0%}' if delta is not None else '':>8}"
+        result = 'REGRESSED (' + ', '.join(regressions) + ')' if regressions else ('ok' if judged else 'skipped')
+        print(f'{name:<32}{cells}  {result}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--min-requests', type=int, default=50)
+    parser.add_argument('--metrics', default='p95_ms,p99_ms')
+    args = parser.parse_args()
+
+    baseline, current = load(args.baseline), load(args.current)
+    metrics = [metric.strip() for metric in args.metrics.split(',')]
+    for report, label in ((baseline, 'baseline'), (current, 'current')):
+        print(f"{label}: {report.get('commit') or 'unknown commit'} {json.dumps(report.get('config', {}))}")
+    if baseline.get('config', {}).get('dataset') != current.get('config', {}).get('dataset'):
+        print('warning: the reports ran on different datasets', file=sys.stderr)
+
+    rows = compare(baseline, current, metrics, args.threshold, args.min_requests)
+    print_table(rows, metrics)
+    regressed = [name for name, _, _, regressions in rows if regressions]
+    if regressed:
+        print(f"{len(regressed)} route(s) regressed by more than {args.threshold:.0%}: {', '.join(regressed)}")
+        sys.exit(1)
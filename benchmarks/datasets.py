@@ -0,0 +1,157 @@
+"""
+Synthetic datasets for benchmarks, written through the models.
+
+    DATABASE_URL=postgresql://... python -m benchmarks.datasets [--preset small]
+        [--doctors N] [--patients N] [--appointments N] [--seed 1] [--reset]
+
+Presets (doctors / patients / appointments):
+
+    tiny      10 /     1k /   10k   (SQLite friendly)
+    small    100 /    10k /  100k
+    medium    1k /   100k /    1M
+    large    10k /     1M /   10M
+
+Rows are generated deterministically from --seed and inserted in batches
+with bulk_insert_mappings, so column defaults (work hours, updated_at)
+apply as they do in the API. Appointments are spread over the doctors in
+back-to-back slots, so the data holds no double bookings. Bulk inserts
+skip the statistics rollup, so it is rebuilt at the end.
+
+--reset recreates the tables from the models, without the indexes that
+only migrations build (search). On Postgres prefer an empty database
+brought up with `flask db upgrade`.
+"""
+import argparse
+import random
+import sys
+import time
+from datetime import datetime
+
+from flask import Flask
+
+from models import setup_db, db, Doctor, Patient, Appointment, APPOINTMENT_DURATION
+from rollups import rebuild
+
+PRESETS = {
+    'tiny': (10, 1000, 10000),
+    'small': (100, 10000, 100000),
+    'medium': (1000, 100000, 1000000),
+    'large': (10000, 1000000, 10000000),
+}
+
+BATCH_SIZE = 10000
+START = datetime(2025, 1, 6, 9)
+SPECIALITIES = ['Cardiology', 'Neurology', 'Dermatology', 'Pediatrics', 'Orthopedics',
+                'Oncology', 'Psychiatry', 'Radiology', 'Urology', 'Ophthalmology']
+FIRST_NAMES = ['Ana', 'Bruno', 'Carla', 'Daniel', 'Elisa', 'Felipe', 'Gabriela', 'Hugo',
+               'Isabel', 'João', 'Karen', 'Lucas', 'Marina', 'Nuno', 'Olivia', 'Pedro']
+LAST_NAMES = ['Silva', 'Santos', 'Oliveira', 'Souza', 'Costa', 'Pereira', 'Almeida',
+              'Ferreira', 'Rodrigues', 'Gomes', 'Martins', 'Araújo', 'Ribeiro', 'Lima']
+STATUSES = ['Scheduled'] * 6 + ['Completed'] * 3 + ['Canceled']
+
+
+def name(rng):
+    return f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+
+
+def phone(rng):
+    return f'555-{rng.randrange(10000):04d}'
+
+
+def doctors(rng, count):
+    for i in range(count):
+        yield {
+            'id': i + 1,
+            'name': f'Dr. {name(rng)}',
+            'speciality': SPECIALITIES[i % len(SPECIALITIES)],
+            'phone': phone(rng),
+            'email': f'doctor{i + 1}@clinic.test'
+        }
+
+
+def patients(rng, count):
+    for i in range(count):
+        yield {
+            'id': i + 1,
+            'name': name(rng),
+            'phone': phone(rng),
+            'address': f'{rng.randrange(1, 2000)} Main Street',
+            'medical_history': rng.choice([None, 'asthma', 'hypertension', 'diabetes'])
+        }
+
+
+def appointments(rng, count, doctor_count, patient_count):
+    for i in range(count):
+        yield {
+            'id': i + 1,
+            'date': START + APPOINTMENT_DURATION * (i // doctor_count),
+            'doctor_id': i % doctor_count + 1,
+            'patient_id': rng.randrange(patient_count) + 1,
+            'status': rng.choice(STATUSES),
+            'notes': None
+        }
+
+
+def insert(model, rows, total):
+    batch, written, start = [], 0, time.perf_counter()
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            db.session.bulk_insert_mappings(model, batch)
+            db.session.commit()
+            written += len(batch)
+            batch = []
+            print(f'\r{model.__tablename__}: {written}/{total}', end='', file=sys.stderr)
+    if batch:
+        db.session.bulk_insert_mappings(model, batch)
+        db.session.commit()
+        written += len(batch)
+    print(f'\r{model.__tablename__}: {written} rows in {time.perf_counter() - start:.1f}s',
+          file=sys.stderr)
+
+
+'''
+    Moves the Postgres id sequences past the explicit ids inserted above,
+    so the API can keep creating rows.
+'''
+def reset_sequences():
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for model in (Doctor, Patient, Appointment):
+        table = model.__tablename__
+        db.session.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM {table}), 1))"))
+    db.session.commit()
+
+
+def generate(doctor_count, patient_count, appointment_count, seed=1):
+    rng = random.Random(seed)
+    insert(Doctor, doctors(rng, doctor_count), doctor_count)
+    insert(Patient, patients(rng, patient_count), patient_count)
+    insert(Appointment, appointments(rng, appointment_count, doctor_count, patient_count),
+           appointment_count)
+    reset_sequences()
+    rebuild()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--preset', choices=PRESETS, default='small')
+    parser.add_argument('--doctors', type=int)
+    parser.add_argument('--patients', type=int)
+    parser.add_argument('--appointments', type=int)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--reset', action='store_true',
+                        help='drop and recreate the tables first')
+    args = parser.parse_args()
+
+    doctor_count, patient_count, appointment_count = PRESETS[args.preset]
+    app = Flask(__name__)
+    setup_db(app)
+    with app.app_context():
+        if args.reset:
+            db.drop_all()
+            db.create_all()
+        generate(args.doctors or doctor_count, args.patients or patient_count,
+                 args.appointments or appointment_count, seed=args.seed)
@@ -0,0 +1,314 @@
+"""
+Load test of every API route, reporting latency percentiles and throughput.
+
+    DATABASE_URL=postgresql://... python -m benchmarks.load \
+        [--server gunicorn|uvicorn|none] [--url http://127.0.0.1:8765] \
+        [--workers 2] [--concurrency 32] [--duration 30] [--warmup 3] \
+        [--routes 'GET /doctors,POST /patients'] [--output bench_load.json]
+        [--token JWT]   # with --server none: a token the running server accepts
+
+The database should hold a dataset from `python -m benchmarks.datasets`.
+Unless --server none is given, an app server is started on DATABASE_URL,
+trusting a local signer (benchmarks/tokens.py): every request carries a
+locally minted RS256 token, so `requires_auth` verifies for real without
+reaching Auth0.
+
+Requests are drawn from ROUTES by weight, each on a random existing row.
+POST routes add rows, PATCH routes overwrite a field of random rows and
+DELETE routes only remove rows the run itself created.
+The report holds, per route and in total: requests, status counts, errors
+(5xx and connection failures), throughput and p50/p95/p99 latency in ms.
+Compare two reports with `python -m benchmarks.compare`.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import quote, urlsplit
+
+from sqlalchemy import create_engine, text
+
+from benchmarks.bench_asgi import wait_for
+from benchmarks.tokens import LocalSigner
+from models import encode_cursor
+
+SERVERS = {
+    'gunicorn': ['gunicorn', '--workers', '{workers}', '--bind', '127.0.0.1:{port}', 'app:app'],
+    'uvicorn': ['uvicorn', '--workers', '{workers}', '--host', '127.0.0.1', '--port', '{port}',
+                '--no-access-log', 'asgi:app'],
+}
+
+
+'''
+Scenario
+    Ids of the dataset plus the rows this run created, shared by the
+    request builders below.
+'''
+class Scenario:
+    def __init__(self, doctors, patients, appointments, rng):
+        self.doctors = doctors
+        self.patients = patients
+        self.appointments = appointments
+        self.rng = rng
+        self.created = {'doctors': [], 'patients': [], 'appointments': []}
+        self.lock = threading.Lock()
+
+    def doctor(self):
+        return self.rng.randrange(1, self.doctors + 1)
+
+    def patient(self):
+        return self.rng.randrange(1, self.patients + 1)
+
+    def appointment(self):
+        return self.rng.randrange(1, self.appointments + 1)
+
+    def future_slot(self):
+        # far from the dataset's slots, so double bookings stay rare
+        return (datetime(2030, 1, 1) + timedelta(minutes=30 * self.rng.randrange(500000))).isoformat()
+
+    def remember(self, kind, row_id):
+        with self.lock:
+            self.created[kind].append(row_id)
+
+    def take(self, kind):
+        with self.lock:
+            return self.created[kind].pop() if self.created[kind] else None
+
+
+def _get(path):
+    return lambda s: ('GET', path(s), None)
+
+
+def _delete(kind, prefix):
+    def build(s):
+        row_id = s.take(kind)
+        return ('DELETE', f'{prefix}/{row_id}', None) if row_id else None
+    return build
+
+
+# (name, weight, builder(scenario) -> (method, path, body) or None, created kind)
+ROUTES = [
+    ('GET /doctors', 10, _get(lambda s: f'/doctors?limit=50&after={encode_cursor([s.doctor()])}'), None),
+    ('GET /doctors/search', 3, _get(lambda s: f'/doctors/search?q={quote(s.rng.choice(["cardio", "silva", "555"]))}'), None),
+    ('GET /patients', 8, _get(lambda s: f'/patients?limit=50&after={encode_cursor([s.patient()])}'), None),
+    ('GET /patients/search', 5, _get(lambda s: f'/patients/search?q={quote(s.rng.choice(["ana silva", "costa", "555-01"]))}'), None),
+    ('GET /appointments', 15, _get(lambda s: '/appointments?limit=50'), None),
+    ('GET /appointments?expand', 5, _get(lambda s: '/appointments?limit=50&expand=doctor,patient'), None),
+    ('GET /appointments/doctor/<id>', 20, _get(lambda s: f'/appointments/doctor/{s.doctor()}?from=2025-01-06T00:00:00&to=2025-01-13T00:00:00'), None),
+    ('GET /availability', 5, _get(lambda s: '/availability?speciality=Cardiology&from=2025-01-06T00:00:00&to=2025-01-13T00:00:00'), None),
+    ('GET /stats/appointments', 3, _get(lambda s: f'/stats/appointments?group_by={s.rng.choice(["doctor", "speciality,status", "status"])}&bucket=week&from=2025-01-01&to=2025-04-01'), None),
+    ('GET /export/appointments', 1, _get(lambda s: f'/export/appointments?doctor_id={s.doctor()}&from=2025-01-01&to=2025-02-01'), None),
+    ('GET /health/db', 1, _get(lambda s: '/health/db'), None),
+    ('GET /health/cache', 1, _get(lambda s: '/health/cache'), None),
+    ('GET /metrics', 1, _get(lambda s: '/metrics'), None),
+    ('POST /doctors', 1, lambda s: ('POST', '/doctors', {'name': 'Dr. Load', 'speciality': 'Radiology'}), 'doctors'),
+    ('PATCH /doctors/<id>', 1, lambda s: ('PATCH', f'/doctors/{s.doctor()}', {'phone': '555-0000'}), None),
+    ('DELETE /doctors/<id>', 1, _delete('doctors', '/doctors'), None),
+    ('POST /doctors/bulk', 1, lambda s: ('POST', '/doctors/bulk', [{'id': s.doctor(), 'phone': '555-0001'} for _ in range(20)]), None),
+    ('POST /patients', 3, lambda s: ('POST', '/patients', {'name': 'Load Test', 'phone': '555-0002'}), 'patients'),
+    ('PATCH /patients/<id>', 2, lambda s: ('PATCH', f'/patients/{s.patient()}', {'address': '1 Load Street'}), None),
+    ('DELETE /patients/<id>', 2, _delete('patients', '/patients'), None),
+    ('POST /patients/bulk', 1, lambda s: ('POST', '/patients/bulk', [{'name': 'Bulk Load'} for _ in range(50)]), None),
+    ('POST /appointments', 4, lambda s: ('POST', '/appointments', {'date': s.future_slot(), 'doctor_id': s.doctor(), 'patient_id': s.patient()}), 'appointments'),
+    ('PATCH /appointments/<id>', 2, lambda s: ('PATCH', f'/appointments/{s.appointment()}', {'notes': 'load test'}), None),
+    ('DELETE /appointments/<id>', 3, _delete('appointments', '/appointments'), None),
+    ('POST /appointments/bulk', 1, lambda s: ('POST', '/appointments/bulk', [{'date': s.future_slot(), 'doctor_id': s.doctor(), 'patient_id': s.patient()} for _ in range(20)]), None),
+]
+
+RESPONSE_KEYS = {'doctors': 'doctor', 'patients': 'patient', 'appointments': 'appointment'}
+
+
+'''
+    Nearest-rank percentile of sorted `values`.
+'''
+def percentile(values, p):
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(latencies, statuses, errors, duration):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': {str(code): count for code, count in sorted(statuses.items())},
+        'rps': round(len(latencies) / duration, 1),
+        'p50_ms': _ms(percentile(latencies, 50)),
+        'p95_ms': _ms(percentile(latencies, 95)),
+        'p99_ms': _ms(percentile(latencies, 99)),
+    }
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def dataset_size(database_url):
+    engine = create_engine(database_url)
+    with engine.connect() as connection:
+        sizes = [connection.execute(text(f'SELECT COALESCE(MAX(id), 0) FROM {table}')).scalar()
+                 for table in ('doctors', 'patients', 'appointments')]
+    engine.dispose()
+    if not all(sizes):
+        sys.exit('the database is empty: load a dataset with python -m benchmarks.datasets')
+    return sizes
+
+
+def drive(url, token, scenario, routes, concurrency, duration, warmup):
+    parts = urlsplit(url)
+    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+    names = [name for name, _, _, _ in routes]
+    weights = [weight for _, weight, _, _ in routes]
+    results = {name: {'latencies': [], 'statuses': {}, 'errors': 0} for name in names}
+    lock = threading.Lock()
+    measure_from = time.time() + warmup
+    deadline = measure_from + duration
+
+    def client():
+        rng = random.Random()
+        connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+        local = {name: {'latencies': [], 'statuses': {}, 'errors': 0} for name in names}
+        while time.time() < deadline:
+            index = rng.choices(range(len(routes)), weights)[0]
+            name, _, build, kind = routes[index]
+            request = build(scenario)
+            if request is None:
+                continue
+            method, path, body = request
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+                response = connection.getresponse()
+                payload = response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                status, payload = None, b''
+                connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+            elapsed = time.perf_counter() - start
+
+            if kind and status == 200:
+                scenario.remember(kind, json.loads(payload)[RESPONSE_KEYS[kind]]['id'])
+            if time.time() < measure_from:
+                continue
+            stats = local[name]
+            if status is None or status >= 500:
+                stats['errors'] += 1
+            if status is not None:
+                stats['latencies'].append(elapsed)
+                stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+
+        with lock:
+            for name, stats in local.items():
+                results[name]['latencies'] += stats['latencies']
+                results[name]['errors'] += stats['errors']
+                for status, count in stats['statuses'].items():
+                    results[name]['statuses'][status] = results[name]['statuses'].get(status, 0) + count
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                               check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    doctors, patients, appointments = dataset_size(args.database_url)
+    scenario = Scenario(doctors, patients, appointments, random.Random(args.seed))
+    routes = ROUTES
+    if args.routes:
+        wanted = {name.strip() for name in args.routes.split(',')}
+        routes = [route for route in ROUTES if route[0] in wanted]
+        if not routes:
+            sys.exit(f'no route matches --routes; choose from: {", ".join(r[0] for r in ROUTES)}')
+
+    signer = LocalSigner()
+    process = None
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.server != 'none':
+            env = dict(os.environ, **signer.server_env(os.path.join(tmp, 'jwks.json')))
+            port = urlsplit(args.url).port
+            command = [part.format(workers=args.workers, port=port) for part in SERVERS[args.server]]
+            process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for(urlsplit(args.url).port)
+            results = drive(args.url, args.token or signer.token(), scenario, routes,
+                            args.concurrency, args.duration, args.warmup)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    report = {
+        'commit': git_commit(),
+        'config': {
+            'server': args.server,
+            'workers': args.workers,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'dataset': {'doctors': doctors, 'patients': patients, 'appointments': appointments},
+        },
+        'routes': {
+            name: summarize(stats['latencies'], stats['statuses'], stats['errors'], args.duration)
+            for name, stats in results.items()
+        },
+    }
+    everything = [latency for stats in results.values() for latency in stats['latencies']]
+    statuses = {}
+    for stats in results.values():
+        for status, count in stats['statuses'].items():
+            statuses[status] = statuses.get(status, 0) + count
+    report['total'] = summarize(everything, statuses,
+                                sum(stats['errors'] for stats in results.values()), args.duration)
+    return report
+
+
+def print_report(report):
+    print(f"{'route':<32}{'requests':>9}{'errors':>8}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, stats in list(report['routes'].items()) + [('total', report['total'])]:
+        print(f"{name:<32}{stats['requests']:>9}{stats['errors']:>8}{stats['rps']:>9}"
+              + ''.join(f"{stats[key] if stats[key] is not None else '-':>9}"
+                        for key in ('p50_ms', 'p95_ms', 'p99_ms')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=list(SERVERS) + ['none'], default='gunicorn')
+    parser.add_argument('--url', default='http://127.0.0.1:8765')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--routes', help='comma separated route names (default: all)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_load.json')
+    parser.add_argument('--token', help='bearer token for --server none')
+    args = parser.parse_args()
+
+    args.database_url = os.environ.get('DATABASE_URL')
+    if not args.database_url:
+        sys.exit('DATABASE_URL must point at the database to serve')
+    if args.server == 'none' and not args.token:
+        sys.exit('--server none needs --token: the running server does not trust locally minted tokens')
+
+    report = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print_report(report)
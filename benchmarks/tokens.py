@@ -0,0 +1,76 @@
+"""
+Local RS256 signing for benchmarks and tests: mints tokens that
+`requires_auth` verifies for real, against a JWKS served from a local file
+(or handed to auth directly) instead of Auth0.
+"""
+import json
+import time
+import auth
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+
+ALL_PERMISSIONS = [
+    'delete:appointments', 'delete:doctors', 'delete:patients',
+    'get:appointments', 'get:appointments-doctor', 'get:patients',
+    'patch:appointments', 'patch:doctors', 'patch:patients',
+    'post:appointments', 'post:doctors', 'post:patients'
+]
+
+BENCH_DOMAIN = 'doctors-crm.bench'
+BENCH_AUDIENCE = 'doctors-crm'
+
+
+class LocalSigner:
+    """RSA key pair used to mint RS256 tokens without reaching Auth0.
+    A domain or audience of None follows whatever auth.py is set to when
+    each token is minted."""
+
+    def __init__(self, kid='bench', domain=BENCH_DOMAIN, audience=BENCH_AUDIENCE,
+                 sub='auth0|bench'):
+        self.kid = kid
+        self.domain = domain
+        self.audience = audience
+        self.sub = sub
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.private_pem = private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ).decode()
+        public_pem = private_key.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode()
+        self.public_jwk = jwk.construct(public_pem, 'RS256').to_dict()
+        self.public_jwk.update({'kid': kid, 'use': 'sig'})
+
+    def jwks(self):
+        return {'keys': [self.public_jwk]}
+
+    def write_jwks(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.jwks(), f)
+        return 'file://' + path
+
+    def token(self, permissions=ALL_PERMISSIONS, expires_in=24 * 3600, **claims):
+        now = int(time.time())
+        payload = {
+            'iss': f'https://{self.domain or auth.AUTH0_DOMAIN}/',
+            'aud': self.audience or auth.API_AUDIENCE,
+            'sub': self.sub,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        payload.update(claims)
+        return jwt.encode(payload, self.private_pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def server_env(self, jwks_path):
+        """Environment for an app server that should trust this signer."""
+        return {
+            'AUTH0_DOMAIN': self.domain,
+            'AUTH0_API_AUDIENCE': self.audience,
+            'AUTH0_JWKS_URL': self.write_jwks(jwks_path),
+        }
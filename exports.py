@@ -0,0 +1,268 @@
+import csv
+import io
+import os
+import queue
+import threading
+from sqlalchemy import select
+from models import db, Appointment
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # optional: without it only CSV is offered
+    pyarrow = None
+
+'''
+Bulk export of the appointments table for analytics, as a stream of
+chunks read straight from the table (no models, no JSON):
+
+    csv       on Postgres the output of `COPY (...) TO STDOUT`, elsewhere
+              written by the csv module; a header line, timestamps as
+              `YYYY-MM-DD HH:MM:SS[.ffffff]`, NULL as an empty field
+    arrow     Arrow IPC stream, one record batch per EXPORT_BATCH_SIZE rows
+    parquet   Parquet file, one row group per EXPORT_BATCH_SIZE rows
+
+Arrow and Parquet need pyarrow.
+
+    EXPORT_BATCH_SIZE   rows fetched (through a server-side cursor) and
+                        encoded at a time (10000)
+    EXPORT_CHUNK_SIZE   bytes of COPY output per chunk sent (65536)
+
+A worker holds at most one batch, or EXPORT_QUEUE_SIZE chunks of COPY
+output, per export in memory, whatever the size of the table.
+'''
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 10000))
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 65536))
+EXPORT_QUEUE_SIZE = 8
+
+EXPORT_COLUMNS = ('id', 'date', 'status', 'notes', 'doctor_id', 'patient_id', 'updated_at')
+
+# format -> (mimetype, file extension)
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+ARROW_FORMATS = ('arrow', 'parquet')
+
+
+def available_formats():
+    return [name for name in FORMATS if pyarrow is not None or name not in ARROW_FORMATS]
+
+
+'''
+    Filters of an export of `model`: from (inclusive), to (exclusive), doctor.
+'''
+def export_criteria(date_from=None, date_to=None, doctor_id=None, model=Appointment):
+    criteria = []
+    if date_from is not None:
+        criteria.append(model.date >= date_from)
+    if date_to is not None:
+        criteria.append(model.date < date_to)
+    if doctor_id is not None:
+        criteria.append(model.doctor_id == doctor_id)
+    return criteria
+
+
+'''
+    SELECT of the export columns of `model` (Appointment, or
+    AppointmentHistory to include the archive) in date order.
+'''
+def export_query(*criteria, model=Appointment):
+    table = model.__table__
+    return (
+        select(*[table.c[name] for name in EXPORT_COLUMNS])
+        .where(*criteria)
+        .order_by(table.c.date, table.c.id)
+    )
+
+
+def fetch_batches(query, batch_size=None):
+    batch_size = batch_size or EXPORT_BATCH_SIZE
+    result = db.session.execute(query.execution_options(stream_results=True, yield_per=batch_size))
+    try:
+        yield from result.partitions()
+    finally:
+        result.close()
+
+
+'''
+    Yields the export of `criteria` in `file_format` as byte chunks. Runs
+    lazily: iterate it inside the request (stream_with_context).
+'''
+def export_chunks(file_format, *criteria, model=Appointment):
+    query = export_query(*criteria, model=model)
+    if file_format in ARROW_FORMATS:
+        return arrow_chunks(query, file_format)
+    engine = db.session.get_bind(clause=query)
+    if engine.dialect.name == 'postgresql':
+        return copy_chunks(engine, query)
+    return csv_chunks(query)
+
+
+# ------------------------------
+# CSV
+# ------------------------------
+def csv_chunks(query):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in fetch_batches(query):
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+'''
+_CopyOutput
+    File object `copy_expert` writes the COPY output to, handed to the
+    response in EXPORT_CHUNK_SIZE chunks through a bounded queue: COPY
+    waits while the client is slow, and stops when it goes away.
+'''
+class _CopyOutput:
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data.encode() if isinstance(data, str) else data
+        if len(self.buffer) >= EXPORT_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+
+    def put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise ExportCancelled()
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+def _run_copy(connection, statement, output):
+    try:
+        connection.cursor().copy_expert(statement, output)
+        connection.rollback()
+        output.flush()
+        output.put(None)
+    except BaseException as ex:
+        # The connection may be left inside the COPY: never reuse it
+        connection.invalidate()
+        try:
+            output.put(ex)
+        except ExportCancelled:
+            pass
+    finally:
+        connection.close()
+
+
+'''
+    CSV through Postgres `COPY (query) TO STDOUT`, run on a pooled
+    connection of `engine` in a thread that feeds the response.
+'''
+def copy_chunks(engine, query):
+    compiled = query.compile(dialect=engine.dialect)
+    connection = engine.raw_connection()
+    try:
+        sql = connection.cursor().mogrify(str(compiled), compiled.params).decode()
+    except BaseException:
+        connection.close()
+        raise
+    statement = f'COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER)'
+
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+    cancelled = threading.Event()
+    thread = threading.Thread(target=_run_copy, args=(connection, statement, _CopyOutput(chunks, cancelled)),
+                              daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+    finally:
+        cancelled.set()
+        thread.join()
+
+
+# ------------------------------
+# Arrow / Parquet
+# ------------------------------
+def arrow_schema():
+    return pyarrow.schema([
+        ('id', pyarrow.int32()),
+        ('date', pyarrow.timestamp('us')),
+        ('status', pyarrow.string()),
+        ('notes', pyarrow.string()),
+        ('doctor_id', pyarrow.int32()),
+        ('patient_id', pyarrow.int32()),
+        ('updated_at', pyarrow.timestamp('us')),
+    ])
+
+
+'''
+_Sink
+    Write-only file object the Arrow writers write to; what they wrote is
+    taken out after each batch.
+'''
+class _Sink:
+    def __init__(self):
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def arrow_chunks(query, file_format):
+    schema = arrow_schema()
+    sink = _Sink()
+    stream = pyarrow.PythonFile(sink, mode='w')
+    if file_format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(stream, schema)
+        write = lambda batch: writer.write_table(pyarrow.Table.from_batches([batch]))
+    else:
+        writer = pyarrow.ipc.new_stream(stream, schema)
+        write = writer.write_batch
+
+    for rows in fetch_batches(query):
+        columns = zip(*rows)
+        write(pyarrow.RecordBatch.from_arrays(
+            [pyarrow.array(values, type=field.type) for values, field in zip(columns, schema)],
+            schema=schema
+        ))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
@@ -0,0 +1,46 @@
+import gc
+import os
+
+'''
+gunicorn settings (read from the working directory by `gunicorn app:app`
+or `gunicorn -k uvicorn.workers.UvicornWorker asgi:app`).
+
+    GUNICORN_PRELOAD    build the app once in the master and fork the
+                        workers from it, sharing its memory copy-on-write
+                        (true)
+    WEB_CONCURRENCY     worker processes (gunicorn's own variable, 1)
+
+Nothing connects to the database while the app is built, so the master
+holds no connection; each worker still disposes the pools it inherited
+before serving, so no socket is ever shared across processes.
+'''
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').strip().lower() not in ('0', 'false', 'no', 'off')
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    # Imported lazily by auth.py, but every worker needs it: load it once
+    # here so the forks share it
+    from jose import jwt  # noqa: F401
+    # Move everything loaded so far out of the collector's reach, so the
+    # workers' collections don't write to (and copy) the shared pages
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+    from models import db
+    app = server.app.wsgi()
+    # asgi:app is an AsyncApp around the Flask app, with its own engine
+    flask_app = getattr(app, 'flask_app', app)
+    engines = list(getattr(flask_app.extensions.get('replicas'), 'engines', {}).values())
+    if hasattr(app, 'engine'):
+        engines.append(app.engine.sync_engine)
+    with flask_app.app_context():
+        engines.append(db.engine)
+    for engine in engines:
+        engine.dispose(close=False)
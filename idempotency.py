@@ -0,0 +1,207 @@
+import click
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+from functools import wraps
+from flask import Response, abort, current_app, make_response, request
+from flask.cli import with_appcontext
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import HTTPException
+from models import db, IdempotencyKey, utc_now
+
+'''
+Idempotency-Key support for the create routes, so a client retrying a
+POST after a timeout gets the original response instead of a duplicate.
+
+    IDEMPOTENCY_TTL             seconds a key and its response are kept (86400)
+    IDEMPOTENCY_WAIT_SECONDS    how long a retry waits for a concurrent
+                                first request to finish before a 409 (10)
+    IDEMPOTENCY_PURGE_INTERVAL  seconds between purges of expired keys,
+                                per worker (300)
+
+The first request with a key inserts its idempotency_keys row in the same
+transaction as the write it protects, so the key is committed exactly
+when the resource is. A concurrent duplicate blocks on that uncommitted
+row (Postgres unique index), then finds it and waits for the stored
+response, which is written right after the route returns.
+
+A retry whose first request failed before committing runs again: that
+request's key went with its rollback. When the route fails after its
+write committed (and the key with it), the key is kept with the failed
+response, a 500 if the route raised an unexpected exception, so the
+retry gets that answer instead of writing a second time.
+
+A retry is replayed from the idempotency_keys row alone (with an
+Idempotent-Replayed header), without touching the models. Reusing a key
+for a different request (method, path or body) is a 422.
+
+    flask purge-idempotency-keys    deletes the expired keys
+'''
+
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 10))
+IDEMPOTENCY_PURGE_INTERVAL = int(os.environ.get('IDEMPOTENCY_PURGE_INTERVAL', 300))
+MAX_KEY_LENGTH = 255
+MAX_CLAIM_ATTEMPTS = 3
+
+# Replayed for a key whose route raised after committing
+FAILED_BODY = json.dumps({'success': False, 'error': 500, 'message': 'internal server error'}).encode()
+
+_purge_lock = threading.Lock()
+_purged_at = None
+
+
+def fingerprint():
+    digest = hashlib.sha256()
+    for part in (request.method.encode(), request.path.encode(), request.get_data()):
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _row(owner, key):
+    return (IdempotencyKey.__table__.c.owner == owner) & (IdempotencyKey.__table__.c.key == key)
+
+
+'''
+    Inserts the key in the session's transaction (replacing an expired
+    one). Returns False when another request holds it; on Postgres this
+    waits until that request's transaction ends.
+'''
+def claim(owner, key, request_fingerprint):
+    table = IdempotencyKey.__table__
+    now = utc_now()
+    try:
+        db.session.execute(table.delete().where(_row(owner, key), table.c.expires_at < now))
+        db.session.execute(table.insert().values(
+            owner=owner, key=key, fingerprint=request_fingerprint,
+            expires_at=now + timedelta(seconds=IDEMPOTENCY_TTL)
+        ))
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    return True
+
+
+'''
+    Waits for the response of the request holding the key. Returns the
+    row once it has one, or None when the key is gone (that request
+    failed). Aborts with 422 for a different request, 409 on timeout.
+'''
+def wait_for_response(owner, key, request_fingerprint):
+    table = IdempotencyKey.__table__
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    delay = 0.05
+    while True:
+        row = db.session.execute(
+            select(table.c.fingerprint, table.c.status_code, table.c.body).where(_row(owner, key))
+        ).first()
+        db.session.rollback()
+        if row is None:
+            return None
+        if row.fingerprint != request_fingerprint:
+            abort(422)
+        if row.status_code is not None:
+            return row
+        if time.monotonic() >= deadline:
+            abort(409)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+def store(owner, key, response):
+    table = IdempotencyKey.__table__
+    db.session.execute(table.update().where(_row(owner, key)).values(
+        status_code=response.status_code, body=response.get_data()))
+    db.session.commit()
+
+
+'''
+    Settles the key of a request that did not succeed, `response` being
+    None when the route raised. After the rollback the key only remains
+    if the route committed it along with its write: it then keeps the
+    failed response, so no retry runs the write again.
+'''
+def record_failure(owner, key, response=None):
+    table = IdempotencyKey.__table__
+    db.session.rollback()
+    if response is None:
+        status_code, body = 500, FAILED_BODY
+    else:
+        status_code, body = response.status_code, response.get_data()
+    db.session.execute(table.update().where(_row(owner, key), table.c.status_code.is_(None)).values(
+        status_code=status_code, body=body))
+    db.session.commit()
+
+
+def replay(row):
+    return Response(row.body, status=row.status_code, mimetype='application/json',
+                    headers={'Idempotent-Replayed': 'true'})
+
+
+def purge_expired():
+    table = IdempotencyKey.__table__
+    with db.engine.begin() as connection:
+        return connection.execute(table.delete().where(table.c.expires_at < utc_now())).rowcount
+
+
+def _purge_if_due():
+    global _purged_at
+    with _purge_lock:
+        if _purged_at is not None and time.monotonic() - _purged_at < IDEMPOTENCY_PURGE_INTERVAL:
+            return
+        _purged_at = time.monotonic()
+    purge_expired()
+
+
+'''
+@idempotent decorator method
+    Makes a write route honour the Idempotency-Key header. Goes under
+    `requires_auth`: keys are scoped to the token subject.
+'''
+def idempotent(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key', None)
+        if key is None:
+            return f(payload, *args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            abort(400)
+        owner = payload.get('sub', '')
+        request_fingerprint = fingerprint()
+        _purge_if_due()
+
+        for _ in range(MAX_CLAIM_ATTEMPTS):
+            if claim(owner, key, request_fingerprint):
+                break
+            row = wait_for_response(owner, key, request_fingerprint)
+            if row is not None:
+                return replay(row)
+        else:
+            abort(409)
+
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except HTTPException as ex:
+            # abort(): settle the key with what the error handler answers
+            response = make_response(current_app.handle_user_exception(ex))
+        except BaseException:
+            record_failure(owner, key)
+            raise
+        if 200 <= response.status_code < 300:
+            store(owner, key, response)
+        else:
+            record_failure(owner, key, response)
+        return response
+    return wrapper
+
+
+@click.command('purge-idempotency-keys')
+@with_appcontext
+def purge_idempotency_keys_command():
+    """Delete the expired idempotency keys."""
+    click.echo(f'{purge_expired()} expired idempotency keys deleted')
@@ -0,0 +1,304 @@
+import click
+import csv
+import io
+import time
+from collections import Counter
+from flask.cli import with_appcontext
+from sqlalchemy import Column, DateTime, Integer, MetaData, Table, func, literal, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError
+from models import db, Doctor, Patient, Appointment, utc_now, chunked
+from response_cache import response_cache
+from rollups import apply_deltas, committed_values, rollup_key
+from validators import ValidationError, parse_id, validate_patient, validate_appointment
+
+'''
+Bulk CSV import of patients and appointments, for loading the history
+of a clinic in one go instead of one POST at a time.
+
+    flask import patients FILE.csv
+    flask import appointments FILE.csv [--chunk-size 10000] [--rejects FILE.csv]
+
+The file starts with a header line naming its columns: the fields of the
+POST body of the model, plus an optional `id`. A row with an id replaces
+that row (creating it if missing); a row without one gets a new id.
+
+The file is read `--chunk-size` rows at a time, and each chunk, in its
+own transaction:
+
+    1. is validated with the validators of the POST routes
+    2. is loaded into a temporary staging table, with COPY FROM STDIN on
+       Postgres (executemany elsewhere)
+    3. appointments: loses the rows whose doctor or patient does not exist
+    4. is upserted into the table with one INSERT ... SELECT per kind of
+       row (with / without id), keeping the statistics rollup current
+
+A row failing any step is rejected, with its line number and reason, and
+the import goes on: a chunk the database refuses is retried row by row.
+The rejected rows are listed at the end and, with --rejects, written to a
+CSV file with an `error` column, ready to be fixed and imported again.
+'''
+
+DEFAULT_CHUNK_SIZE = 10000
+SHOWN_REJECTS = 20
+
+# table -> (model, validator, the columns it returns)
+IMPORTS = {
+    'patients': (Patient, validate_patient, ('name', 'phone', 'address', 'medical_history')),
+    'appointments': (Appointment, validate_appointment,
+                     ('date', 'status', 'notes', 'doctor_id', 'patient_id')),
+}
+
+
+'''
+ImportResult
+    Counts of an import so far and the rejected rows, as
+    (line, row, error) tuples.
+'''
+class ImportResult:
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.rejected = []
+        self.doctor_ids = set()
+
+    @property
+    def rows(self):
+        return self.created + self.updated + len(self.rejected)
+
+
+def staging_table(model, fields):
+    columns = model.__table__.c
+    return Table(
+        f'import_{model.__tablename__}', MetaData(),
+        Column('line', Integer, primary_key=True),
+        Column('id', Integer),
+        *[Column(name, columns[name].type) for name in fields],
+        prefixes=['TEMPORARY']
+    )
+
+
+'''
+    The column values of a CSV row (empty fields are missing), validated
+    like a POST body. Raises ValidationError.
+'''
+def clean_row(validate, row):
+    body = {name: value if value != '' else None for name, value in row.items() if name}
+    values = validate(body)
+    values['id'] = parse_id('id', body['id']) if body.get('id') is not None else None
+    return values
+
+
+def load_staging(connection, staging, records):
+    connection.execute(staging.delete())
+    if connection.dialect.name != 'postgresql':
+        connection.execute(staging.insert(), records)
+        return
+    names = [column.name for column in staging.columns]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerows([record[name] for name in names] for record in records)
+    buffer.seek(0)
+    statement = f'COPY {staging.name} ({", ".join(names)}) FROM STDIN WITH (FORMAT csv)'
+    dbapi = connection.dialect.dbapi
+    try:
+        connection.connection.cursor().copy_expert(statement, buffer)
+    except dbapi.Error as ex:
+        # Raised by the driver directly: wrap it as SQLAlchemy would
+        raise DBAPIError.instance(statement, None, ex, dbapi.Error)
+
+
+'''
+    Drops the staged appointments whose doctor or patient does not exist;
+    returns {line: error} for them.
+'''
+def drop_unresolved(connection, staging):
+    doctor = select(Doctor.id).where(Doctor.id == staging.c.doctor_id).exists()
+    patient = select(Patient.id).where(Patient.id == staging.c.patient_id).exists()
+    unresolved = ~doctor | ~patient
+    errors = {
+        line: 'doctor not found' if not has_doctor else 'patient not found'
+        for line, has_doctor in connection.execute(
+            select(staging.c.line, doctor).where(unresolved))
+    }
+    if errors:
+        connection.execute(staging.delete().where(unresolved))
+    return errors
+
+
+def existing(connection, model, ids):
+    found = set()
+    for chunk in chunked(list(ids)):
+        found.update(connection.execute(select(model.id).where(model.id.in_(chunk))).scalars())
+    return found
+
+
+'''
+    Rollup deltas of upserting the staged appointments: +1 for each new
+    row, -1 for the row it replaces.
+'''
+def track_counts(connection, staging):
+    staged = connection.execute(
+        select(staging.c.id, staging.c.date, staging.c.doctor_id, staging.c.status)).all()
+    old = committed_values(connection, [row.id for row in staged if row.id is not None])
+    deltas = Counter()
+    for row in staged:
+        deltas[rollup_key(row.date, row.doctor_id, row.status)] += 1
+        if row.id in old:
+            deltas[rollup_key(*old[row.id])] -= 1
+    apply_deltas(connection, deltas)
+    return {row.doctor_id for row in staged} | {values[1] for values in old.values()}
+
+
+'''
+    Moves the serial sequence of `table` past the explicit ids just
+    written, so the rows inserted without one do not collide (Postgres).
+'''
+def advance_sequence(connection, table, top_id):
+    sequence = connection.execute(
+        text("SELECT pg_get_serial_sequence(:table, 'id')"), {'table': table.name}).scalar()
+    if sequence and top_id > connection.execute(text(f'SELECT last_value FROM {sequence}')).scalar():
+        connection.execute(text('SELECT setval(:sequence, :value)'), {'sequence': sequence, 'value': top_id})
+
+
+def upsert(connection, model, staging, fields):
+    table = model.__table__
+    now = literal(utc_now(), DateTime)
+    source = [staging.c[name] for name in fields]
+    insert = postgresql.insert if connection.dialect.name == 'postgresql' else sqlite.insert
+
+    with_id = insert(table).from_select(
+        ['id', *fields, 'updated_at'],
+        select(staging.c.id, *source, now).where(staging.c.id.isnot(None))
+    )
+    connection.execute(with_id.on_conflict_do_update(
+        index_elements=['id'],
+        set_={name: with_id.excluded[name] for name in (*fields, 'updated_at')}
+    ))
+    if connection.dialect.name == 'postgresql':
+        top_id = connection.execute(select(func.max(staging.c.id))).scalar()
+        if top_id is not None:
+            advance_sequence(connection, table, top_id)
+    connection.execute(table.insert().from_select(
+        [*fields, 'updated_at'],
+        select(*source, now).where(staging.c.id.is_(None)).order_by(staging.c.line)
+    ))
+
+
+'''
+    Writes one chunk of validated rows ((line, row, values) tuples) in a
+    transaction. A chunk the database refuses is retried row by row, so
+    only the offending rows are rejected.
+'''
+def write_chunk(connection, model, fields, staging, rows, result):
+    try:
+        with connection.begin():
+            load_staging(connection, staging, [
+                dict(values, line=line) for line, _, values in rows
+            ])
+            errors = drop_unresolved(connection, staging) if model is Appointment else {}
+            ids = [values['id'] for line, _, values in rows if line not in errors and values['id'] is not None]
+            found = existing(connection, model, ids)
+            doctor_ids = track_counts(connection, staging) if model is Appointment else set()
+            upsert(connection, model, staging, fields)
+    except (IntegrityError, DataError) as ex:
+        if len(rows) == 1:
+            line, row, _ = rows[0]
+            result.rejected.append((line, row, str(ex.orig).strip().splitlines()[0]))
+            return
+        for row in rows:
+            write_chunk(connection, model, fields, staging, [row], result)
+        return
+
+    result.rejected += [(line, row, errors[line]) for line, row, _ in rows if line in errors]
+    updated = len(set(ids) & found)
+    result.updated += updated
+    result.created += len(rows) - len(errors) - updated
+    result.doctor_ids |= doctor_ids
+
+
+'''
+    Imports the CSV file `source` into the table `name` (IMPORTS), calling
+    `progress(result)` after each chunk. Returns the ImportResult.
+'''
+def import_csv(name, source, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    model, validate, fields = IMPORTS[name]
+    staging = staging_table(model, fields)
+    result = ImportResult()
+    reader = csv.DictReader(source)
+
+    with db.engine.connect() as connection:
+        with connection.begin():
+            staging.create(connection)
+        def flush():
+            write_chunk(connection, model, fields, staging, chunk, result)
+            chunk.clear()
+            chunk_ids.clear()
+            if progress is not None:
+                progress(result)
+
+        try:
+            chunk, chunk_ids = [], set()
+            for row in reader:
+                try:
+                    values = clean_row(validate, row)
+                except ValidationError as ex:
+                    result.rejected.append((reader.line_num, row, ex.message))
+                    continue
+                # A later row with the same id replaces the earlier one:
+                # never upsert one id twice in a statement
+                if values['id'] is not None and values['id'] in chunk_ids:
+                    flush()
+                chunk.append((reader.line_num, row, values))
+                chunk_ids.add(values['id'])
+                if len(chunk) >= chunk_size:
+                    flush()
+            if chunk:
+                flush()
+        finally:
+            with connection.begin():
+                staging.drop(connection)
+
+    result.rejected.sort(key=lambda rejected: rejected[0])
+    response_cache.invalidate(name, *[f'appointments:doctor:{doctor_id}' for doctor_id in result.doctor_ids])
+    return result
+
+
+def write_rejects(path, rejected):
+    names = list(dict.fromkeys(name for _, row, _ in rejected for name in row if name))
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['line', *names, 'error'])
+        for line, row, error in rejected:
+            writer.writerow([line, *[row.get(name) for name in names], error])
+
+
+@click.command('import')
+@click.argument('table', type=click.Choice(list(IMPORTS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk-size', type=click.IntRange(min=1), default=DEFAULT_CHUNK_SIZE, show_default=True,
+              help='Rows validated and written per transaction.')
+@click.option('--rejects', type=click.Path(dir_okay=False), default=None,
+              help='Write the rejected rows, with an error column, to this CSV file.')
+@with_appcontext
+def import_command(table, path, chunk_size, rejects):
+    """Import patients or appointments from a CSV file."""
+    start = time.perf_counter()
+
+    def progress(result):
+        elapsed = time.perf_counter() - start
+        click.echo(f'{result.rows} rows  {result.rows / elapsed:.0f} rows/s', err=True)
+
+    with open(path, newline='', encoding='utf-8-sig') as source:
+        result = import_csv(table, source, chunk_size, progress)
+    elapsed = time.perf_counter() - start
+
+    for line, _, error in result.rejected[:SHOWN_REJECTS]:
+        click.echo(f'line {line}: {error}', err=True)
+    if len(result.rejected) > SHOWN_REJECTS:
+        click.echo(f'... and {len(result.rejected) - SHOWN_REJECTS} more rejected rows', err=True)
+    if rejects and result.rejected:
+        write_rejects(rejects, result.rejected)
+    click.echo(f'{table}: {result.created} created, {result.updated} updated, '
+               f'{len(result.rejected)} rejected in {elapsed:.1f}s '
+               f'({result.rows / max(elapsed, 1e-9):.0f} rows/s)')
@@ -0,0 +1,63 @@
+import json
+from datetime import date, time
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional: fall back to the stdlib encoder
+    orjson = None
+
+'''
+JSON encoding for every response body: jsonify, the NDJSON streams and the
+ASGI read path all go through `dumps_bytes`.
+
+With orjson installed, bodies are encoded by orjson (several times faster
+than the stdlib on large row lists); otherwise by the stdlib `json` module.
+Both produce compact output with keys in insertion order and write dates
+and times as ISO 8601, so the response body does not depend on which
+encoder is installed and rows can carry datetime values as fetched.
+'''
+
+
+'''
+    Encodes values the encoders do not handle natively: dates and times as
+    ISO 8601 (what orjson does natively), anything else (Decimal, UUID,
+    dataclasses, ...) the way Flask's default provider does.
+'''
+def _default(value):
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return DefaultJSONProvider.default(value)
+
+
+if orjson is not None:
+    def dumps_bytes(obj):
+        return orjson.dumps(obj, default=_default)
+else:
+    _encoder = json.JSONEncoder(default=_default, separators=(',', ':'), ensure_ascii=False)
+
+    def dumps_bytes(obj):
+        return _encoder.encode(obj).encode()
+
+
+def dumps(obj):
+    return dumps_bytes(obj).decode()
+
+
+'''
+FastJSONProvider
+    Flask JSON provider backed by `dumps_bytes`. Responses are always
+    compact, including in debug mode.
+'''
+class FastJSONProvider(DefaultJSONProvider):
+    sort_keys = False
+    compact = True
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj), mimetype=self.mimetype)
@@ -0,0 +1,273 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from models import db
+
+'''
+Per-request instrumentation of the Flask app, installed by `init_metrics`:
+
+    - wall time of the request
+    - time spent in `requires_auth` (header parsing, JWT verification,
+      permission check)
+    - number of SQL statements and the time spent executing them, from the
+      engine's before_cursor_execute / after_cursor_execute events
+    - size of the serialized response body
+
+Each is kept as a Prometheus histogram labelled by route template and
+method, rendered in the text exposition format by `render_metrics`
+(served on GET /metrics). The numbers are per worker process; Prometheus
+sums them across workers. Every response also carries a Server-Timing
+header with the same breakdown. The routes asgi.py serves natively record
+the same histograms, under the same route templates, through
+`start_native_request` / `finish_native_request`.
+
+    SLOW_REQUEST_MS     log requests slower than this, with their SQL
+                        statements and timings, 0 = off (0)
+'''
+
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 0))
+SLOW_REQUEST_MAX_STATEMENTS = 50
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Histogram
+    Cumulative-bucket histogram with one series per label set.
+'''
+class Histogram:
+    def __init__(self, name, description, buckets, labels=('route', 'method')):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def snapshot(self, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                return {'count': 0, 'sum': 0.0}
+            return {'count': series[1], 'sum': series[2]}
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((key, ([*counts], count, total))
+                            for key, (counts, count, total) in self._series.items())
+        for label_values, (counts, count, total) in series:
+            labels = ','.join(f'{name}="{_escape(value)}"'
+                              for name, value in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total:.6f}')
+        return '\n'.join(lines)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Wall time of the request.', TIME_BUCKETS)
+AUTH_SECONDS = Histogram(
+    'http_request_auth_seconds', 'Time spent in requires_auth.', TIME_BUCKETS)
+DB_QUERIES = Histogram(
+    'http_request_db_queries', 'SQL statements executed per request.', COUNT_BUCKETS)
+DB_SECONDS = Histogram(
+    'http_request_db_seconds', 'Time spent executing SQL statements.', TIME_BUCKETS)
+RESPONSE_BYTES = Histogram(
+    'http_response_size_bytes', 'Size of the serialized response body.', SIZE_BUCKETS)
+
+HISTOGRAMS = (REQUEST_SECONDS, AUTH_SECONDS, DB_QUERIES, DB_SECONDS, RESPONSE_BYTES)
+
+
+'''
+RequestStats
+    Timings collected while one request is served, kept on `flask.g`.
+'''
+class RequestStats:
+    def __init__(self, keep_statements=False):
+        self.start = time.perf_counter()
+        self.auth_seconds = 0.0
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.statements = [] if keep_statements else None
+
+
+# Stats of the request served outside Flask (asgi.py) in this context:
+# the asyncio task of the request, which SQLAlchemy's async engine and
+# asyncio.to_thread carry into the code they run
+_native_stats = contextvars.ContextVar('native_request_stats', default=None)
+
+
+def current_stats():
+    if not has_request_context():
+        return _native_stats.get()
+    return g.get('request_stats', None)
+
+
+'''
+    Adds `seconds` to the auth time of the current request (no-op outside
+    an instrumented request).
+'''
+def record_auth_time(seconds):
+    stats = current_stats()
+    if stats is not None:
+        stats.auth_seconds += seconds
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_start
+    stats = current_stats()
+    if stats is None:
+        return
+    stats.db_queries += 1
+    stats.db_seconds += elapsed
+    if stats.statements is not None and len(stats.statements) < SLOW_REQUEST_MAX_STATEMENTS:
+        stats.statements.append((elapsed, statement))
+
+
+'''
+    Server-Timing value for the stats collected so far.
+'''
+def server_timing(stats, total):
+    return ', '.join([
+        f'app;dur={total * 1000:.1f}',
+        f'auth;dur={stats.auth_seconds * 1000:.1f}',
+        f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.db_queries} queries"',
+    ])
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _observe(stats, route, method, status, size, slow_request_ms):
+    total = time.perf_counter() - stats.start
+    REQUEST_SECONDS.observe(total, route, method)
+    AUTH_SECONDS.observe(stats.auth_seconds, route, method)
+    DB_QUERIES.observe(stats.db_queries, route, method)
+    DB_SECONDS.observe(stats.db_seconds, route, method)
+    if size is not None:
+        RESPONSE_BYTES.observe(size, route, method)
+
+    if slow_request_ms and total * 1000 >= slow_request_ms:
+        statements = ''.join(
+            f'\n    {elapsed * 1000:8.1f} ms  {" ".join(statement.split())}'
+            for elapsed, statement in stats.statements or ()
+        )
+        logger.warning(
+            'slow request %s %s -> %s: %.1f ms (auth %.1f ms, db %.1f ms in %d queries)%s',
+            method, route, status, total * 1000, stats.auth_seconds * 1000,
+            stats.db_seconds * 1000, stats.db_queries, statements
+        )
+
+
+'''
+    Counts the statements `engine` executes (the `sync_engine` of an
+    async engine) in the stats of the current request.
+'''
+def instrument_engine(engine):
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+'''
+    Starts the stats of a request served outside Flask, in the current
+    context. End it with `finish_native_request`.
+'''
+def start_native_request(slow_request_ms=0):
+    stats = RequestStats(keep_statements=slow_request_ms > 0)
+    _native_stats.set(stats)
+    return stats
+
+
+'''
+    Records a request started with `start_native_request`, like the Flask
+    hooks do, and returns its Server-Timing header value.
+'''
+def finish_native_request(stats, route, method, status, size, slow_request_ms=0):
+    _native_stats.set(None)
+    timing = server_timing(stats, time.perf_counter() - stats.start)
+    _observe(stats, route, method, status, size, slow_request_ms)
+    return timing
+
+
+'''
+    Installs the request hooks and the SQL event listeners on `app`.
+    The SLOW_REQUEST_MS config value overrides the environment setting.
+'''
+def init_metrics(app):
+    app.config.setdefault('SLOW_REQUEST_MS', SLOW_REQUEST_MS)
+
+    with app.app_context():
+        engines = [db.engine]
+    if 'replicas' in app.extensions:
+        # queries on read replicas count too (see replicas.py)
+        engines += app.extensions['replicas'].engines.values()
+    for engine in engines:
+        instrument_engine(engine)
+
+    @app.before_request
+    def start_request_stats():
+        g.request_stats = RequestStats(keep_statements=app.config['SLOW_REQUEST_MS'] > 0)
+
+    @app.after_request
+    def finish_request_stats(response):
+        stats = g.get('request_stats', None)
+        if stats is None:
+            return response
+        response.headers['Server-Timing'] = server_timing(stats, time.perf_counter() - stats.start)
+
+        route, method, status = _route(), request.method, response.status_code
+        slow_request_ms = app.config['SLOW_REQUEST_MS']
+        if response.is_streamed:
+            # the body (and its queries) is produced after this hook runs;
+            # record once the last chunk has been sent
+            response.call_on_close(
+                lambda: _observe(stats, route, method, status, None, slow_request_ms))
+        else:
+            _observe(stats, route, method, status, response.calculate_content_length(),
+                     slow_request_ms)
+        return response
+
+
+'''
+    Every histogram in the Prometheus text exposition format.
+'''
+def render_metrics():
+    return '\n'.join(histogram.render() for histogram in HISTOGRAMS) + '\n'
@@ -1,7 +1,7 @@
 """empty message
 
 Revision ID: 058f16663f06
-Revises: 
+Revises: 3f6c2b8e1a70
 Create Date: 2025-11-14 16:32:08.785370
 
 """
@@ -11,7 +11,7 @@ import sqlalchemy as sa
 
 # revision identifiers, used by Alembic.
 revision = '058f16663f06'
-down_revision = None
+down_revision = '3f6c2b8e1a70'
 branch_labels = None
 depends_on = None
 
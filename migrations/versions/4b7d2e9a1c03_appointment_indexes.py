@@ -0,0 +1,38 @@
+"""appointment lookup indexes
+
+Revision ID: 4b7d2e9a1c03
+Revises: 058f16663f06
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '4b7d2e9a1c03'
+down_revision = '058f16663f06'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_appointments_date_id', ['date', 'id']),
+    ('ix_appointments_doctor_id_date', ['doctor_id', 'date']),
+    ('ix_appointments_patient_id_date', ['patient_id', 'date']),
+    ('ix_appointments_status_date', ['status', 'date']),
+]
+
+
+def upgrade():
+    # Built concurrently on Postgres so the table stays writable meanwhile.
+    with op.get_context().autocommit_block():
+        for name, columns in INDEXES:
+            op.create_index(name, 'appointments', columns, unique=False,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, _ in INDEXES:
+            op.drop_index(name, table_name='appointments',
+                          postgresql_concurrently=True)
@@ -0,0 +1,48 @@
+"""patient and doctor search indexes
+
+Revision ID: 5d0b7e3f9a14
+Revises: c41f8a2d6b90
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5d0b7e3f9a14'
+down_revision = 'c41f8a2d6b90'
+branch_labels = None
+depends_on = None
+
+
+# Must match search.search_document(): the search fields joined by spaces.
+DOCUMENTS = {
+    'doctors': "coalesce(name, '') || ' ' || coalesce(speciality, '') || ' ' || "
+               "coalesce(phone, '') || ' ' || coalesce(email, '')",
+    'patients': "coalesce(name, '') || ' ' || coalesce(phone, '')",
+}
+
+
+def upgrade():
+    # Postgres only: SQLite (local tests) searches with LIKE.
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # Built concurrently so the tables stay writable meanwhile.
+    with op.get_context().autocommit_block():
+        for table, document in DOCUMENTS.items():
+            op.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{table}_search_tsv "
+                       f"ON {table} USING gin (to_tsvector('simple'::regconfig, {document}))")
+            op.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{table}_search_trgm "
+                       f"ON {table} USING gin (({document}) gin_trgm_ops)")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    with op.get_context().autocommit_block():
+        for table in DOCUMENTS:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS ix_{table}_search_trgm')
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS ix_{table}_search_tsv')
@@ -0,0 +1,32 @@
+"""doctor working hours
+
+Revision ID: 9e3a51c7d8f2
+Revises: 4b7d2e9a1c03
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e3a51c7d8f2'
+down_revision = '4b7d2e9a1c03'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('doctors', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('work_start', sa.Time(), nullable=False, server_default='09:00:00'))
+        batch_op.add_column(sa.Column('work_end', sa.Time(), nullable=False, server_default='17:00:00'))
+        batch_op.add_column(sa.Column('work_days', sa.String(), nullable=False, server_default='0,1,2,3,4'))
+        batch_op.create_index('ix_doctors_speciality', ['speciality'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('doctors', schema=None) as batch_op:
+        batch_op.drop_index('ix_doctors_speciality')
+        batch_op.drop_column('work_days')
+        batch_op.drop_column('work_end')
+        batch_op.drop_column('work_start')
@@ -0,0 +1,47 @@
+"""appointments ON DELETE CASCADE
+
+Revision ID: b5f2c8d4e619
+Revises: e83b5d1c2a47
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5f2c8d4e619'
+down_revision = 'e83b5d1c2a47'
+branch_labels = None
+depends_on = None
+
+
+# column -> referenced table
+REFERENCES = {'doctor_id': 'doctors', 'patient_id': 'patients'}
+NAMING_CONVENTION = {'fk': '%(table_name)s_%(column_0_name)s_fkey'}
+
+
+def replace_foreign_keys(ondelete):
+    if op.get_bind().dialect.name != 'postgresql':
+        with op.batch_alter_table('appointments', naming_convention=NAMING_CONVENTION) as batch_op:
+            for column, table in REFERENCES.items():
+                batch_op.drop_constraint(f'appointments_{column}_fkey', type_='foreignkey')
+                batch_op.create_foreign_key(f'appointments_{column}_fkey', table, [column], ['id'],
+                                            ondelete=ondelete)
+        return
+
+    # The existing rows already satisfy the keys: add them NOT VALID (no
+    # scan under the ALTER's lock), then validate with a weaker lock.
+    action = f' ON DELETE {ondelete}' if ondelete else ''
+    for column, table in REFERENCES.items():
+        name = f'appointments_{column}_fkey'
+        op.execute(f'ALTER TABLE appointments DROP CONSTRAINT {name}, '
+                   f'ADD CONSTRAINT {name} FOREIGN KEY ({column}) REFERENCES {table} (id){action} NOT VALID')
+        op.execute(f'ALTER TABLE appointments VALIDATE CONSTRAINT {name}')
+
+
+def upgrade():
+    replace_foreign_keys('CASCADE')
+
+
+def downgrade():
+    replace_foreign_keys(None)
@@ -0,0 +1,47 @@
+"""updated_at version columns
+
+Revision ID: c41f8a2d6b90
+Revises: 9e3a51c7d8f2
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41f8a2d6b90'
+down_revision = '9e3a51c7d8f2'
+branch_labels = None
+depends_on = None
+
+
+TABLES = ['doctors', 'patients', 'appointments']
+
+
+def upgrade():
+    # Existing rows get the migration time (UTC) as their first version.
+    if op.get_bind().dialect.name == 'postgresql':
+        now = sa.text("(now() AT TIME ZONE 'utc')")
+    else:
+        now = sa.text('(CURRENT_TIMESTAMP)')
+    for table in TABLES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=False,
+                                          server_default=now))
+
+    with op.get_context().autocommit_block():
+        for table in TABLES:
+            op.create_index(f'ix_{table}_updated_at', table, ['updated_at'], unique=False,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table in TABLES:
+            op.drop_index(f'ix_{table}_updated_at', table_name=table,
+                          postgresql_concurrently=True)
+
+    for table in TABLES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('updated_at')
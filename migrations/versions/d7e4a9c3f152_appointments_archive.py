@@ -0,0 +1,49 @@
+"""appointments_archive
+
+Revision ID: d7e4a9c3f152
+Revises: b5f2c8d4e619
+Create Date: 2026-10-18 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7e4a9c3f152'
+down_revision = 'b5f2c8d4e619'
+branch_labels = None
+depends_on = None
+
+INDEXES = {
+    'ix_appointments_archive_date_id': ['date', 'id'],
+    'ix_appointments_archive_doctor_id_date': ['doctor_id', 'date'],
+    'ix_appointments_archive_patient_id_date': ['patient_id', 'date'],
+}
+
+
+def upgrade():
+    op.create_table('appointments_archive',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('date', sa.DateTime(), nullable=False),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('notes', sa.String(), nullable=True),
+    sa.Column('doctor_id', sa.Integer(), nullable=False),
+    sa.Column('patient_id', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.Column('archived_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['doctor_id'], ['doctors.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['patient_id'], ['patients.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    for name, columns in INDEXES.items():
+        op.create_index(name, 'appointments_archive', columns, unique=False)
+
+
+def downgrade():
+    # Put the archived appointments back rather than lose them
+    op.execute('INSERT INTO appointments (id, date, status, notes, doctor_id, patient_id, updated_at) '
+               'SELECT id, date, status, notes, doctor_id, patient_id, updated_at FROM appointments_archive')
+    for name in INDEXES:
+        op.drop_index(name, table_name='appointments_archive')
+    op.drop_table('appointments_archive')
@@ -1,22 +1,90 @@
 import os
+import base64
+import json
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, String, Integer, ForeignKey, DateTime
-from sqlalchemy.orm import relationship
-from datetime import datetime, timezone
+from flask_sqlalchemy.session import Session
+import sqlite3
+from sqlalchemy import Column, String, Integer, ForeignKey, Date, DateTime, Time, LargeBinary, Index, event, func, inspect, select, tuple_, union_all
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import foreign, relationship
+from datetime import datetime, time, timedelta, timezone
+from pool import engine_options, pool_settings
 
-db = SQLAlchemy()
+
+"""
+RoutingSession
+    session that sends reads to the replica engine chosen for the current
+    request (g.read_engine, set by replicas.replica_reads); flushes and
+    INSERT / UPDATE / DELETE statements always go to the primary
+"""
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context():
+            engine = g.get('read_engine', None)
+            if engine is not None and not getattr(clause, 'is_dml', False):
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+"""
+enforce_sqlite_foreign_keys
+    SQLite checks foreign keys, and runs their ON DELETE rules, only on
+    connections that ask for it
+"""
+@event.listens_for(Engine, 'connect')
+def enforce_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys = ON')
+        cursor.close()
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000
+DEFAULT_WORK_START = time(9, 0)
+DEFAULT_WORK_END = time(17, 0)
+DEFAULT_WORK_DAYS = '0,1,2,3,4'  # weekday numbers, Monday is 0
+APPOINTMENT_DURATION = timedelta(minutes=int(os.environ.get('APPOINTMENT_DURATION_MINUTES', 30)))
+
+
+"""
+utc_now()
+    current UTC time as a naive datetime, the value of `updated_at` columns
+"""
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+"""
+normalize_database_url(url)
+    postgres:// (as Heroku spells it) to the postgresql:// SQLAlchemy expects
+"""
+def normalize_database_url(url):
+    if url.startswith('postgres://'):
+        return url.replace('postgres://', 'postgresql://', 1)
+    return url
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service,
+    with the connection pool configured from the environment (see pool.py)
 """
-def setup_db(app):
-    database_path = os.environ['DATABASE_URL']
-    if database_path.startswith('postgres://'):
-        database_path = database_path.replace('postgres://', 'postgresql://', 1)
-        
+def setup_db(app, database_path=None):
+    if database_path is None:
+        database_path = os.environ['DATABASE_URL']
+    database_path = normalize_database_url(database_path)
+
     app.config['SQLALCHEMY_DATABASE_URI'] = database_path
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # pool settings from the environment; explicit app config wins
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **engine_options(database_path),
+        **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+    }
+    app.config.setdefault('DB_PGBOUNCER', pool_settings()['pgbouncer'])
     db.init_app(app)
 
 
@@ -25,6 +93,12 @@ def setup_db(app):
 # ------------------------------
 class Doctor(db.Model):
     __tablename__ = 'doctors'
+    __table_args__ = (
+        Index('ix_doctors_speciality', 'speciality'),
+        Index('ix_doctors_updated_at', 'updated_at'),
+    )
+    sort_keys = ('id',)
+    summary_fields = ('id', 'name', 'speciality')
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
@@ -32,14 +106,28 @@ class Doctor(db.Model):
     phone = Column(String)
     email = Column(String)
 
-    # Relationship with appointments
-    appointments = relationship('Appointment', backref='doctor', lazy=True)
+    # Working hours, used by the availability search
+    work_start = Column(Time, nullable=False, default=DEFAULT_WORK_START)
+    work_end = Column(Time, nullable=False, default=DEFAULT_WORK_END)
+    work_days = Column(String, nullable=False, default=DEFAULT_WORK_DAYS)
 
-    def __init__(self, name, speciality, phone=None, email=None):
+    # Version column: set on every INSERT / UPDATE, read by the collection ETags
+    updated_at = Column(DateTime, nullable=False, default=utc_now, onupdate=utc_now)
+
+    # Relationship with appointments. Deleting a doctor deletes them in the
+    # database (ON DELETE CASCADE), never through the session
+    appointments = relationship('Appointment', backref='doctor', lazy=True, passive_deletes='all')
+
+    def __init__(self, name, speciality, phone=None, email=None,
+                 work_start=DEFAULT_WORK_START, work_end=DEFAULT_WORK_END,
+                 work_days=DEFAULT_WORK_DAYS):
         self.name = name
         self.speciality = speciality
         self.phone = phone
         self.email = email
+        self.work_start = work_start
+        self.work_end = work_end
+        self.work_days = work_days
 
     def insert(self):
         db.session.add(self)
@@ -58,7 +146,11 @@ class Doctor(db.Model):
             'name': self.name,
             'speciality': self.speciality,
             'phone': self.phone,
-            'email': self.email
+            'email': self.email,
+            'work_start': self.work_start.isoformat(),
+            'work_end': self.work_end.isoformat(),
+            'work_days': self.work_days,
+            'updated_at': self.updated_at.isoformat()
         }
 
 # ------------------------------
@@ -66,6 +158,11 @@ class Doctor(db.Model):
 # ------------------------------
 class Patient(db.Model):
     __tablename__ = 'patients'
+    __table_args__ = (
+        Index('ix_patients_updated_at', 'updated_at'),
+    )
+    sort_keys = ('id',)
+    summary_fields = ('id', 'name', 'phone')
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
@@ -73,8 +170,11 @@ class Patient(db.Model):
     address = Column(String)
     medical_history = Column(String)
 
-    # Relationship with appointments
-    appointments = relationship('Appointment', backref='patient', lazy=True)
+    # Version column: set on every INSERT / UPDATE, read by the collection ETags
+    updated_at = Column(DateTime, nullable=False, default=utc_now, onupdate=utc_now)
+
+    # Relationship with appointments, deleted with the patient like a doctor's
+    appointments = relationship('Appointment', backref='patient', lazy=True, passive_deletes='all')
 
     def __init__(self, name, phone=None, address=None, medical_history=None):
         self.name = name
@@ -99,7 +199,8 @@ class Patient(db.Model):
             'name': self.name,
             'phone': self.phone,
             'address': self.address,
-            'medical_history': self.medical_history
+            'medical_history': self.medical_history,
+            'updated_at': self.updated_at.isoformat()
         }
 
 # ------------------------------
@@ -107,14 +208,26 @@ class Patient(db.Model):
 # ------------------------------
 class Appointment(db.Model):
     __tablename__ = 'appointments'
+    __table_args__ = (
+        Index('ix_appointments_date_id', 'date', 'id'),
+        Index('ix_appointments_doctor_id_date', 'doctor_id', 'date'),
+        Index('ix_appointments_patient_id_date', 'patient_id', 'date'),
+        Index('ix_appointments_status_date', 'status', 'date'),
+        Index('ix_appointments_updated_at', 'updated_at'),
+    )
+    sort_keys = ('date', 'id')
+    expandable = ('doctor', 'patient')
 
     id = Column(Integer, primary_key=True)
     date = Column(DateTime, nullable=False, default=datetime.now(timezone.utc))
     status = Column(String, nullable=False, default='Scheduled')  # e.g., Scheduled, Canceled, Completed, Reschedule
     notes = Column(String)
 
-    doctor_id = Column(Integer, ForeignKey('doctors.id'), nullable=False)
-    patient_id = Column(Integer, ForeignKey('patients.id'), nullable=False)
+    doctor_id = Column(Integer, ForeignKey('doctors.id', ondelete='CASCADE'), nullable=False)
+    patient_id = Column(Integer, ForeignKey('patients.id', ondelete='CASCADE'), nullable=False)
+
+    # Version column: set on every INSERT / UPDATE, read by the collection ETags
+    updated_at = Column(DateTime, nullable=False, default=utc_now, onupdate=utc_now)
 
     def __init__(self, date, doctor_id, patient_id, status='Scheduled', notes=None):
         self.date = date
@@ -134,6 +247,44 @@ class Appointment(db.Model):
         db.session.delete(self)
         db.session.commit()
 
+    """
+    schedule_criteria(doctor_id, date_from, date_to, status)
+        filters for one doctor's appointments: from inclusive, to exclusive
+    """
+    @classmethod
+    def schedule_criteria(cls, doctor_id, date_from=None, date_to=None, status=None):
+        criteria = [cls.doctor_id == doctor_id]
+        if date_from:
+            criteria.append(cls.date >= date_from)
+        if date_to:
+            criteria.append(cls.date < date_to)
+        if status:
+            criteria.append(cls.status == status)
+        return criteria
+
+    """
+    conflicting(doctor_id, date, exclude_id, exclude_ids)
+        returns the id of an active (not canceled) appointment of the doctor,
+        other than `exclude_id` / `exclude_ids`, overlapping a slot of
+        APPOINTMENT_DURATION starting at `date`, or None.
+        Slots have a fixed length, so two appointments overlap exactly when
+        their start times are less than one duration apart: a range scan on
+        the (doctor_id, date) index.
+    """
+    @classmethod
+    def conflicting(cls, doctor_id, date, exclude_id=None, exclude_ids=()):
+        query = select(cls.id).where(
+            cls.doctor_id == doctor_id,
+            cls.date > date - APPOINTMENT_DURATION,
+            cls.date < date + APPOINTMENT_DURATION,
+            cls.status != 'Canceled'
+        )
+        if exclude_id is not None:
+            query = query.where(cls.id != exclude_id)
+        if exclude_ids:
+            query = query.where(cls.id.notin_(exclude_ids))
+        return db.session.execute(query.limit(1)).scalar()
+
     def format(self):
         return {
             'id': self.id,
@@ -141,5 +292,321 @@ class Appointment(db.Model):
             'doctor_id': self.doctor_id,
             'patient_id': self.patient_id,
             'status': self.status,
-            'notes': self.notes
-        }
\ No newline at end of file
+            'notes': self.notes,
+            'updated_at': self.updated_at.isoformat()
+        }
+
+
+# ------------------------------
+# ArchivedAppointment
+# ------------------------------
+"""
+ArchivedAppointment
+    old finished appointments moved out of the appointments table by
+    `flask archive-appointments` (see archive.py): the same columns, plus
+    when the row was archived. Never written by the routes.
+"""
+class ArchivedAppointment(db.Model):
+    __tablename__ = 'appointments_archive'
+    __table_args__ = (
+        Index('ix_appointments_archive_date_id', 'date', 'id'),
+        Index('ix_appointments_archive_doctor_id_date', 'doctor_id', 'date'),
+        Index('ix_appointments_archive_patient_id_date', 'patient_id', 'date'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    date = Column(DateTime, nullable=False)
+    status = Column(String, nullable=False)
+    notes = Column(String)
+    doctor_id = Column(Integer, ForeignKey('doctors.id', ondelete='CASCADE'), nullable=False)
+    patient_id = Column(Integer, ForeignKey('patients.id', ondelete='CASCADE'), nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+    archived_at = Column(DateTime, nullable=False, default=utc_now)
+
+
+APPOINTMENT_COLUMNS = [column.name for column in Appointment.__table__.columns]
+
+
+"""
+AppointmentHistory
+    read-only view of every appointment, current and archived: the UNION
+    ALL of both tables, with the columns, sort keys, expansions and
+    filters of Appointment, so the query helpers take it in its place
+    (the `?include_archived=1` reads). Postgres pushes the filters and
+    ORDER BY ... LIMIT of a page into both tables' indexes.
+"""
+class AppointmentHistory(db.Model):
+    __table__ = union_all(
+        select(*[Appointment.__table__.c[name] for name in APPOINTMENT_COLUMNS]),
+        select(*[ArchivedAppointment.__table__.c[name] for name in APPOINTMENT_COLUMNS]),
+    ).subquery('appointment_history')
+    __mapper_args__ = {'primary_key': [__table__.c.id]}
+    sort_keys = Appointment.sort_keys
+    expandable = Appointment.expandable
+
+    doctor = relationship(Doctor, viewonly=True,
+                          primaryjoin=lambda: foreign(AppointmentHistory.doctor_id) == Doctor.id)
+    patient = relationship(Patient, viewonly=True,
+                           primaryjoin=lambda: foreign(AppointmentHistory.patient_id) == Patient.id)
+
+    schedule_criteria = classmethod(Appointment.schedule_criteria.__func__)
+
+
+# ------------------------------
+# AppointmentCount
+# ------------------------------
+"""
+AppointmentCount
+    rollup of appointments per day, doctor and status, kept current by the
+    write paths (see rollups.py) and read by GET /stats/appointments, so
+    statistics never scan the appointments table
+"""
+class AppointmentCount(db.Model):
+    __tablename__ = 'appointment_counts'
+    __table_args__ = (
+        Index('ix_appointment_counts_doctor_id_day', 'doctor_id', 'day'),
+    )
+
+    day = Column(Date, primary_key=True)
+    doctor_id = Column(Integer, ForeignKey('doctors.id', ondelete='CASCADE'), primary_key=True)
+    status = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+# ------------------------------
+# IdempotencyKey
+# ------------------------------
+"""
+IdempotencyKey
+    an Idempotency-Key sent by a client (`owner`, the token subject) with
+    the fingerprint of its request and, once it succeeded, the response
+    to replay to retries until `expires_at` (see idempotency.py)
+"""
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (
+        Index('ix_idempotency_keys_expires_at', 'expires_at'),
+    )
+
+    owner = Column(String, primary_key=True)
+    key = Column(String(255), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    status_code = Column(Integer)  # NULL while the first request runs
+    body = Column(LargeBinary)
+    expires_at = Column(DateTime, nullable=False)
+
+
+# ------------------------------
+# Query helpers
+# ------------------------------
+"""
+encode_cursor(values) / decode_cursor(cursor)
+    opaque keyset cursors: the sort key values of the last row of a page
+"""
+def encode_cursor(values):
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(model, cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if len(values) != len(model.sort_keys):
+            raise ValueError('cursor does not match the sort keys')
+        return [
+            datetime.fromisoformat(value)
+            if isinstance(model.__table__.c[key].type, DateTime) else int(value)
+            for key, value in zip(model.sort_keys, values)
+        ]
+    except (TypeError, ValueError, KeyError) as ex:
+        raise ValueError(f'invalid cursor: {cursor}') from ex
+
+
+"""
+projection(model, fields)
+    resolves a `fields` list to table columns, in table order;
+    None selects every column, unknown names raise ValueError
+"""
+def projection(model, fields=None):
+    table_columns = model.__table__.columns
+    if not fields:
+        return list(table_columns)
+    unknown = [field for field in fields if field not in table_columns]
+    if unknown:
+        raise ValueError(f'unknown fields: {", ".join(unknown)}')
+    return [column for column in table_columns if column.name in fields]
+
+
+"""
+page_query(model, fields, after, limit, *criteria, extra)
+    builds a keyset-paginated SELECT over the model's table, ordered by
+    `model.sort_keys`. Only the projected columns (plus the sort keys,
+    needed for the next cursor, and the `extra` column names) are selected.
+    One extra row is fetched to tell whether another page exists.
+"""
+def page_query(model, fields=None, after=None, limit=DEFAULT_PAGE_SIZE, *criteria, extra=()):
+    columns = projection(model, fields)
+    sort_columns = [model.__table__.c[key] for key in model.sort_keys]
+    extra_columns = [model.__table__.c[name] for name in extra]
+    selected = columns + [c for c in sort_columns + extra_columns if c not in columns]
+
+    query = select(*selected).where(*criteria).order_by(*sort_columns)
+    if after is not None:
+        values = decode_cursor(model, after)
+        if len(sort_columns) == 1:
+            query = query.where(sort_columns[0] > values[0])
+        else:
+            query = query.where(tuple_(*sort_columns) > tuple_(*values))
+    return query.limit(limit + 1), [c.name for c in columns]
+
+
+"""
+serialize_rows(rows, names)
+    converts result rows to dicts keyed by `names`, the leading columns of
+    each row. Values are kept as fetched (no ORM object, no isoformat per
+    row); json_provider encodes dates and times as `format()` does.
+    Subquery column names (AppointmentHistory) are str subclasses, which
+    orjson refuses as keys, so the names are made plain str first.
+"""
+def serialize_rows(rows, names):
+    names = [str(name) for name in names]
+    return [dict(zip(names, row)) for row in rows]
+
+
+"""
+expand_keys(model, expand)
+    validates `expand` against `model.expandable` and returns the
+    foreign key column names the expansion reads
+"""
+def expand_keys(model, expand):
+    if not expand:
+        return []
+    unknown = [name for name in expand if name not in getattr(model, 'expandable', ())]
+    if unknown:
+        raise ValueError(f'cannot expand: {", ".join(unknown)}')
+    relationships = inspect(model).relationships
+    return [next(iter(relationships[name].local_columns)).name for name in expand]
+
+
+"""
+expand_targets(model, expand)
+    the model classes embedded by `expand`
+"""
+def expand_targets(model, expand):
+    relationships = inspect(model).relationships
+    return [relationships[name].mapper.class_ for name in expand]
+
+
+"""
+expand_rows(model, rows, raw_rows, expand)
+    embeds the summary (`summary_fields`) of each related row named in
+    `expand` into the serialized rows. Each relationship is loaded with one
+    IN query for the whole batch, the way selectinload does, so the number
+    of queries does not depend on the number of rows.
+"""
+def expand_rows(model, rows, raw_rows, expand):
+    relationships = inspect(model).relationships
+    for name in expand:
+        relationship = relationships[name]
+        key = next(iter(relationship.local_columns)).name
+        target = relationship.mapper.class_
+        columns = [target.__table__.c[field] for field in target.summary_fields]
+
+        related = {}
+        ids = list({raw._mapping[key] for raw in raw_rows if raw._mapping[key] is not None})
+        for chunk in chunked(ids):
+            results = db.session.execute(select(*columns).where(target.id.in_(chunk))).all()
+            for result, summary in zip(results, serialize_rows(results, target.summary_fields)):
+                related[result.id] = summary
+        for row, raw in zip(rows, raw_rows):
+            row[name] = related.get(raw._mapping[key])
+    return rows
+
+
+"""
+page_result(model, raw_rows, names, limit)
+    turns the rows of a page_query into (rows as dicts, next cursor or None)
+"""
+def page_result(model, raw_rows, names, limit):
+    next_cursor = None
+    if len(raw_rows) > limit:
+        raw_rows = raw_rows[:limit]
+        last = raw_rows[-1]._mapping
+        next_cursor = encode_cursor([last[key] for key in model.sort_keys])
+    return serialize_rows(raw_rows, names), next_cursor
+
+
+"""
+version_queries(model, expand, *criteria)
+    (row count, latest updated_at) of the rows matching `criteria`, plus
+    the same pair for the whole table of each expanded relation.
+    Inserts and updates move the latest updated_at, deletes change the
+    count, so the pairs change whenever the listed data can have changed.
+"""
+def version_queries(model, expand=(), *criteria):
+    targets = expand_targets(model, expand)
+    return [
+        select(func.count(), func.max(target.updated_at)).select_from(target).where(*where)
+        for target, where in [(model, criteria)] + [(target, ()) for target in targets]
+    ]
+
+
+"""
+fetch_page(model, fields, after, limit, *criteria, expand)
+    runs page_query and returns (rows as dicts, next cursor or None)
+"""
+def fetch_page(model, fields=None, after=None, limit=DEFAULT_PAGE_SIZE, *criteria, expand=()):
+    query, names = page_query(model, fields, after, limit, *criteria,
+                              extra=expand_keys(model, expand))
+    raw_rows = db.session.execute(query).all()
+    rows, next_cursor = page_result(model, raw_rows, names, limit)
+    if expand:
+        expand_rows(model, rows, raw_rows[:limit], expand)
+    return rows, next_cursor
+
+
+"""
+stream_rows(model, fields, *criteria, expand)
+    yields every matching row as a dict, in sort key order, reading through
+    a server-side cursor `batch_size` rows at a time so memory stays flat;
+    expansions are loaded once per batch
+"""
+def stream_rows(model, fields=None, *criteria, expand=(), batch_size=STREAM_BATCH_SIZE):
+    columns = projection(model, fields)
+    names = [c.name for c in columns]
+    extra = [model.__table__.c[name] for name in expand_keys(model, expand)]
+    sort_columns = [model.__table__.c[key] for key in model.sort_keys]
+    query = (
+        select(*columns, *[c for c in extra if c not in columns])
+        .where(*criteria)
+        .order_by(*sort_columns)
+        .execution_options(stream_results=True, yield_per=batch_size)
+    )
+    result = db.session.execute(query)
+    try:
+        for batch in result.partitions():
+            rows = serialize_rows(batch, names)
+            if expand:
+                expand_rows(model, rows, batch, expand)
+            yield from rows
+    finally:
+        result.close()
+
+
+def chunked(values, size=900):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+"""
+existing_ids(model, ids)
+    returns the subset of `ids` that exist in the model's table,
+    querying in chunks to stay under driver parameter limits
+"""
+def existing_ids(model, ids):
+    found = set()
+    for chunk in chunked(list(set(ids))):
+        found.update(db.session.execute(select(model.id).where(model.id.in_(chunk))).scalars())
+    return found
@@ -0,0 +1,149 @@
+import logging
+import os
+import threading
+import time
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+'''
+Connection pool settings, read from the environment by setup_db:
+
+    DB_POOL_SIZE              persistent connections per worker (5)
+    DB_MAX_OVERFLOW           extra connections opened under load (10)
+    DB_POOL_TIMEOUT           seconds to wait for a free connection (30)
+    DB_POOL_RECYCLE           seconds before a connection is replaced (1800)
+    DB_POOL_PRE_PING          test connections on checkout (true)
+    DB_STATEMENT_TIMEOUT_MS   server-side statement timeout, 0 = none (0)
+    DB_PGBOUNCER              running behind PgBouncer in transaction
+                              pooling mode: keep no server-side session
+                              state (false)
+
+Size the pool so that gunicorn workers x (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+stays below the server's max_connections.
+'''
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+FALSE_VALUES = ('0', 'false', 'no', 'off', '')
+
+
+def _int_setting(environ, name, default, minimum):
+    raw = environ.get(name, None)
+    if raw is None:
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        raise ValueError(f'{name} must be an integer, got {raw!r}')
+    if value < minimum:
+        raise ValueError(f'{name} must be >= {minimum}, got {value}')
+    return value
+
+
+def _bool_setting(environ, name, default):
+    raw = environ.get(name, None)
+    if raw is None:
+        return default
+    if raw.lower() in TRUE_VALUES:
+        return True
+    if raw.lower() in FALSE_VALUES:
+        return False
+    raise ValueError(f'{name} must be a boolean, got {raw!r}')
+
+
+'''
+    Reads and validates the pool settings; raises ValueError on bad values
+    so a misconfigured worker fails at boot rather than under load.
+'''
+def pool_settings(environ=os.environ):
+    return {
+        'pool_size': _int_setting(environ, 'DB_POOL_SIZE', 5, 1),
+        'max_overflow': _int_setting(environ, 'DB_MAX_OVERFLOW', 10, 0),
+        'pool_timeout': _int_setting(environ, 'DB_POOL_TIMEOUT', 30, 1),
+        'pool_recycle': _int_setting(environ, 'DB_POOL_RECYCLE', 1800, -1),
+        'pool_pre_ping': _bool_setting(environ, 'DB_POOL_PRE_PING', True),
+        'statement_timeout_ms': _int_setting(environ, 'DB_STATEMENT_TIMEOUT_MS', 0, 0),
+        'pgbouncer': _bool_setting(environ, 'DB_PGBOUNCER', False),
+    }
+
+
+'''
+    SQLAlchemy engine options for `database_path`. Only Postgres gets a tuned
+    QueuePool; other databases (SQLite in tests) keep their defaults.
+'''
+def engine_options(database_path, environ=os.environ):
+    if not database_path.startswith('postgresql'):
+        return {}
+
+    settings = pool_settings(environ)
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': settings['pool_size'],
+        'max_overflow': settings['max_overflow'],
+        'pool_timeout': settings['pool_timeout'],
+        'pool_recycle': settings['pool_recycle'],
+        'pool_pre_ping': settings['pool_pre_ping'],
+        # batch executemany() INSERTs and UPDATEs (bulk endpoints) with psycopg2 fast paths
+        'executemany_mode': 'values_plus_batch',
+    }
+
+    if settings['statement_timeout_ms']:
+        if settings['pgbouncer']:
+            # PgBouncer rejects startup parameters and a session-level SET
+            # would leak to other clients of the server connection.
+            logger.warning('DB_STATEMENT_TIMEOUT_MS is ignored with DB_PGBOUNCER; '
+                           'set statement_timeout on the database role instead')
+        else:
+            options['connect_args'] = {
+                'options': f"-c statement_timeout={settings['statement_timeout_ms']}"
+            }
+    return options
+
+
+'''
+TimedQueuePool
+    QueuePool that records how long callers wait to check out a connection.
+'''
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wait_lock = threading.Lock()
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with self._wait_lock:
+                self.wait_count += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+
+'''
+    Snapshot of an engine's pool: checked-out, idle and overflow connections,
+    plus checkout wait times when the pool records them.
+'''
+def pool_status(engine):
+    pool = engine.pool
+    status = {'class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'idle': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+            'max_overflow': pool._max_overflow,
+        })
+    if isinstance(pool, TimedQueuePool):
+        with pool._wait_lock:
+            status['wait'] = {
+                'count': pool.wait_count,
+                'total_seconds': round(pool.wait_total, 6),
+                'max_seconds': round(pool.wait_max, 6),
+            }
+    return status
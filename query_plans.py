@@ -0,0 +1,187 @@
+import click
+import json
+from datetime import datetime, timedelta
+from flask.cli import with_appcontext
+from sqlalchemy import select
+from models import db, Doctor, Patient, Appointment, AppointmentHistory, page_query, encode_cursor, version_queries
+from search import search_query
+from rollups import stats_query
+from exports import export_criteria, export_query
+from archive import archive_criteria
+
+SAMPLE_DATE = datetime(2025, 1, 1, 9, 0)
+
+"""
+QUERY_PATTERNS
+    every query shape the routes issue, as (name, builder, bounded) tuples.
+    `bounded` marks top-N reads (ORDER BY ... LIMIT) that may walk an index
+    in order without a search condition, and the whole-collection versions,
+    counted from the narrow updated_at index instead of the table.
+    Keep this list in sync with app.py: a new filter or ordering on a
+    route needs a pattern here so `check_query_plans` covers it.
+    A builder returns None for a shape that only exists on Postgres
+    (the search indexes); it is skipped on other databases.
+"""
+QUERY_PATTERNS = [
+    ('doctors page',
+     lambda: page_query(Doctor, after=encode_cursor([1]))[0], False),
+    ('patients page',
+     lambda: page_query(Patient, after=encode_cursor([1]))[0], False),
+    ('appointments first page',
+     lambda: page_query(Appointment)[0], True),
+    ('appointments page',
+     lambda: page_query(Appointment, after=encode_cursor([SAMPLE_DATE, 1]))[0], False),
+    ('appointment by id',
+     lambda: select(Appointment).where(Appointment.id == 1), False),
+    ('doctor schedule',
+     lambda: page_query(Appointment, None, None, 100,
+                        Appointment.doctor_id == 1,
+                        Appointment.date >= SAMPLE_DATE,
+                        Appointment.date < SAMPLE_DATE + timedelta(days=7),
+                        Appointment.status == 'Scheduled')[0], False),
+    ('doctor schedule page',
+     lambda: page_query(Appointment, None, encode_cursor([SAMPLE_DATE, 1]), 100,
+                        Appointment.doctor_id == 1)[0], False),
+    ('double booking check',
+     lambda: select(Appointment.id).where(
+         Appointment.doctor_id == 1,
+         Appointment.date > SAMPLE_DATE - timedelta(minutes=30),
+         Appointment.date < SAMPLE_DATE + timedelta(minutes=30),
+         Appointment.status != 'Canceled').limit(1), False),
+    ('doctors by speciality',
+     lambda: select(Doctor.id).where(Doctor.speciality == 'Cardiology'), False),
+    ('availability busy slots',
+     lambda: select(Appointment.doctor_id, Appointment.date)
+             .join(Doctor, Doctor.id == Appointment.doctor_id)
+             .where(Doctor.speciality == 'Cardiology',
+                    Appointment.date > SAMPLE_DATE,
+                    Appointment.date < SAMPLE_DATE + timedelta(days=14),
+                    Appointment.status != 'Canceled')
+             .order_by(Appointment.doctor_id, Appointment.date), False),
+    ('expand doctors',
+     lambda: select(Doctor.id, Doctor.name).where(Doctor.id.in_([1, 2, 3])), False),
+    ('expand patients',
+     lambda: select(Patient.id, Patient.name).where(Patient.id.in_([1, 2, 3])), False),
+    ('doctors version',
+     lambda: version_queries(Doctor)[0], True),
+    ('appointments version',
+     lambda: version_queries(Appointment)[0], True),
+    ('doctor schedule version',
+     lambda: version_queries(Appointment, (),
+                             Appointment.doctor_id == 1,
+                             Appointment.date >= SAMPLE_DATE,
+                             Appointment.status == 'Scheduled')[0], False),
+    ('patient search',
+     lambda: _postgres_only(lambda: search_query(Patient, 'smith 555')), False),
+    ('doctor search',
+     lambda: _postgres_only(lambda: search_query(Doctor, 'cardio')), False),
+    ('appointments by patient',
+     lambda: select(Appointment).where(Appointment.patient_id == 1), False),
+    ('appointment stats by week',
+     lambda: stats_query(['status'], 'week', SAMPLE_DATE.date(),
+                         SAMPLE_DATE.date() + timedelta(days=90)), False),
+    ('appointment stats of a doctor',
+     lambda: stats_query(['speciality'], 'day', doctor_id=1), False),
+    ('appointments export by date',
+     lambda: export_query(*export_criteria(SAMPLE_DATE, SAMPLE_DATE + timedelta(days=30))), False),
+    ('appointments export of a doctor',
+     lambda: export_query(*export_criteria(SAMPLE_DATE, None, 1)), False),
+    ('archive batch',
+     lambda: select(Appointment.id).where(*archive_criteria(SAMPLE_DATE)).limit(1000), False),
+    ('archived appointments page',
+     lambda: page_query(AppointmentHistory, after=encode_cursor([SAMPLE_DATE, 1]))[0], False),
+    ('archived doctor schedule',
+     lambda: page_query(AppointmentHistory, None, None, 100,
+                        *AppointmentHistory.schedule_criteria(1, SAMPLE_DATE, None, None))[0], False),
+]
+
+def _postgres_only(build):
+    return build() if db.engine.dialect.name == 'postgresql' else None
+
+
+SEQ_SCAN = 'sequential scan'
+INDEX_WALK = 'full index walk'
+INDEX_SEARCH = 'index search'
+
+
+def _postgres_scans(node):
+    node_type = node['Node Type']
+    if node_type == 'Seq Scan':
+        yield SEQ_SCAN, f"Seq Scan on {node['Relation Name']}"
+    elif node_type in ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan'):
+        kind = INDEX_SEARCH if 'Index Cond' in node else INDEX_WALK
+        yield kind, f"{node_type} using {node['Index Name']}"
+    for child in node.get('Plans', []):
+        yield from _postgres_scans(child)
+
+
+def _sqlite_scan(detail):
+    if detail.startswith('SEARCH '):
+        return INDEX_SEARCH, detail
+    if detail.startswith('SCAN ') and ' USING ' in detail:
+        return INDEX_WALK, detail
+    if detail.startswith('SCAN '):
+        return SEQ_SCAN, detail
+    return None
+
+
+"""
+explain(query)
+    returns the table accesses in the plan of `query` as (kind, detail)
+    pairs, kind being SEQ_SCAN, INDEX_WALK or INDEX_SEARCH.
+    On Postgres sequential scans are disabled for the transaction so the
+    plan shows whether an index *can* serve the query, whatever the table size.
+"""
+def explain(query):
+    connection = db.session.connection()
+    dialect = connection.dialect
+    compiled = query.compile(dialect=dialect, compile_kwargs={'render_postcompile': True})
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+
+    if dialect.name == 'postgresql':
+        connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        plan = connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}', params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return list(_postgres_scans(plan[0]['Plan']))
+    if dialect.name == 'sqlite':
+        rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params)
+        return [scan for scan in (_sqlite_scan(row[-1]) for row in rows) if scan]
+    raise NotImplementedError(f'EXPLAIN is not supported for {dialect.name}')
+
+
+"""
+check_query_plans()
+    runs EXPLAIN for every QUERY_PATTERNS entry and returns the
+    (name, scans) pairs that read a whole table or a whole index
+"""
+def check_query_plans():
+    offenders = []
+    try:
+        for name, build, bounded in QUERY_PATTERNS:
+            allowed = (INDEX_SEARCH, INDEX_WALK) if bounded else (INDEX_SEARCH,)
+            query = build()
+            if query is None:
+                continue
+            scans = explain(query)
+            if any(kind not in allowed for kind, _ in scans):
+                offenders.append((name, scans))
+    finally:
+        db.session.rollback()
+    return offenders
+
+
+@click.command('check-query-plans')
+@with_appcontext
+def check_query_plans_command():
+    """Fail if any query the API issues would scan a whole table."""
+    offenders = check_query_plans()
+    for name, scans in offenders:
+        click.echo(f'{name}:', err=True)
+        for kind, detail in scans:
+            click.echo(f'    {kind}: {detail}', err=True)
+    if offenders:
+        raise SystemExit(1)
+    click.echo(f'{len(QUERY_PATTERNS)} query patterns use indexes')
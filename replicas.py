@@ -0,0 +1,262 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, g, request
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import InterfaceError, OperationalError
+from auth import AuthError, get_token_auth_header
+from models import db, normalize_database_url
+from pool import engine_options, pool_status
+
+logger = logging.getLogger(__name__)
+
+'''
+Read replica routing for the collection GETs.
+
+    DATABASE_REPLICA_URLS               comma separated replica URLs; none
+                                        means every query uses DATABASE_URL
+    REPLICA_CHECK_INTERVAL              seconds between health checks of a
+                                        replica, and before a failed one is
+                                        tried again (10)
+    REPLICA_MAX_LAG_SECONDS             Postgres replicas further behind
+                                        are skipped, 0 = no limit (30)
+    REPLICA_READ_YOUR_WRITES_SECONDS    after a successful write, the same
+                                        client reads from the primary for
+                                        this long (5)
+
+Handlers decorated with `replica_reads` run their queries on the next
+healthy replica in round-robin order; RoutingSession (models.py) sends
+everything else, and any write, to the primary. A replica that fails a
+health check or a query is skipped until REPLICA_CHECK_INTERVAL passes,
+and a read that failed on it is retried on the primary. With no healthy
+replica, reads use the primary.
+
+Clients are told apart by the `sub` of their bearer token (read without
+verification: it only picks a database, never grants access), or by
+address when they send none. Recent writers are remembered per worker,
+so behind several workers read-your-writes holds for the worker that took
+the write; keep the window longer than the replication lag.
+
+The native read path of asgi.py still reads from the primary.
+'''
+
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 10))
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 30))
+REPLICA_READ_YOUR_WRITES_SECONDS = float(os.environ.get('REPLICA_READ_YOUR_WRITES_SECONDS', 5))
+RECENT_WRITERS_SIZE = 10000
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Seconds a Postgres replica is behind (0 when caught up, or not a replica)
+LAG_QUERY = text(
+    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END'
+)
+
+
+'''
+ReplicaSet
+    The replica engines of an app by name (replica_0, replica_1, ...),
+    handed out round-robin, with the health of each one.
+'''
+class ReplicaSet:
+    def __init__(self, engines, check_interval=REPLICA_CHECK_INTERVAL, max_lag=REPLICA_MAX_LAG_SECONDS):
+        self.engines = engines
+        self.keys = list(engines)
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self._next = 0
+        self._checked_at = {key: None for key in self.keys}
+        self._healthy = {key: True for key in self.keys}
+        self._errors = {key: None for key in self.keys}
+        self._lag = {key: None for key in self.keys}
+        self._lock = threading.Lock()
+
+    '''
+        The engine of the next healthy replica, or None to use the primary.
+        Replicas due for a health check are checked first.
+    '''
+    def pick(self):
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.keys)
+        for offset in range(len(self.keys)):
+            key = self.keys[(start + offset) % len(self.keys)]
+            if self._due(key):
+                self.check(key)
+            if self._healthy[key]:
+                return self.engines[key]
+        return None
+
+    def _due(self, key):
+        checked_at = self._checked_at[key]
+        return checked_at is None or time.monotonic() - checked_at >= self.check_interval
+
+    def check(self, key):
+        engine = self.engines[key]
+        try:
+            with engine.connect() as connection:
+                if engine.dialect.name == 'postgresql':
+                    lag = float(connection.execute(LAG_QUERY).scalar())
+                else:
+                    connection.execute(text('SELECT 1'))
+                    lag = 0.0
+        except (OperationalError, InterfaceError) as ex:
+            self.mark_down(key, ex)
+            return False
+
+        if self.max_lag and lag > self.max_lag:
+            self.mark_down(key, f'{lag:.1f}s behind the primary')
+            return False
+        with self._lock:
+            if not self._healthy[key]:
+                logger.info('replica %s is back', key)
+            self._checked_at[key] = time.monotonic()
+            self._healthy[key] = True
+            self._errors[key] = None
+            self._lag[key] = lag
+        return True
+
+    def mark_down(self, key, error):
+        with self._lock:
+            if self._healthy[key]:
+                logger.warning('replica %s skipped for %ss: %s', key, self.check_interval, error)
+            self._checked_at[key] = time.monotonic()
+            self._healthy[key] = False
+            self._errors[key] = str(error)
+
+    def key_of(self, engine):
+        return next((key for key, candidate in self.engines.items() if candidate is engine), None)
+
+    def status(self):
+        with self._lock:
+            return [{
+                'name': key,
+                'healthy': self._healthy[key],
+                'lag_seconds': self._lag[key],
+                'error': self._errors[key],
+                'pool': pool_status(self.engines[key]),
+            } for key in self.keys]
+
+
+'''
+RecentWriters
+    Clients that wrote in the last `window` seconds, oldest first.
+'''
+class RecentWriters:
+    def __init__(self, window=REPLICA_READ_YOUR_WRITES_SECONDS, maxsize=RECENT_WRITERS_SIZE):
+        self.window = window
+        self.maxsize = maxsize
+        self._deadlines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, client):
+        if self.window <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._deadlines[client] = now + self.window
+            self._deadlines.move_to_end(client)
+            while self._deadlines:
+                oldest, deadline = next(iter(self._deadlines.items()))
+                if deadline > now and len(self._deadlines) <= self.maxsize:
+                    break
+                del self._deadlines[oldest]
+
+    def recent(self, client):
+        with self._lock:
+            deadline = self._deadlines.get(client)
+        return deadline is not None and deadline > time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._deadlines.clear()
+
+
+recent_writers = RecentWriters()
+
+
+'''
+    Who is asking: the `sub` of the bearer token, else the client address.
+'''
+def client_key():
+    from jose import jwt
+    from jose.exceptions import JWTError
+    try:
+        sub = jwt.get_unverified_claims(get_token_auth_header()).get('sub')
+    except (AuthError, JWTError):
+        sub = None
+    return f'sub:{sub}' if sub else f'addr:{request.remote_addr}'
+
+
+'''
+    True while the current request reads from the primary because its
+    client wrote recently; such reads skip cached responses, which may
+    come from a lagging replica.
+'''
+def reading_own_writes():
+    return g.get('own_writes', False)
+
+
+'''
+@replica_reads decorator method
+    Runs a read-only handler on a replica when the app has any, unless
+    the client is inside its read-your-writes window. Goes under
+    `requires_auth`, so rejected requests never reach a database.
+'''
+def replica_reads(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        replicas = current_app.extensions.get('replicas')
+        if replicas is None:
+            return f(*args, **kwargs)
+        if recent_writers.recent(client_key()):
+            g.own_writes = True
+            return f(*args, **kwargs)
+
+        engine = replicas.pick()
+        if engine is None:
+            return f(*args, **kwargs)
+        g.read_engine = engine
+        try:
+            return f(*args, **kwargs)
+        except (OperationalError, InterfaceError) as ex:
+            replicas.mark_down(replicas.key_of(engine), ex)
+            db.session.rollback()
+            g.pop('read_engine', None)
+            return f(*args, **kwargs)
+    return wrapper
+
+
+'''
+    Replica URLs from the DATABASE_REPLICA_URLS config value (a list) or
+    environment variable (comma separated); empty without replicas.
+'''
+def replica_urls(app):
+    urls = app.config.get('DATABASE_REPLICA_URLS', os.environ.get('DATABASE_REPLICA_URLS', ''))
+    if isinstance(urls, str):
+        urls = urls.split(',')
+    return [normalize_database_url(url.strip()) for url in urls if url.strip()]
+
+
+'''
+    Sets up replica routing on `app` when it has replicas: one engine per
+    replica, pooled like the primary (see pool.py), and remembers the
+    clients of successful writes.
+'''
+def init_replicas(app):
+    urls = replica_urls(app)
+    if not urls:
+        return
+    app.extensions['replicas'] = ReplicaSet({
+        f'replica_{index}': create_engine(url, **engine_options(url))
+        for index, url in enumerate(urls)
+    })
+
+    @app.after_request
+    def remember_writers(response):
+        if request.method not in READ_METHODS and response.status_code < 400:
+            recent_writers.record(client_key())
+        return response
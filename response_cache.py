@@ -0,0 +1,278 @@
+import fnmatch
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+try:
+    import redis
+except ImportError:  # optional: only needed for a redis:// shared backend
+    redis = None
+
+'''
+Response cache for the collection GETs.
+
+Entries are keyed by route, query parameters and the permission the route
+requires, and tagged with what they read ('doctors', 'appointments',
+'appointments:doctor:<id>', ...). Every tag has a generation counter that
+is part of the entry key: a write bumps the generations of the tags it
+touches, which makes exactly the entries depending on them unreachable.
+Stale entries are never served; they age out of the backend.
+
+    RESPONSE_CACHE          memory: in-process LRU, per worker (default)
+                            shared: one cache for every worker, at
+                                    RESPONSE_CACHE_URL (redis://... or
+                                    local:// for the in-process stand-in)
+                            off:    no caching
+    RESPONSE_CACHE_URL      shared backend location (local://)
+    RESPONSE_CACHE_TTL      seconds an entry lives (10)
+    RESPONSE_CACHE_SIZE     entries per worker for the memory backend (1024)
+
+With the memory backend a write only invalidates the worker that served
+it; other workers serve their entries until RESPONSE_CACHE_TTL. Use the
+shared backend when more than one worker takes writes.
+'''
+
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'memory')
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL', 'local://')
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 10))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+
+
+'''
+MemoryBackend
+    Bounded LRU of entries with a TTL, private to the process.
+'''
+class MemoryBackend:
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generations(self, tags):
+        with self._lock:
+            return [self._generations.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize, 'evictions': self.evictions}
+
+
+'''
+LocalSharedClient
+    In-process stand-in for the subset of the Redis client the shared
+    backend uses (get, set with expiry, mget, incr, info), for tests and
+    single-process development.
+'''
+class LocalSharedClient:
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        entry = self._values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self._values[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key)
+            return entry[0] if entry else None
+
+    def mget(self, keys):
+        with self._lock:
+            return [entry[0] if entry else None for entry in map(self._live, keys)]
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._values[key] = (value, time.monotonic() + ex if ex else None)
+
+    def incr(self, key):
+        with self._lock:
+            entry = self._live(key)
+            value = int(entry[0]) + 1 if entry else 1
+            self._values[key] = (str(value).encode(), None)
+            return value
+
+    def scan_iter(self, match='*'):
+        with self._lock:
+            return [key for key in self._values if fnmatch.fnmatchcase(key, match)]
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+
+    def info(self, section=None):
+        with self._lock:
+            return {'evicted_keys': 0, 'db_keys': len(self._values)}
+
+
+'''
+SharedBackend
+    Cache shared by every worker, on a Redis client (or LocalSharedClient).
+    Tag generations live next to the entries, so a write in one worker
+    invalidates the entries of all of them.
+'''
+class SharedBackend:
+    def __init__(self, client, prefix='crm:response:'):
+        self.client = client
+        self.prefix = prefix
+
+    def generations(self, tags):
+        values = self.client.mget([f'{self.prefix}tag:{tag}' for tag in tags])
+        return [int(value) if value else 0 for value in values]
+
+    def bump(self, tags):
+        for tag in tags:
+            self.client.incr(f'{self.prefix}tag:{tag}')
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*'):
+            self.client.delete(key)
+
+    def stats(self):
+        return {'evictions': self.client.info('stats').get('evicted_keys', 0)}
+
+
+def shared_client(url):
+    if url.startswith('local://'):
+        return LocalSharedClient()
+    if redis is None:
+        raise RuntimeError('RESPONSE_CACHE_URL needs the redis package: pip install redis')
+    return redis.Redis.from_url(url)
+
+
+'''
+    The backend selected by RESPONSE_CACHE (None when caching is off).
+'''
+def backend_from_env(kind=RESPONSE_CACHE, url=RESPONSE_CACHE_URL):
+    if kind == 'off':
+        return None
+    if kind == 'memory':
+        return MemoryBackend()
+    if kind == 'shared':
+        return SharedBackend(shared_client(url))
+    raise ValueError(f'RESPONSE_CACHE must be memory, shared or off, got {kind!r}')
+
+
+'''
+    Cached responses are stored as bytes: the ETag and Last-Modified
+    header values on the first two lines, then the body.
+'''
+def pack_entry(etag, last_modified, body):
+    return b'\n'.join([etag.encode(), (last_modified or '').encode(), body])
+
+
+def unpack_entry(value):
+    etag, last_modified, body = value.split(b'\n', 2)
+    return etag.decode(), last_modified.decode() or None, body
+
+
+'''
+ResponseCache
+    Front of the backend: builds entry keys from the route, the query
+    parameters, the permission scope and the tag generations, and counts
+    hits and misses of this worker.
+'''
+class ResponseCache:
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.backend is not None and self.ttl > 0
+
+    def key(self, route, args, scope, tags):
+        generations = self.backend.generations(tags)
+        items = args.items(multi=True) if hasattr(args, 'getlist') else args.items()
+        query = urlencode(sorted(items))
+        versions = ','.join(f'{tag}={generation}' for tag, generation in zip(tags, generations))
+        return f'{route}?{query}|{scope or "public"}|{versions}'
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value, self.ttl)
+
+    '''
+        Called by the write routes once their transaction is committed.
+    '''
+    def invalidate(self, *tags):
+        if self.backend is not None:
+            self.backend.bump(tags)
+
+    def clear(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                'backend': type(self.backend).__name__ if self.backend else None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+            }
+        if self.backend is not None:
+            stats.update(self.backend.stats())
+        return stats
+
+
+response_cache = ResponseCache(backend_from_env())
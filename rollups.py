@@ -0,0 +1,248 @@
+import click
+from collections import Counter
+from flask.cli import with_appcontext
+from sqlalchemy import Date, cast, event, func, inspect, select, text, type_coerce
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, RoutingSession, Doctor, Patient, Appointment, AppointmentHistory, AppointmentCount, chunked
+
+'''
+Appointment statistics from the appointment_counts rollup (one row per
+day, doctor and status with the number of appointments).
+
+The rollup is kept current in the transaction of every write:
+
+    - ORM writes (the single-row routes) through the before_flush
+      listener below, from the appointments being inserted, deleted or
+      moved to another day or status
+    - bulk writes (bulk_insert_mappings / bulk_update_mappings, which
+      skip flush events) through `record_bulk_write`
+    - patient deletes, whose appointments the database deletes (ON DELETE
+      CASCADE), through the before_flush listener below, from one
+      grouped count of those appointments
+
+Each write adds its +1 / -1 deltas with an upsert, so concurrent writes
+never lose counts. Doctor deletes need nothing: their rollup rows go
+with them (ON DELETE CASCADE). Rows whose count drops to 0 stay until the next
+rebuild and are left out of the results.
+
+    flask rebuild-stats     recomputes the rollup from the appointments,
+                            archived ones included, after writes that
+                            bypass both paths (manual SQL,
+                            benchmarks.datasets)
+'''
+
+ROLLUP_FIELDS = ('date', 'doctor_id', 'status')
+
+# group_by name -> (result key, column)
+GROUPS = {
+    'doctor': ('doctor_id', AppointmentCount.doctor_id),
+    'speciality': ('speciality', Doctor.speciality),
+    'status': ('status', AppointmentCount.status),
+}
+BUCKETS = ('day', 'week', 'month')
+
+
+def rollup_key(date, doctor_id, status):
+    return (date.date(), doctor_id, status)
+
+
+'''
+    (date, doctor_id, status) of the stored appointments `ids`, by id,
+    as the database has them before the current write. On Postgres the
+    rows are locked (in id order) as they are read, so two writes of one
+    appointment take turns and the second sees the first one's values;
+    a row deleted meanwhile is missing from the result.
+'''
+def committed_values(session, ids):
+    values = {}
+    table = Appointment.__table__
+    for chunk in chunked(sorted(ids)):
+        query = (select(table.c.id, table.c.date, table.c.doctor_id, table.c.status)
+                 .where(table.c.id.in_(chunk)).order_by(table.c.id))
+        if db.engine.dialect.name == 'postgresql':
+            query = query.with_for_update()
+        values.update((row[0], tuple(row[1:])) for row in session.execute(query))
+    return values
+
+
+'''
+    Adds `deltas` ({(day, doctor_id, status): change}) to the rollup with
+    one upsert, in key order so concurrent writers lock rows alike.
+'''
+def apply_deltas(session, deltas):
+    rows = [
+        {'day': day, 'doctor_id': doctor_id, 'status': status, 'count': change}
+        for (day, doctor_id, status), change in sorted(deltas.items()) if change
+    ]
+    if not rows:
+        return
+    insert = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+    statement = insert(AppointmentCount.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=['day', 'doctor_id', 'status'],
+        set_={'count': AppointmentCount.__table__.c['count'] + statement.excluded['count']}
+    )
+    session.execute(statement, rows)
+
+
+def _changes_rollup(obj):
+    state = inspect(obj)
+    return any(state.attrs[name].history.has_changes() for name in ROLLUP_FIELDS)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def track_appointment_counts(session, flush_context, instances):
+    created = [obj for obj in session.new if isinstance(obj, Appointment)]
+    changed = [obj for obj in session.dirty if isinstance(obj, Appointment) and _changes_rollup(obj)]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Appointment)]
+    if not (created or changed or deleted):
+        return
+
+    deltas = Counter()
+    old = committed_values(session, [obj.id for obj in changed + deleted])
+    for obj in created + changed:
+        deltas[rollup_key(obj.date, obj.doctor_id, obj.status)] += 1
+    for obj in changed + deleted:
+        # Missing when a concurrent delete removed it (and counted it) first
+        if obj.id in old:
+            deltas[rollup_key(*old[obj.id])] -= 1
+    apply_deltas(session, deltas)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def forget_deleted_patients(session, flush_context, instances):
+    ids = [obj.id for obj in session.deleted if isinstance(obj, Patient)]
+    if not ids:
+        return
+    dialect = db.engine.dialect.name
+    # Lock the patients first: appointments added for them meanwhile
+    # would be deleted by the cascade without being counted here
+    session.execute(select(Patient.id).where(Patient.id.in_(ids)).with_for_update())
+    # Archived appointments count too, and go with the patient as well
+    appointments = AppointmentHistory
+    day = type_coerce(day_of(appointments.date, dialect), Date)
+    rows = session.execute(
+        select(day, appointments.doctor_id, appointments.status, func.count())
+        .where(appointments.patient_id.in_(ids))
+        .group_by(day, appointments.doctor_id, appointments.status)
+    )
+    apply_deltas(session, {(row[0], row[1], row[2]): -row[3] for row in rows})
+
+
+'''
+    Rollup deltas of a bulk write of appointments: `creates` and
+    `updates` as bulk_write validated them ((index, values) pairs),
+    applied before the rows are written.
+'''
+def record_bulk_write(creates, updates):
+    deltas = Counter(
+        rollup_key(values['date'], values['doctor_id'], values['status']) for _, values in creates
+    )
+    changed = [values for _, values in updates if 'date' in values or 'status' in values]
+    current = committed_values(db.session, [values['id'] for values in changed])
+    for values in changed:
+        date, doctor_id, status = current[values['id']]
+        deltas[rollup_key(date, doctor_id, status)] -= 1
+        current[values['id']] = (values.get('date', date), doctor_id, values.get('status', status))
+        deltas[rollup_key(*current[values['id']])] += 1
+    apply_deltas(db.session, deltas)
+
+
+# ------------------------------
+# Queries
+# ------------------------------
+def day_of(column, dialect):
+    return cast(column, Date) if dialect == 'postgresql' else func.date(column)
+
+
+'''
+    The first day of the `bucket` (day, week starting on Monday, month)
+    holding `day`.
+'''
+def bucket_of(day, bucket, dialect):
+    if bucket == 'day':
+        return day
+    if dialect == 'postgresql':
+        return cast(func.date_trunc(bucket, day), Date)
+    if bucket == 'week':
+        weekday = (func.strftime('%w', day) + 6) % 7
+        return type_coerce(func.date(day, func.printf('-%d days', weekday)), Date)
+    return type_coerce(func.date(day, 'start of month'), Date)
+
+
+'''
+    SELECT of appointment counts from the rollup, grouped by the
+    `group_by` names (GROUPS) and by `bucket` period when given, with
+    optional filters; days from inclusive, to exclusive.
+    Raises ValueError on an unknown group or bucket.
+'''
+def stats_query(group_by=(), bucket=None, date_from=None, date_to=None,
+                doctor_id=None, status=None, speciality=None, dialect=None):
+    unknown = [name for name in group_by if name not in GROUPS]
+    if unknown:
+        raise ValueError(f'cannot group by {", ".join(unknown)}')
+    if bucket is not None and bucket not in BUCKETS:
+        raise ValueError(f'bucket must be one of {", ".join(BUCKETS)}')
+    dialect = dialect or db.engine.dialect.name
+
+    columns = []
+    if bucket is not None:
+        columns.append(bucket_of(AppointmentCount.day, bucket, dialect).label('period'))
+    columns += [GROUPS[name][1].label(GROUPS[name][0]) for name in dict.fromkeys(group_by)]
+    total = func.sum(AppointmentCount.count)
+    query = select(*columns, total.label('count'))
+
+    if 'speciality' in group_by or speciality is not None:
+        query = query.join(Doctor, Doctor.id == AppointmentCount.doctor_id)
+    if date_from is not None:
+        query = query.where(AppointmentCount.day >= date_from)
+    if date_to is not None:
+        query = query.where(AppointmentCount.day < date_to)
+    if doctor_id is not None:
+        query = query.where(AppointmentCount.doctor_id == doctor_id)
+    if status is not None:
+        query = query.where(AppointmentCount.status == status)
+    if speciality is not None:
+        query = query.where(Doctor.speciality == speciality)
+    if columns:
+        query = query.group_by(*columns).having(total > 0).order_by(*columns)
+    return query
+
+
+'''
+    Runs a stats query and returns its rows as dicts.
+'''
+def appointment_stats(**options):
+    result = db.session.execute(stats_query(**options))
+    names = list(result.keys())
+    return [dict(zip(names, row)) for row in result if row[-1]]
+
+
+'''
+    Recomputes the rollup from the appointments, archived ones included,
+    in one transaction. On Postgres appointment writes (and archiving)
+    wait until it commits.
+'''
+def rebuild():
+    dialect = db.engine.dialect.name
+    table = AppointmentCount.__table__
+    if dialect == 'postgresql':
+        db.session.execute(text('LOCK TABLE appointments, appointments_archive IN SHARE MODE'))
+    db.session.execute(table.delete())
+    appointments = AppointmentHistory
+    day = day_of(appointments.date, dialect)
+    db.session.execute(table.insert().from_select(
+        ['day', 'doctor_id', 'status', 'count'],
+        select(day, appointments.doctor_id, appointments.status, func.count())
+        .group_by(day, appointments.doctor_id, appointments.status)
+    ))
+    db.session.commit()
+
+
+@click.command('rebuild-stats')
+@with_appcontext
+def rebuild_stats_command():
+    """Recompute the appointment statistics rollup from the appointments."""
+    rebuild()
+    rows = db.session.execute(select(func.count()).select_from(AppointmentCount)).scalar()
+    click.echo(f'appointment_counts rebuilt: {rows} rows')
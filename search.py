@@ -0,0 +1,148 @@
+import base64
+import json
+import re
+from sqlalchemy import case, func, literal, literal_column, or_, and_, select
+from models import db, Doctor, Patient
+
+'''
+Ranked search over patients and doctors.
+
+On Postgres each searchable model has two expression indexes over the
+same document text (its SEARCH_FIELDS joined by spaces), created by the
+search migration:
+
+    ix_<table>_search_tsv   GIN (to_tsvector('simple', document))
+    ix_<table>_search_trgm  GIN (document gin_trgm_ops)       -- pg_trgm
+
+A query matches rows whose words start with every term of `q` (prefix
+tsquery, for as-you-type search) or that contain a fuzzy match of `q`
+(trigram word similarity, for typos and partial phone numbers). Rows are
+ranked by the better of ts_rank and word similarity.
+
+The expressions below must stay identical to the indexed ones, otherwise
+Postgres cannot use the indexes.
+
+Elsewhere (SQLite in tests) a LIKE based fallback matches every term
+as a substring of some field, ranking name matches first.
+'''
+
+SEARCH_FIELDS = {
+    Doctor: ('name', 'speciality', 'phone', 'email'),
+    Patient: ('name', 'phone'),
+}
+
+# Returned by search: never medical_history
+RESULT_FIELDS = {
+    Doctor: ('id', 'name', 'speciality', 'phone', 'email'),
+    Patient: ('id', 'name', 'phone', 'address'),
+}
+
+DEFAULT_SEARCH_LIMIT = 20
+MIN_QUERY_LENGTH = 2
+MAX_SEARCH_TERMS = 8
+TERM_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+'''
+    Splits `q` into lowercase word terms (at most MAX_SEARCH_TERMS).
+    Raises ValueError when there is nothing to search for, or too little
+    (a one-letter prefix would match a large part of the table).
+'''
+def search_terms(q):
+    terms = [term.lower() for term in TERM_PATTERN.findall(q or '')][:MAX_SEARCH_TERMS]
+    if len(''.join(terms)) < MIN_QUERY_LENGTH:
+        raise ValueError(f'q must contain at least {MIN_QUERY_LENGTH} letters or digits')
+    return terms
+
+
+'''
+    Opaque cursor for ranked results: the offset of the next page.
+'''
+def encode_offset(offset):
+    return base64.urlsafe_b64encode(json.dumps({'offset': offset}).encode()).decode().rstrip('=')
+
+
+def decode_offset(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        offset = int(json.loads(base64.urlsafe_b64decode(padded.encode()))['offset'])
+    except (TypeError, ValueError, KeyError) as ex:
+        raise ValueError(f'invalid cursor: {cursor}') from ex
+    if offset < 0:
+        raise ValueError(f'invalid cursor: {cursor}')
+    return offset
+
+
+'''
+    The document text of `model`: its search fields joined by spaces,
+    as the search indexes spell it.
+'''
+def search_document(model):
+    table = model.__table__
+    parts = [func.coalesce(table.c[field], literal_column("''")) for field in SEARCH_FIELDS[model]]
+    document = parts[0]
+    for part in parts[1:]:
+        document = document.op('||')(literal_column("' '")).op('||')(part)
+    return document
+
+
+def _postgres_search(model, terms, q):
+    document = search_document(model)
+    vector = func.to_tsvector(literal_column("'simple'::regconfig"), document)
+    tsquery = func.to_tsquery(literal_column("'simple'::regconfig"),
+                              literal(' & '.join(f'{term}:*' for term in terms)))
+    similarity = func.word_similarity(literal(q), document)
+    match = or_(vector.op('@@')(tsquery), literal(q).op('<%')(document))
+    rank = func.greatest(func.ts_rank(vector, tsquery), similarity)
+    return match, rank
+
+
+def _fallback_search(model, terms, q):
+    table = model.__table__
+    fields = [func.lower(table.c[field]) for field in SEARCH_FIELDS[model]]
+    match = and_(*[
+        or_(*[field.like(f'%{escape_like(term)}%', escape='\\') for field in fields])
+        for term in terms
+    ])
+    name = func.lower(table.c.name)
+    rank = case(
+        (name.like(f'{escape_like(terms[0])}%', escape='\\'), 2),
+        (name.like(f'%{escape_like(terms[0])}%', escape='\\'), 1),
+        else_=0
+    )
+    return match, rank
+
+
+def escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+'''
+    SELECT of the RESULT_FIELDS of `model` matching `q`, best first, for
+    one page of results (plus one row telling whether another page exists).
+'''
+def search_query(model, q, offset=0, limit=DEFAULT_SEARCH_LIMIT, dialect=None):
+    terms = search_terms(q)
+    dialect = dialect or db.engine.dialect.name
+    build = _postgres_search if dialect == 'postgresql' else _fallback_search
+    match, rank = build(model, terms, ' '.join(terms))
+    columns = [model.__table__.c[field] for field in RESULT_FIELDS[model]]
+    return (
+        select(*columns)
+        .where(match)
+        .order_by(rank.desc(), model.__table__.c.id)
+        .offset(offset)
+        .limit(limit + 1)
+    )
+
+
+'''
+    Runs a search and returns (rows as dicts, next cursor or None).
+    Raises ValueError on an empty `q` or a bad cursor.
+'''
+def search(model, q, after=None, limit=DEFAULT_SEARCH_LIMIT):
+    offset = decode_offset(after) if after else 0
+    rows = db.session.execute(search_query(model, q, offset, limit)).all()
+    next_cursor = encode_offset(offset + limit) if len(rows) > limit else None
+    names = RESULT_FIELDS[model]
+    return [dict(zip(names, row)) for row in rows[:limit]], next_cursor
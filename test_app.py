@@ -1,8 +1,38 @@
+import asyncio
+import csv
+import io
+import hashlib
+import importlib.util
 import os
+import subprocess
+import sys
+import threading
 import unittest
 import json
+import tempfile
+import time
+import types
+from contextlib import contextmanager
+import auth
+import asgi
+import availability
+import exports
+import idempotency
+import json_provider
+import metrics
+import models
+import pool
+import replicas
+import response_cache
+import rollups
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from datetime import datetime, timedelta, time as time_of_day
 from app import create_app
-from models import db
+from benchmarks.tokens import ALL_PERMISSIONS, LocalSigner
+from models import db, Doctor, Patient, Appointment
+from query_plans import check_query_plans
 
 # Placeholder JWT tokens for testing:
 ADMIN_TOKEN = 'eyJhbGciOiJSUzI1NiIsInR5cCI6IkpXVCIsImtpZCI6Ik5meERVQ0FNdkhyTmRIWHRGLW9aZiJ9.eyJpc3MiOiJodHRwczovL3VkYWNpdHktYWxleGFuZHJlZGducy51cy5hdXRoMC5jb20vIiwic3ViIjoiYXV0aDB8NjhlOTYxNzE5ZjlhMDg3MTA3NzAyOGJlIiwiYXVkIjoiZG9jdG9ycy1jcm0iLCJpYXQiOjE3NjM0OTQ4MzAsImV4cCI6MTc2MzU4MTIzMCwic2NvcGUiOiIiLCJhenAiOiIwQ1VaenMzY0s5cWJPRVNsbE44TDhvd0J4TXFoeTI2RiIsInBlcm1pc3Npb25zIjpbImRlbGV0ZTphcHBvaW50bWVudHMiLCJkZWxldGU6ZG9jdG9ycyIsImRlbGV0ZTpwYXRpZW50cyIsImdldDphcHBvaW50bWVudHMiLCJnZXQ6YXBwb2ludG1lbnRzLWRvY3RvciIsImdldDpwYXRpZW50cyIsInBhdGNoOmFwcG9pbnRtZW50cyIsInBhdGNoOmRvY3RvcnMiLCJwYXRjaDpwYXRpZW50cyIsInBvc3Q6YXBwb2ludG1lbnRzIiwicG9zdDpkb2N0b3JzIiwicG9zdDpwYXRpZW50cyJdfQ.mAXCewaM_bIy8kPYtC8_SzpZZfGRhQPiEn3Q6rTfu9jVulx0VxE2fChJLMbxpgfTVNeaDeTXdSXdTgbtW2Q2MhSHddabNkzgZUEShQVXwbxgKJtDWN3E1hd9KA3LN2q9itI7UL_fYLLBjCLTr9mvfgL4PcXHmqa_ylTZ7BS0q5uKhw-eYj8zFUaRv0r83d4a0Xe9f2Q1IDnBBwBC5Z8kvJ58V6J6Q-_s5nvoW-jdLD8XcdBRJAXCKo60xZEJzca9nGcpVogY-5wxULgFpQTTwgHRnjvxyMaDUb5sxCTHtwI3KKDpyoK-lOWb5cawn9YuuXccWhoRKyIvpIRXyClnIA'
@@ -14,6 +44,29 @@ def get_auth_header(token):
         "Authorization": f"Bearer {token}"
     }
 
+
+def local_signing_key(kid='test-key'):
+    """A LocalSigner for the domain and audience auth.py is set to."""
+    return LocalSigner(kid, domain=None, audience=None, sub='auth0|test')
+
+
+def jwks_for(*keys):
+    return {'keys': [key.public_jwk for key in keys]}
+
+
+def use_local_auth(*keys):
+    """Point auth at a local JWKS and return the fetch counter."""
+    auth.AUTH0_DOMAIN = auth.AUTH0_DOMAIN or 'doctors-crm.test'
+    auth.API_AUDIENCE = auth.API_AUDIENCE or 'doctors-crm'
+    calls = {'count': 0}
+
+    def fetch():
+        calls['count'] += 1
+        return jwks_for(*keys)
+
+    auth.set_jwks_source(fetch)
+    return calls
+
 class AppTestCase(unittest.TestCase):
     def setUp(self):
         """Configure the app and setup the database."""
@@ -218,5 +271,1491 @@ class AppTestCase(unittest.TestCase):
         self.assertIn(res.status_code, [401, 403, 404])
 
 
+@contextmanager
+def count_queries(engine):
+    """Collect the SQL statements executed on `engine` inside the block."""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+class LocalAppTestCase(unittest.TestCase):
+    """Runs the app against a throwaway SQLite database and local tokens."""
+
+    def setUp(self):
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.db_path}',
+            'TESTING': True
+        })
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.create_all()
+        response_cache.response_cache.clear()
+
+        self.key = local_signing_key()
+        use_local_auth(self.key)
+        self.admin_headers = get_auth_header(self.key.token(ALL_PERMISSIONS))
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+            db.engine.dispose()
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def seed(self, doctors=1, patients=1, appointments=0, start=datetime(2025, 1, 6, 9)):
+        """Insert sample rows; appointments are spread over the doctors hourly."""
+        with self.app.app_context():
+            db.session.add_all([
+                Doctor(name=f'Dr. {i}', speciality='Cardiology' if i % 2 else 'Neurology')
+                for i in range(doctors)
+            ])
+            db.session.add_all([Patient(name=f'Patient {i}') for i in range(patients)])
+            db.session.flush()
+            db.session.add_all([
+                Appointment(
+                    date=start + timedelta(hours=i // doctors),
+                    doctor_id=i % doctors + 1,
+                    patient_id=i % patients + 1
+                )
+                for i in range(appointments)
+            ])
+            db.session.commit()
+
+
+class PaginationTestCase(LocalAppTestCase):
+    def test_doctors_keyset_pages_cover_every_row(self):
+        """Following next_cursor returns each doctor exactly once."""
+        self.seed(doctors=5)
+        ids, cursor = [], None
+        while True:
+            url = '/doctors?limit=2' + (f'&after={cursor}' if cursor else '')
+            data = json.loads(self.client.get(url).data)
+            ids += [doctor['id'] for doctor in data['doctors']]
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(ids, [1, 2, 3, 4, 5])
+
+    def test_appointments_ordered_by_date(self):
+        """Appointments sharing a date are paged by id without gaps."""
+        self.seed(doctors=3, patients=2, appointments=7)
+        res = self.client.get('/appointments?limit=4', headers=self.admin_headers)
+        first = json.loads(res.data)
+        res = self.client.get(f'/appointments?limit=4&after={first["next_cursor"]}',
+                              headers=self.admin_headers)
+        second = json.loads(res.data)
+        rows = first['appointments'] + second['appointments']
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows, sorted(rows, key=lambda r: (r['date'], r['id'])))
+        self.assertIsNone(second['next_cursor'])
+
+    def test_fields_projection(self):
+        """Only the requested columns are returned."""
+        self.seed(patients=2)
+        res = self.client.get('/patients?fields=name', headers=self.admin_headers)
+        data = json.loads(res.data)
+        self.assertEqual(data['patients'], [{'name': 'Patient 0'}, {'name': 'Patient 1'}])
+
+    def test_400_invalid_list_args(self):
+        """Unknown fields, bad limits and bad cursors are rejected."""
+        for query in ('fields=password', 'limit=0', 'limit=abc', 'after=not-a-cursor'):
+            res = self.client.get(f'/doctors?{query}')
+            self.assertEqual(res.status_code, 400, query)
+
+
+class StreamingTestCase(LocalAppTestCase):
+    def test_stream_query_param(self):
+        """?stream=1 returns every row as one JSON document per line."""
+        self.seed(doctors=250)
+        res = self.client.get('/doctors?stream=1&fields=id,name')
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in res.data.decode().splitlines()]
+        self.assertEqual(len(rows), 250)
+        self.assertEqual(rows[0], {'id': 1, 'name': 'Dr. 0'})
+
+    def test_stream_accept_header(self):
+        """Accept: application/x-ndjson selects the streaming mode."""
+        self.seed(doctors=2, patients=2, appointments=3)
+        headers = dict(self.admin_headers, Accept='application/x-ndjson')
+        res = self.client.get('/appointments', headers=headers)
+        lines = res.data.decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn('date', json.loads(lines[0]))
+
+    def test_400_stream_unknown_field(self):
+        """Projection errors are reported before streaming starts."""
+        res = self.client.get('/doctors?stream=1&fields=nope')
+        self.assertEqual(res.status_code, 400)
+
+
+class QueryPlanTestCase(LocalAppTestCase):
+    def test_no_query_pattern_uses_a_sequential_scan(self):
+        """Every query the routes issue is served by an index."""
+        self.seed(doctors=20, patients=20, appointments=500)
+        with self.app.app_context():
+            db.session.execute(db.text('ANALYZE'))
+            offenders = check_query_plans()
+        self.assertEqual(offenders, [])
+
+    def test_cli_check_query_plans(self):
+        """The check is available as a flask command."""
+        result = self.app.test_cli_runner().invoke(args=['check-query-plans'])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+
+class BulkWriteTestCase(LocalAppTestCase):
+    def test_bulk_create_patients(self):
+        """A whole roster is created in one request."""
+        items = [{'name': f'Patient {i}', 'phone': str(i)} for i in range(1000)]
+        res = self.client.post('/patients/bulk', headers=self.admin_headers, json=items)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 1000)
+        with self.app.app_context():
+            self.assertEqual(Patient.query.count(), 1000)
+
+    def test_bulk_create_and_update_appointments(self):
+        """Items with an id update, the others create."""
+        self.seed(doctors=1, patients=1, appointments=1)
+        items = [
+            {'id': 1, 'status': 'Completed'},
+            {'date': '2025-02-01T10:00:00', 'doctor_id': 1, 'patient_id': 1}
+        ]
+        res = self.client.post('/appointments/bulk', headers=self.admin_headers, json=items)
+        data = json.loads(res.data)
+        self.assertEqual((data['created'], data['updated']), (1, 1))
+        with self.app.app_context():
+            self.assertEqual(Appointment.query.get(1).status, 'Completed')
+            self.assertEqual(Appointment.query.count(), 2)
+
+    def test_422_bulk_reports_errors_per_item(self):
+        """Invalid items are reported by index and nothing is written."""
+        self.seed(doctors=1, patients=1)
+        items = [
+            {'date': '2025-02-01T10:00:00', 'doctor_id': 1, 'patient_id': 1},
+            {'date': 'not a date', 'doctor_id': 1, 'patient_id': 1},
+            {'date': '2025-02-01T11:00:00', 'doctor_id': 99, 'patient_id': 1},
+            {'id': 42, 'status': 'Canceled'}
+        ]
+        res = self.client.post('/appointments/bulk', headers=self.admin_headers, json=items)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual([(e['index'], e['status']) for e in data['errors']],
+                         [(1, 400), (2, 422), (3, 404)])
+        with self.app.app_context():
+            self.assertEqual(Appointment.query.count(), 0)
+
+    def test_409_bulk_double_booking(self):
+        """Items clashing with a stored appointment or with each other are refused."""
+        self.seed(doctors=2, patients=1, appointments=2)
+        items = [
+            {'date': '2025-01-06T09:15:00', 'doctor_id': 1, 'patient_id': 1},
+            {'date': '2025-02-01T10:00:00', 'doctor_id': 1, 'patient_id': 1},
+            {'date': '2025-02-01T10:20:00', 'doctor_id': 1, 'patient_id': 1},
+            {'date': '2025-02-01T10:20:00', 'doctor_id': 2, 'patient_id': 1},
+            {'date': '2025-02-01T10:40:00', 'doctor_id': 1, 'patient_id': 1, 'status': 'Canceled'},
+        ]
+        res = self.client.post('/appointments/bulk', headers=self.admin_headers, json=items)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual([(e['index'], e['status']) for e in json.loads(res.data)['errors']],
+                         [(0, 409), (2, 409)])
+        with self.app.app_context():
+            self.assertEqual(Appointment.query.count(), 2)
+
+    def test_bulk_moves_are_checked_at_their_new_dates(self):
+        """A slot freed by an item of the batch can be taken by another."""
+        self.seed(doctors=1, patients=1, appointments=2)
+        items = [
+            {'id': 1, 'date': '2025-01-06T12:00:00'},
+            {'date': '2025-01-06T09:00:00', 'doctor_id': 1, 'patient_id': 1},
+            {'id': 2, 'status': 'Canceled'},
+            {'date': '2025-01-06T10:00:00', 'doctor_id': 1, 'patient_id': 1},
+        ]
+        res = self.client.post('/appointments/bulk', headers=self.admin_headers, json=items)
+        self.assertEqual(res.status_code, 200)
+        res = self.client.post('/appointments/bulk', headers=self.admin_headers, json=[
+            {'id': 1, 'date': '2025-01-06T09:10:00'}])
+        self.assertEqual(json.loads(res.data)['errors'], [{'index': 0, 'status': 409, 'message': 'conflict'}])
+
+    def test_bulk_checks_permissions_per_item(self):
+        """Updates need the patch permission even when creates are allowed."""
+        self.seed(patients=1)
+        headers = get_auth_header(self.key.token(['post:patients']))
+        items = [{'name': 'New'}, {'id': 1, 'name': 'Renamed'}]
+        res = self.client.post('/patients/bulk', headers=headers, json=items)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['errors'], [{'index': 1, 'status': 403, 'message': 'Permission not found'}])
+
+    def test_403_bulk_without_any_permission(self):
+        """The bulk route still requires a write permission."""
+        headers = get_auth_header(self.key.token(['get:patients']))
+        res = self.client.post('/patients/bulk', headers=headers, json=[{'name': 'x'}])
+        self.assertEqual(res.status_code, 403)
+
+
+class DoctorScheduleTestCase(LocalAppTestCase):
+    def setUp(self):
+        super().setUp()
+        # doctor 1 and 2 alternate, one appointment per doctor per hour from 9:00
+        self.seed(doctors=2, patients=1, appointments=10)
+
+    def test_schedule_date_range(self):
+        """from is inclusive, to is exclusive."""
+        res = self.client.get('/appointments/doctor/1?from=2025-01-06T10:00:00&to=2025-01-06T12:00:00',
+                              headers=self.admin_headers)
+        dates = [a['date'] for a in json.loads(res.data)['appointments']]
+        self.assertEqual(dates, ['2025-01-06T10:00:00', '2025-01-06T11:00:00'])
+
+    def test_schedule_status_filter(self):
+        """status narrows the schedule."""
+        self.client.patch('/appointments/1', headers=self.admin_headers, json={'status': 'Canceled'})
+        res = self.client.get('/appointments/doctor/1?status=Canceled', headers=self.admin_headers)
+        self.assertEqual([a['id'] for a in json.loads(res.data)['appointments']], [1])
+
+    def test_400_schedule_bad_date(self):
+        res = self.client.get('/appointments/doctor/1?from=yesterday', headers=self.admin_headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_409_double_booking_on_create(self):
+        """A slot overlapping an active appointment of the doctor is rejected."""
+        body = {'date': '2025-01-06T09:15:00', 'doctor_id': 1, 'patient_id': 1}
+        res = self.client.post('/appointments', headers=self.admin_headers, json=body)
+        self.assertEqual(res.status_code, 409)
+
+    def test_create_after_previous_slot(self):
+        """Back-to-back appointments do not conflict."""
+        body = {'date': '2025-01-06T09:30:00', 'doctor_id': 1, 'patient_id': 1}
+        res = self.client.post('/appointments', headers=self.admin_headers, json=body)
+        self.assertEqual(res.status_code, 200)
+
+    def test_canceled_slot_can_be_rebooked(self):
+        self.client.patch('/appointments/1', headers=self.admin_headers, json={'status': 'Canceled'})
+        body = {'date': '2025-01-06T09:00:00', 'doctor_id': 1, 'patient_id': 1}
+        res = self.client.post('/appointments', headers=self.admin_headers, json=body)
+        self.assertEqual(res.status_code, 200)
+
+    def test_409_double_booking_on_update(self):
+        """Moving an appointment onto another one is rejected; moving it onto itself is not."""
+        res = self.client.patch('/appointments/1', headers=self.admin_headers,
+                                json={'date': '2025-01-06T10:10:00'})
+        self.assertEqual(res.status_code, 409)
+        res = self.client.patch('/appointments/1', headers=self.admin_headers,
+                                json={'date': '2025-01-06T09:05:00'})
+        self.assertEqual(res.status_code, 200)
+
+
+class AvailabilityTestCase(LocalAppTestCase):
+    def setUp(self):
+        super().setUp()
+        # 2025-01-06 is a Monday; doctor 1 (Neurology) is busy 9:00 and 10:00,
+        # doctor 2 (Cardiology) is busy 9:00 and 10:00 as well
+        self.seed(doctors=2, patients=1, appointments=4)
+
+    def get_slots(self, query):
+        res = self.client.get(f'/availability?{query}')
+        self.assertEqual(res.status_code, 200)
+        return {d['doctor_id']: d['slots'] for d in json.loads(res.data)['availability']}
+
+    def test_free_intervals_around_appointments(self):
+        """Busy slots are cut out of the working hours."""
+        slots = self.get_slots('speciality=Neurology&from=2025-01-06T00:00:00&to=2025-01-07T00:00:00')
+        self.assertEqual(list(slots), [1])
+        self.assertEqual(slots[1], [
+            {'start': '2025-01-06T09:30:00', 'end': '2025-01-06T10:00:00'},
+            {'start': '2025-01-06T10:30:00', 'end': '2025-01-06T17:00:00'}
+        ])
+
+    def test_duration_drops_short_gaps(self):
+        slots = self.get_slots('from=2025-01-06T00:00:00&to=2025-01-07T00:00:00&duration=60')
+        self.assertEqual(slots[2], [{'start': '2025-01-06T10:30:00', 'end': '2025-01-06T17:00:00'}])
+
+    def test_offsets_are_read_as_utc(self):
+        """A `Z` or `+hh:mm` window is converted to the stored naive UTC."""
+        expected = self.get_slots('speciality=Neurology&from=2025-01-06T00:00:00&to=2025-01-07T00:00:00')
+        self.assertEqual(self.get_slots('speciality=Neurology&from=2025-01-06T00:00:00Z&to=2025-01-07T00:00:00Z'),
+                         expected)
+        slots = self.get_slots('speciality=Neurology&from=2025-01-06T12:00:00%2B02:00&to=2025-01-06T12:00:00Z')
+        self.assertEqual(slots[1], [{'start': '2025-01-06T10:30:00', 'end': '2025-01-06T12:00:00'}])
+
+    def test_400_patch_inverting_working_hours(self):
+        """A work_end before the stored work_start is refused, not saved."""
+        res = self.client.patch('/doctors/1', headers=self.admin_headers, json={'work_end': '08:00'})
+        self.assertEqual(res.status_code, 400)
+        res = self.client.patch('/doctors/1', headers=self.admin_headers, json={'work_end': '12:00'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(list(self.get_slots('from=2025-01-06T11:00:00&to=2025-01-06T13:00:00')), [1, 2])
+
+    def test_weekends_are_not_working_days(self):
+        slots = self.get_slots('from=2025-01-11T00:00:00&to=2025-01-13T00:00:00')
+        self.assertEqual(slots, {})
+
+    def test_cache_invalidated_by_new_appointment(self):
+        """Creating an appointment removes its slot from cached results."""
+        query = 'speciality=Neurology&from=2025-01-06T11:00:00&to=2025-01-06T12:00:00'
+        self.assertEqual(self.get_slots(query)[1],
+                         [{'start': '2025-01-06T11:00:00', 'end': '2025-01-06T12:00:00'}])
+        body = {'date': '2025-01-06T11:00:00', 'doctor_id': 1, 'patient_id': 1}
+        self.client.post('/appointments', headers=self.admin_headers, json=body)
+        self.assertEqual(self.get_slots(query)[1],
+                         [{'start': '2025-01-06T11:30:00', 'end': '2025-01-06T12:00:00'}])
+
+    def test_constant_query_count(self):
+        """The search issues the same number of queries for 2 or 40 doctors."""
+        counts = []
+        for doctors in (2, 40):
+            self.seed(doctors=doctors, appointments=doctors * 3)
+            with self.app.app_context(), count_queries(db.engine) as statements:
+                availability.availability_cache.invalidate()
+                availability.find_availability(None, datetime(2025, 1, 6), datetime(2025, 1, 20),
+                                               timedelta(minutes=30))
+            counts.append(len(statements))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_400_invalid_window(self):
+        for query in ('from=2025-01-06', 'from=2025-01-07&to=2025-01-06',
+                      'from=2025-01-01&to=2025-06-01', 'from=2025-01-06&to=2025-01-07&duration=0'):
+            self.assertEqual(self.client.get(f'/availability?{query}').status_code, 400, query)
+
+
+class ExpandTestCase(LocalAppTestCase):
+    def test_expand_embeds_doctor_and_patient(self):
+        self.seed(doctors=2, patients=2, appointments=2)
+        res = self.client.get('/appointments?expand=doctor,patient&fields=id', headers=self.admin_headers)
+        rows = json.loads(res.data)['appointments']
+        self.assertEqual(rows[1], {
+            'id': 2,
+            'doctor': {'id': 2, 'name': 'Dr. 1', 'speciality': 'Cardiology'},
+            'patient': {'id': 2, 'name': 'Patient 1', 'phone': None}
+        })
+
+    def test_expand_query_count_is_constant(self):
+        """Expanding 5 or 500 appointments takes the same number of queries."""
+        counts = []
+        for appointments in (5, 495):
+            self.seed(doctors=20, patients=50, appointments=appointments)
+            response_cache.response_cache.clear()  # seeded outside the write routes
+            with self.app.app_context(), count_queries(db.engine) as statements:
+                res = self.client.get('/appointments?limit=1000&expand=doctor,patient',
+                                      headers=self.admin_headers)
+            self.assertEqual(res.status_code, 200)
+            counts.append(len(statements))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_expand_in_stream(self):
+        self.seed(doctors=1, patients=1, appointments=3)
+        res = self.client.get('/appointments/doctor/1?stream=1&expand=patient', headers=self.admin_headers)
+        rows = [json.loads(line) for line in res.data.decode().splitlines()]
+        self.assertEqual([row['patient']['name'] for row in rows], ['Patient 0'] * 3)
+
+    def test_400_unknown_expansion(self):
+        self.assertEqual(self.client.get('/doctors?expand=appointments').status_code, 400)
+        res = self.client.get('/appointments?expand=nurse', headers=self.admin_headers)
+        self.assertEqual(res.status_code, 400)
+
+
+class PoolSettingsTestCase(unittest.TestCase):
+    def test_defaults_for_postgres(self):
+        options = pool.engine_options('postgresql://localhost/db', environ={})
+        self.assertEqual(options['pool_size'], 5)
+        self.assertEqual(options['max_overflow'], 10)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertIs(options['poolclass'], pool.TimedQueuePool)
+        self.assertNotIn('connect_args', options)
+
+    def test_environment_overrides(self):
+        environ = {'DB_POOL_SIZE': '12', 'DB_POOL_PRE_PING': 'false', 'DB_STATEMENT_TIMEOUT_MS': '5000'}
+        options = pool.engine_options('postgresql://localhost/db', environ=environ)
+        self.assertEqual(options['pool_size'], 12)
+        self.assertFalse(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=5000'})
+
+    def test_pgbouncer_mode_sends_no_startup_options(self):
+        environ = {'DB_PGBOUNCER': '1', 'DB_STATEMENT_TIMEOUT_MS': '5000'}
+        options = pool.engine_options('postgresql://localhost/db', environ=environ)
+        self.assertNotIn('connect_args', options)
+
+    def test_invalid_values_are_rejected(self):
+        for environ in ({'DB_POOL_SIZE': '0'}, {'DB_MAX_OVERFLOW': 'lots'}, {'DB_POOL_PRE_PING': 'maybe'}):
+            with self.assertRaises(ValueError):
+                pool.pool_settings(environ)
+
+    def test_sqlite_keeps_defaults(self):
+        self.assertEqual(pool.engine_options('sqlite://', environ={'DB_POOL_SIZE': '3'}), {})
+
+    def test_pool_status_reports_usage(self):
+        engine = create_engine('sqlite://', poolclass=pool.TimedQueuePool, pool_size=2)
+        connection = engine.connect()
+        status = pool.pool_status(engine)
+        connection.close()
+        self.assertEqual(status['checked_out'], 1)
+        self.assertEqual(status['wait']['count'], 1)
+
+
+class DBHealthTestCase(LocalAppTestCase):
+    def test_health_db(self):
+        res = self.client.get('/health/db')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('class', data['pool'])
+
+
+class SerializationTestCase(LocalAppTestCase):
+    def test_list_rows_match_format(self):
+        """Rows serialized from column tuples match the format() dicts."""
+        self.seed(doctors=2, patients=2, appointments=3)
+        for path, key, model in (('/appointments', 'appointments', Appointment),
+                                 ('/doctors', 'doctors', Doctor)):
+            data = json.loads(self.client.get(path, headers=self.admin_headers).data)
+            with self.app.app_context():
+                expected = [row.format() for row in model.query.order_by(*model.sort_keys).all()]
+            self.assertEqual(data[key], expected)
+
+    def test_dates_and_times_encoded_as_iso_8601(self):
+        """dumps_bytes writes datetimes and times like isoformat()."""
+        value = {'date': datetime(2025, 1, 6, 9, 30, 0, 120000), 'start': datetime(2025, 1, 6).time()}
+        self.assertEqual(json.loads(json_provider.dumps_bytes(value)),
+                         {'date': '2025-01-06T09:30:00.120000', 'start': '00:00:00'})
+
+
+class ConditionalRequestTestCase(LocalAppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.seed(doctors=2, patients=1, appointments=4)
+
+    def test_304_without_loading_rows(self):
+        """A matching If-None-Match is answered by the version query alone."""
+        res = self.client.get('/appointments/doctor/1', headers=self.admin_headers)
+        etag = res.headers['ETag']
+        self.assertIn('Last-Modified', res.headers)
+
+        headers = dict(self.admin_headers, **{'If-None-Match': etag})
+        response_cache.response_cache.clear()
+        with self.app.app_context(), count_queries(db.engine) as statements:
+            res = self.client.get('/appointments/doctor/1', headers=headers)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(len(statements), 1)
+        self.assertIn('count(', statements[0])
+
+    def test_etag_changes_on_insert_update_and_delete(self):
+        """Every write to the listed rows produces a new ETag."""
+        etags = [self.client.get('/doctors').headers['ETag']]
+        for name in ('Dr. New', 'Dr. Newer'):
+            self.client.post('/doctors', json={'name': name, 'speciality': 'Neurology'},
+                             headers=self.admin_headers)
+            etags.append(self.client.get('/doctors').headers['ETag'])
+        self.client.patch('/doctors/4', json={'phone': '555'}, headers=self.admin_headers)
+        etags.append(self.client.get('/doctors').headers['ETag'])
+        self.client.delete('/doctors/3', headers=self.admin_headers)
+        etags.append(self.client.get('/doctors').headers['ETag'])
+        self.assertEqual(len(set(etags)), 5)
+
+    def test_etag_depends_on_query_and_filtered_rows(self):
+        """Other pages and other doctors' writes get their own ETags."""
+        first = self.client.get('/appointments/doctor/1', headers=self.admin_headers).headers['ETag']
+        limited = self.client.get('/appointments/doctor/1?limit=1', headers=self.admin_headers).headers['ETag']
+        self.assertNotEqual(first, limited)
+
+        self.client.patch('/appointments/2', json={'notes': 'moved'}, headers=self.admin_headers)
+        headers = dict(self.admin_headers, **{'If-None-Match': first})
+        res = self.client.get('/appointments/doctor/1', headers=headers)
+        self.assertEqual(res.status_code, 304)
+
+    def test_async_path_sends_the_same_etag(self):
+        """The ASGI read path computes the same ETag and answers 304."""
+        etag = self.client.get('/patients', headers=self.admin_headers).headers['ETag']
+        app = asgi.AsyncApp(self.app, create_async_engine(f'sqlite+aiosqlite:///{self.db_path}'))
+
+        async def scenario():
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                messages.append(message)
+
+            headers = dict(self.admin_headers, **{'If-None-Match': etag})
+            await app({
+                'type': 'http', 'method': 'GET', 'path': '/patients', 'query_string': b'',
+                'headers': [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+            }, receive, send)
+            await app.engine.dispose()
+            return messages[0]
+
+        start = asyncio.run(scenario())
+        self.assertEqual(start['status'], 304)
+        self.assertIn((b'etag', etag.encode()), start['headers'])
+
+
+class ResponseCacheTestCase(LocalAppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.seed(doctors=2, patients=1, appointments=4)
+
+    def get(self, path):
+        with self.app.app_context(), count_queries(db.engine) as statements:
+            res = self.client.get(path, headers=self.admin_headers)
+        return res, len(statements)
+
+    def test_repeated_read_is_served_from_cache(self):
+        """The second identical request runs no query."""
+        first, queries = self.get('/doctors?limit=1')
+        self.assertEqual(queries, 2)
+        second, queries = self.get('/doctors?limit=1')
+        self.assertEqual(queries, 0)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        stats = response_cache.response_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(json.loads(self.client.get('/health/cache').data)['cache']['hit_ratio'], 0.5)
+
+    def test_writes_invalidate_only_what_they_touch(self):
+        """An appointment write drops its doctor's schedule, not others."""
+        for path in ('/appointments/doctor/1', '/appointments/doctor/2', '/patients'):
+            self.get(path)
+        self.client.patch('/appointments/1', json={'notes': 'moved'}, headers=self.admin_headers)
+
+        res, queries = self.get('/appointments/doctor/1')
+        self.assertEqual(queries, 2)
+        self.assertEqual(json.loads(res.data)['appointments'][0]['notes'], 'moved')
+        self.assertEqual(self.get('/appointments/doctor/2')[1], 0)
+        self.assertEqual(self.get('/patients')[1], 0)
+
+    def test_bulk_write_invalidates_the_written_doctors(self):
+        """Tags come from the validated ids, whatever the client's id format."""
+        for path in ('/appointments/doctor/1', '/appointments/doctor/2'):
+            self.get(path)
+        res = self.client.post('/appointments/bulk', headers=self.admin_headers, json=[
+            {'date': '2025-02-01T09:00:00', 'doctor_id': '01', 'patient_id': 1},
+            {'id': 2, 'doctor_id': 1},
+        ])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.get('/appointments/doctor/1')[1], 2)
+        self.assertEqual(self.get('/appointments/doctor/2')[1], 2)
+
+        self.get('/appointments/doctor/1')
+        res = self.client.post('/appointments/bulk', headers=self.admin_headers, json=[
+            {'date': '2025-02-01T10:00:00', 'doctor_id': 1, 'patient_id': 1},
+            {'date': '2025-02-01T11:00:00', 'doctor_id': 9, 'patient_id': 1},
+        ])
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(self.get('/appointments/doctor/1')[1], 0)
+
+    def test_expanded_listing_invalidated_by_related_write(self):
+        """Embedded doctor summaries are refreshed when the doctor changes."""
+        self.get('/appointments?expand=doctor')
+        self.client.patch('/doctors/1', json={'name': 'Dr. Renamed'}, headers=self.admin_headers)
+        res, queries = self.get('/appointments?expand=doctor')
+        self.assertGreater(queries, 0)
+        self.assertEqual(json.loads(res.data)['appointments'][0]['doctor']['name'], 'Dr. Renamed')
+
+    def test_shared_backend_invalidates_every_worker(self):
+        """Workers sharing a backend see each other's invalidations."""
+        client = response_cache.LocalSharedClient()
+        worker_a = response_cache.ResponseCache(response_cache.SharedBackend(client))
+        worker_b = response_cache.ResponseCache(response_cache.SharedBackend(client))
+        key = worker_a.key('/doctors', {}, None, ['doctors'])
+        worker_a.set(key, b'cached')
+        self.assertEqual(worker_b.get(worker_b.key('/doctors', {}, None, ['doctors'])), b'cached')
+        worker_b.invalidate('doctors')
+        self.assertIsNone(worker_a.get(worker_a.key('/doctors', {}, None, ['doctors'])))
+
+    def test_memory_backend_counts_evictions(self):
+        """The LRU drops the least recently used entry past maxsize."""
+        cache = response_cache.ResponseCache(response_cache.MemoryBackend(maxsize=2))
+        keys = [cache.key('/doctors', {'limit': str(i)}, None, ['doctors']) for i in range(3)]
+        for key in keys:
+            cache.set(key, b'page')
+        self.assertIsNone(cache.get(keys[0]))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class SearchTestCase(LocalAppTestCase):
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add_all([
+                Patient(name='John Smith', phone='555-0101', medical_history='asthma'),
+                Patient(name='Joanna Smithers', phone='555-0102'),
+                Patient(name='Mary Johnson', phone='555-0199'),
+                Doctor(name='Ana Costa', speciality='Cardiology', email='ana@clinic.test'),
+                Doctor(name='Bruno Lima', speciality='Neurology', phone='555-0200'),
+            ])
+            db.session.commit()
+
+    def search(self, path):
+        res = self.client.get(path, headers=self.admin_headers)
+        return res.status_code, json.loads(res.data)
+
+    def test_patient_search_ranks_name_matches_first(self):
+        """Every term must match; name prefixes rank first; no medical history."""
+        status, data = self.search('/patients/search?q=john')
+        self.assertEqual(status, 200)
+        self.assertEqual([p['name'] for p in data['patients']], ['John Smith', 'Mary Johnson'])
+        self.assertNotIn('medical_history', data['patients'][0])
+
+        status, data = self.search('/patients/search?q=smith%20555-0102')
+        self.assertEqual([p['name'] for p in data['patients']], ['Joanna Smithers'])
+
+    def test_doctor_search_by_speciality_and_email(self):
+        """Doctors are found by speciality or email, without a token."""
+        res = self.client.get('/doctors/search?q=neuro')
+        self.assertEqual([d['name'] for d in json.loads(res.data)['doctors']], ['Bruno Lima'])
+        status, data = self.search('/doctors/search?q=clinic.test')
+        self.assertEqual([d['name'] for d in data['doctors']], ['Ana Costa'])
+
+    def test_search_pagination(self):
+        """Pages follow next_cursor until the results run out."""
+        status, first = self.search('/patients/search?q=555&limit=2')
+        status, second = self.search(f"/patients/search?q=555&limit=2&after={first['next_cursor']}")
+        self.assertEqual(len(first['patients']) + len(second['patients']), 3)
+        self.assertIsNone(second['next_cursor'])
+
+    def test_400_search_without_query(self):
+        for path in ('/patients/search', '/patients/search?q=%20', '/patients/search?q=j',
+                     '/patients/search?q=john&after=bogus'):
+            self.assertEqual(self.search(path)[0], 400)
+
+    def test_401_patient_search_requires_token(self):
+        self.assertEqual(self.client.get('/patients/search?q=john').status_code, 401)
+
+
+class MetricsTestCase(LocalAppTestCase):
+    def test_histograms_per_route(self):
+        """Requests are recorded under their route template."""
+        self.seed(doctors=2, patients=1, appointments=2)
+        before = metrics.DB_QUERIES.snapshot('/appointments/doctor/<int:doctor_id>', 'GET')
+        self.client.get('/appointments/doctor/1', headers=self.admin_headers)
+        after = metrics.DB_QUERIES.snapshot('/appointments/doctor/<int:doctor_id>', 'GET')
+        self.assertEqual(after['count'], before['count'] + 1)
+        self.assertGreaterEqual(after['sum'], before['sum'] + 1)
+
+        body = self.client.get('/metrics').data.decode()
+        self.assertIn('http_request_duration_seconds_count{route="/appointments/doctor/<int:doctor_id>",method="GET"}', body)
+        self.assertIn('# TYPE http_response_size_bytes histogram', body)
+
+    def test_server_timing_header(self):
+        """Responses break down app, auth and db time."""
+        res = self.client.get('/patients', headers=self.admin_headers)
+        timing = res.headers['Server-Timing']
+        self.assertRegex(timing, r'^app;dur=[\d.]+, auth;dur=[\d.]+, db;dur=[\d.]+;desc="2 queries"$')
+
+    def test_slow_requests_are_logged_with_statements(self):
+        """Requests over SLOW_REQUEST_MS are logged with their SQL."""
+        self.app.config['SLOW_REQUEST_MS'] = 0.001
+        with self.assertLogs('metrics', level='WARNING') as logs:
+            self.client.get('/doctors')
+        self.assertIn('slow request GET /doctors', logs.output[0])
+        self.assertIn('FROM doctors', logs.output[0])
+
+
+class ReplicaTestCase(LocalAppTestCase):
+    """A primary and two replica SQLite databases holding different doctors."""
+
+    def setUp(self):
+        self.paths = [tempfile.mkstemp(suffix='.db') for _ in range(3)]
+        primary, *replica_urls = [f'sqlite:///{path}' for _, path in self.paths]
+        self.db_fd, self.db_path = self.paths[0]
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': primary,
+            'DATABASE_REPLICA_URLS': replica_urls,
+            'TESTING': True
+        })
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.create_all()
+            db.session.add(Doctor(name='Dr. Primary', speciality='Cardiology'))
+            db.session.commit()
+            for index in range(2):
+                engine = self.app.extensions['replicas'].engines[f'replica_{index}']
+                db.metadata.create_all(engine)
+                with engine.begin() as connection:
+                    connection.execute(Doctor.__table__.insert(), {
+                        'name': f'Dr. Replica {index}', 'speciality': 'Cardiology',
+                        'work_start': time_of_day(9), 'work_end': time_of_day(17),
+                        'work_days': '0', 'updated_at': datetime(2025, 1, 1)
+                    })
+        response_cache.response_cache.clear()
+        replicas.recent_writers.clear()
+
+        self.key = local_signing_key()
+        use_local_auth(self.key)
+        self.admin_headers = get_auth_header(self.key.token(ALL_PERMISSIONS))
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        for engine in self.app.extensions['replicas'].engines.values():
+            engine.dispose()
+        for fd, path in self.paths:
+            os.close(fd)
+            os.unlink(path)
+
+    def doctor_names(self, headers=None):
+        response_cache.response_cache.clear()
+        res = self.client.get('/doctors', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        return [doctor['name'] for doctor in json.loads(res.data)['doctors']]
+
+    def test_reads_round_robin_over_replicas(self):
+        """GETs alternate between the replicas, never the primary."""
+        names = [self.doctor_names()[0] for _ in range(4)]
+        self.assertEqual(names, ['Dr. Replica 0', 'Dr. Replica 1', 'Dr. Replica 0', 'Dr. Replica 1'])
+
+    def test_writes_go_to_the_primary(self):
+        """A write lands on the primary and its client then reads its own write."""
+        res = self.client.post('/doctors', headers=self.admin_headers,
+                               json={'name': 'Dr. New', 'speciality': 'Neurology'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.doctor_names(self.admin_headers), ['Dr. Primary', 'Dr. New'])
+
+        other = get_auth_header(self.key.token(ALL_PERMISSIONS, sub='someone-else'))
+        self.assertTrue(self.doctor_names(other)[0].startswith('Dr. Replica'))
+
+    def test_read_your_writes_window_expires(self):
+        """Once the window has passed the writer reads from replicas again."""
+        replicas.recent_writers.window = 0.05
+        try:
+            self.client.post('/doctors', headers=self.admin_headers,
+                             json={'name': 'Dr. New', 'speciality': 'Neurology'})
+            time.sleep(0.1)
+            self.assertTrue(self.doctor_names(self.admin_headers)[0].startswith('Dr. Replica'))
+        finally:
+            replicas.recent_writers.window = replicas.REPLICA_READ_YOUR_WRITES_SECONDS
+
+    def test_failed_replica_is_skipped(self):
+        """A failed replica read is retried on the primary, then the replica is skipped."""
+        with self.app.extensions['replicas'].engines['replica_0'].begin() as connection:
+            connection.execute(db.text('DROP TABLE doctors'))
+        with self.assertLogs('replicas', level='WARNING'):
+            names = [self.doctor_names()[0] for _ in range(4)]
+        self.assertEqual(names, ['Dr. Primary', 'Dr. Replica 1', 'Dr. Replica 1', 'Dr. Replica 1'])
+
+        data = json.loads(self.client.get('/health/db').data)
+        health = {replica['name']: replica['healthy'] for replica in data['replicas']}
+        self.assertEqual(health, {'replica_0': False, 'replica_1': True})
+
+    def test_no_healthy_replica_reads_the_primary(self):
+        replica_set = self.app.extensions['replicas']
+        for key in replica_set.keys:
+            replica_set.mark_down(key, 'test')
+        self.assertEqual(self.doctor_names(), ['Dr. Primary'])
+
+
+class StatsTestCase(LocalAppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.seed(doctors=2, patients=2)
+        rows = [(6, 1, 'Scheduled'), (6, 1, 'Scheduled'), (6, 2, 'Completed'),
+                (7, 2, 'Scheduled'), (14, 1, 'Canceled')]
+        for hour, (day, doctor_id, status) in enumerate(rows, start=9):
+            res = self.client.post('/appointments', headers=self.admin_headers, json={
+                'date': datetime(2025, 1, day, hour).isoformat(),
+                'doctor_id': doctor_id, 'patient_id': 1, 'status': status
+            })
+            self.assertEqual(res.status_code, 200)
+
+    def stats(self, query=''):
+        res = self.client.get(f'/stats/appointments{query}', headers=self.admin_headers)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)['stats']
+
+    def test_group_by_doctor_and_status(self):
+        self.assertEqual(self.stats('?group_by=doctor,status'), [
+            {'doctor_id': 1, 'status': 'Canceled', 'count': 1},
+            {'doctor_id': 1, 'status': 'Scheduled', 'count': 2},
+            {'doctor_id': 2, 'status': 'Completed', 'count': 1},
+            {'doctor_id': 2, 'status': 'Scheduled', 'count': 1},
+        ])
+
+    def test_buckets_and_filters(self):
+        """Weeks start on Monday; from is inclusive, to exclusive."""
+        self.assertEqual(self.stats('?bucket=week'), [
+            {'period': '2025-01-06', 'count': 4},
+            {'period': '2025-01-13', 'count': 1},
+        ])
+        self.assertEqual(self.stats('?bucket=day&from=2025-01-07&to=2025-01-14'),
+                         [{'period': '2025-01-07', 'count': 1}])
+        self.assertEqual(self.stats('?group_by=speciality&speciality=Cardiology'),
+                         [{'speciality': 'Cardiology', 'count': 2}])
+        res = self.client.get('/stats/appointments?bucket=month&status=Scheduled', headers=self.admin_headers)
+        self.assertEqual(json.loads(res.data)['total'], 3)
+
+    def test_writes_keep_the_rollup_current(self):
+        """Updates, deletes and bulk writes match a rebuild from the appointments."""
+        self.client.patch('/appointments/1', headers=self.admin_headers, json={'status': 'Completed'})
+        self.client.patch('/appointments/2', headers=self.admin_headers,
+                          json={'date': '2025-01-20T09:00:00'})
+        self.client.delete('/appointments/3', headers=self.admin_headers)
+        res = self.client.post('/appointments/bulk', headers=self.admin_headers, json=[
+            {'date': '2025-01-21T09:00:00', 'doctor_id': 2, 'patient_id': 2},
+            {'id': 4, 'status': 'Canceled'},
+            {'id': 4, 'date': '2025-02-03T09:00:00'},
+        ])
+        self.assertEqual(res.status_code, 200)
+
+        incremental = self.stats('?bucket=day&group_by=doctor,status')
+        with self.app.app_context():
+            rollups.rebuild()
+        self.assertEqual(self.stats('?bucket=day&group_by=doctor,status'), incremental)
+        self.assertIn({'period': '2025-02-03', 'doctor_id': 2, 'status': 'Canceled', 'count': 1},
+                      incremental)
+
+    def test_stats_never_read_appointments(self):
+        with self.app.app_context():
+            engine = db.engine
+        with count_queries(engine) as statements:
+            self.stats('?bucket=month&group_by=speciality,status')
+        self.assertFalse([statement for statement in statements if 'appointments' in statement])
+
+    def test_400_unknown_group_or_bucket(self):
+        for query in ('?group_by=patient', '?bucket=year', '?from=yesterday', '?doctor_id=x'):
+            res = self.client.get(f'/stats/appointments{query}', headers=self.admin_headers)
+            self.assertEqual(res.status_code, 400)
+
+
+class IdempotencyTestCase(LocalAppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.seed(doctors=1, patients=1)
+        self.appointment = {'date': '2025-01-06T09:00:00', 'doctor_id': 1, 'patient_id': 1}
+
+    def post(self, path, body, key='retry-1', headers=None):
+        headers = dict(headers or self.admin_headers, **{'Idempotency-Key': key})
+        return self.client.post(path, headers=headers, json=body)
+
+    def count(self, model):
+        with self.app.app_context():
+            return db.session.query(model).count()
+
+    def test_retry_replays_the_original_response(self):
+        first = self.post('/appointments', self.appointment)
+        retry = self.post('/appointments', self.appointment)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.count(Appointment), 1)
+
+    def test_replay_does_not_touch_the_models(self):
+        self.post('/patients', {'name': 'Retry Patient'})
+        with self.app.app_context():
+            engine = db.engine
+        with count_queries(engine) as statements:
+            self.post('/patients', {'name': 'Retry Patient'})
+        self.assertFalse([statement for statement in statements if 'patients' in statement])
+        self.assertEqual(self.count(Patient), 2)
+
+    def test_keys_are_scoped_to_the_client(self):
+        other = get_auth_header(self.key.token(ALL_PERMISSIONS, sub='other-client'))
+        self.post('/patients', {'name': 'Same Key'})
+        res = self.post('/patients', {'name': 'Same Key'}, headers=other)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+        self.assertEqual(self.count(Patient), 3)
+
+    def test_422_key_reused_for_another_request(self):
+        self.post('/patients', {'name': 'First'})
+        res = self.post('/patients', {'name': 'Second'})
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(self.count(Patient), 2)
+
+    def test_failed_request_is_not_stored(self):
+        """A failure writes nothing, so its retry runs for real."""
+        self.client.post('/appointments', headers=self.admin_headers, json=self.appointment)
+        self.assertEqual(self.post('/appointments', self.appointment).status_code, 409)
+        self.client.delete('/appointments/1', headers=self.admin_headers)
+        res = self.post('/appointments', self.appointment)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+
+    def test_failure_after_the_write_commits_is_not_retried(self):
+        """The key committed with the write stays, so the retry cannot write twice."""
+        def broken_format(patient):
+            raise RuntimeError('serialization failed')
+        original = Patient.format
+        Patient.format = broken_format
+        try:
+            first = self.post('/patients', {'name': 'Committed'})
+        finally:
+            Patient.format = original
+        self.assertEqual(first.status_code, 422)
+        self.assertEqual(self.count(Patient), 2)
+
+        retry = self.post('/patients', {'name': 'Committed'})
+        self.assertEqual((retry.status_code, retry.data), (422, first.data))
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.count(Patient), 2)
+
+    def test_concurrent_duplicate_waits_for_the_first(self):
+        """A retry arriving while the first request runs replays its response."""
+        fingerprint = hashlib.sha256(b'POST\0/patients\0{"name":"Slow"}\0').hexdigest()
+        with self.app.app_context():
+            db.session.add(models.IdempotencyKey(
+                owner='auth0|test', key='retry-1', fingerprint=fingerprint,
+                expires_at=datetime.utcnow() + timedelta(hours=1)))
+            db.session.commit()
+
+        def finish():
+            time.sleep(0.2)
+            with self.app.app_context():
+                row = db.session.get(models.IdempotencyKey, ('auth0|test', 'retry-1'))
+                row.status_code, row.body = 200, b'{"success":true,"patient":{"id":1}}'
+                db.session.commit()
+
+        worker = threading.Thread(target=finish)
+        worker.start()
+        res = self.client.post('/patients', data='{"name":"Slow"}', headers=dict(
+            self.admin_headers, **{'Idempotency-Key': 'retry-1', 'Content-Type': 'application/json'}))
+        worker.join()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.count(Patient), 1)
+
+    def test_409_when_the_first_request_never_finishes(self):
+        fingerprint = hashlib.sha256(b'POST\0/patients\0{"name":"Stuck"}\0').hexdigest()
+        with self.app.app_context():
+            db.session.add(models.IdempotencyKey(
+                owner='auth0|test', key='retry-1', fingerprint=fingerprint,
+                expires_at=datetime.utcnow() + timedelta(hours=1)))
+            db.session.commit()
+        idempotency.IDEMPOTENCY_WAIT_SECONDS = 0.1
+        try:
+            res = self.client.post('/patients', data='{"name":"Stuck"}', headers=dict(
+                self.admin_headers, **{'Idempotency-Key': 'retry-1', 'Content-Type': 'application/json'}))
+        finally:
+            idempotency.IDEMPOTENCY_WAIT_SECONDS = 10
+        self.assertEqual(res.status_code, 409)
+
+
+class StartupTestCase(unittest.TestCase):
+    """Importing the app and building it stay off the database."""
+
+    def test_import_is_lazy(self):
+        """`import app` builds no app and loads neither jose nor alembic."""
+        code = ('import sys, app; '
+                'print(sorted(m for m in ("jose", "alembic", "flask_migrate") if m in sys.modules), '
+                '"app" in vars(app))')
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual(output.strip(), '[] False')
+
+    def test_create_app_does_not_connect(self):
+        """create_app succeeds against a database it could not open."""
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:////nonexistent/dir/crm.db',
+            'TESTING': True
+        })
+        with app.app_context():
+            with self.assertRaises(OperationalError):
+                db.session.execute(text('SELECT 1'))
+            db.session.remove()
+            db.engine.dispose()
+
+    def test_migrations_build_the_schema(self):
+        """`flask db upgrade` (the release step) creates every table from an empty database."""
+        db_fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(db_fd)
+        self.addCleanup(os.unlink, db_path)
+        env = dict(os.environ, DATABASE_URL=f'sqlite:///{db_path}', FLASK_APP='app')
+        subprocess.run([sys.executable, '-m', 'flask', 'db', 'upgrade'], env=env, capture_output=True,
+                       check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        engine = create_engine(f'sqlite:///{db_path}')
+        try:
+            with engine.connect() as connection:
+                tables = set(inspect(connection).get_table_names())
+        finally:
+            engine.dispose()
+        self.assertLessEqual(set(db.metadata.tables), tables)
+
+    def test_post_fork_resets_the_asgi_app_pools(self):
+        """Preloaded `asgi:app`: the worker gets fresh pools, async engine included."""
+        spec = importlib.util.spec_from_file_location(
+            'gunicorn_conf', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py'))
+        gunicorn_conf = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(gunicorn_conf)
+        app = asgi.create_async_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'TESTING': True})
+        with app.flask_app.app_context():
+            pool = db.engine.pool
+        async_pool = app.engine.sync_engine.pool
+
+        server = types.SimpleNamespace(app=types.SimpleNamespace(wsgi=lambda: app))
+        gunicorn_conf.preload_app = True
+        gunicorn_conf.post_fork(server, None)
+        with app.flask_app.app_context():
+            self.assertIsNot(db.engine.pool, pool)
+            db.engine.dispose()
+        self.assertIsNot(app.engine.sync_engine.pool, async_pool)
+        app.engine.sync_engine.dispose()
+
+
+class ExportTestCase(LocalAppTestCase):
+    def export(self, query='', status=200):
+        res = self.client.get(f'/export/appointments{query}', headers=self.admin_headers)
+        self.assertEqual(res.status_code, status)
+        return res
+
+    def test_csv_export_streams_every_row(self):
+        """Rows come in date order, across several fetch batches."""
+        self.seed(doctors=2, patients=1, appointments=7)
+        exports.EXPORT_BATCH_SIZE = 3
+        try:
+            res = self.export()
+        finally:
+            exports.EXPORT_BATCH_SIZE = 10000
+        self.assertTrue(res.content_type.startswith('text/csv'))
+        self.assertIn('appointments.csv', res.headers['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(res.get_data(as_text=True))))
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(list(rows[0]), list(exports.EXPORT_COLUMNS))
+        self.assertEqual(rows[0]['date'], '2025-01-06 09:00:00')
+        self.assertEqual(rows[0]['notes'], '')
+        self.assertEqual([row['date'] for row in rows], sorted(row['date'] for row in rows))
+
+    def test_filters(self):
+        """from is inclusive, to exclusive; doctor_id narrows to one doctor."""
+        self.seed(doctors=2, patients=1, appointments=8)
+        res = self.export('?from=2025-01-06T10:00:00&to=2025-01-06T12:00:00&doctor_id=2')
+        rows = list(csv.DictReader(io.StringIO(res.get_data(as_text=True))))
+        self.assertEqual([(row['doctor_id'], row['date']) for row in rows],
+                         [('2', '2025-01-06 10:00:00'), ('2', '2025-01-06 11:00:00')])
+        self.assertEqual(self.export('?from=2026-01-01').get_data(as_text=True),
+                         ','.join(exports.EXPORT_COLUMNS) + '\n')
+
+    def test_bad_requests(self):
+        self.export('?format=xml', status=400)
+        self.export('?from=yesterday', status=400)
+        self.export('?doctor_id=x', status=400)
+        if exports.pyarrow is None:
+            self.export('?format=parquet', status=406)
+
+    @unittest.skipIf(exports.pyarrow is None, 'pyarrow is not installed')
+    def test_arrow_and_parquet_exports(self):
+        self.seed(doctors=2, patients=1, appointments=5)
+        table = exports.pyarrow.ipc.open_stream(self.export('?format=arrow').get_data()).read_all()
+        self.assertEqual(table.num_rows, 5)
+        self.assertEqual(table.schema.names, list(exports.EXPORT_COLUMNS))
+        table = exports.pyarrow.parquet.read_table(
+            exports.pyarrow.BufferReader(self.export('?format=parquet').get_data()))
+        self.assertEqual(table.column('doctor_id').to_pylist(), [1, 2, 1, 2, 1])
+
+
+class ImportTestCase(LocalAppTestCase):
+    def run_import(self, table, content, *options):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write(content)
+        try:
+            result = self.app.test_cli_runner().invoke(args=['import', table, f.name, *options])
+        finally:
+            os.unlink(f.name)
+        self.assertEqual(result.exit_code, 0, result.output)
+        return result.output
+
+    def test_import_patients_rejects_bad_rows(self):
+        output = self.run_import('patients', 'name,phone,address\nAna,555,\n,556,\nBruno,,"Rua 1\nLisboa"\n')
+        self.assertIn('line 3: missing required fields: name', output)
+        self.assertIn('2 created, 0 updated, 1 rejected', output)
+        with self.app.app_context():
+            self.assertEqual([(p.name, p.phone, p.address) for p in Patient.query.order_by(Patient.id)],
+                             [('Ana', '555', None), ('Bruno', None, 'Rua 1\nLisboa')])
+
+    def test_import_appointments_upserts_and_keeps_stats(self):
+        """Rows with an id replace it, unknown doctors / patients are rejected."""
+        self.seed(doctors=2, patients=2, appointments=2)
+        rejects = self.db_path + '.rejects.csv'
+        self.addCleanup(os.unlink, rejects)
+        output = self.run_import('appointments', '\n'.join([
+            'id,date,status,doctor_id,patient_id',
+            '1,2025-01-07T09:00:00,Completed,2,1',
+            ',2025-01-08T09:00:00,,1,2',
+            ',2025-01-08T10:00:00,,3,1',
+            ',2025-01-08T11:00:00,,1,3',
+            ',yesterday,,1,1',
+            '9,2025-01-09T09:00:00,,1,1',
+            '9,2025-01-09T10:00:00,,1,1',
+        ]) + '\n', '--chunk-size', '2', '--rejects', rejects)
+        self.assertIn('2 created, 2 updated, 3 rejected', output)
+        with open(rejects) as f:
+            self.assertEqual([(row['line'], row['error']) for row in csv.DictReader(f)], [
+                ('4', 'doctor not found'), ('5', 'patient not found'), ('6', 'invalid date: yesterday')])
+
+        with self.app.app_context():
+            self.assertEqual(Appointment.query.count(), 4)
+            moved = db.session.get(Appointment, 1)
+            self.assertEqual((moved.date, moved.status, moved.doctor_id), (datetime(2025, 1, 7, 9), 'Completed', 2))
+            self.assertEqual(db.session.get(Appointment, 9).date, datetime(2025, 1, 9, 10))
+            counted = rollups.appointment_stats(group_by=['doctor', 'status'])
+            rollups.rebuild()
+            self.assertEqual(rollups.appointment_stats(group_by=['doctor', 'status']), counted)
+
+
+class CascadeDeleteTestCase(LocalAppTestCase):
+    def seed_history(self, appointments):
+        """Two doctors and two patients; doctor 1 holds `appointments` of patient 1."""
+        self.seed(doctors=2, patients=2, appointments=4)
+        start = datetime(2024, 1, 1, 9)
+        with self.app.app_context():
+            db.session.bulk_insert_mappings(Appointment, [
+                {'date': start + timedelta(hours=i), 'doctor_id': 1, 'patient_id': 1, 'status': 'Completed'}
+                for i in range(appointments)
+            ])
+            db.session.commit()
+            rollups.rebuild()
+
+    def test_delete_doctor_with_large_history(self):
+        """One set-based delete, without loading the appointments."""
+        self.seed_history(50000)
+        statements = []
+        with self.app.app_context():
+            listener = lambda *args: statements.append(args[2])
+            event.listen(db.engine, 'before_cursor_execute', listener)
+        start = time.perf_counter()
+        res = self.client.delete('/doctors/1', headers=self.admin_headers)
+        elapsed = time.perf_counter() - start
+        with self.app.app_context():
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(res.status_code, 200)
+        self.assertLess(elapsed, 2.0)
+        self.assertFalse([sql for sql in statements if 'FROM appointments' in sql])
+        with self.app.app_context():
+            self.assertEqual(Appointment.query.count(), 2)
+            self.assertEqual({a.doctor_id for a in Appointment.query}, {2})
+            self.assertEqual(rollups.appointment_stats(group_by=['doctor']), [{'doctor_id': 2, 'count': 2}])
+
+    def test_delete_patient_adjusts_stats(self):
+        self.seed_history(100)
+        res = self.client.delete('/patients/1', headers=self.admin_headers)
+        self.assertEqual(res.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual({a.patient_id for a in Appointment.query}, {2})
+            counted = rollups.appointment_stats(group_by=['doctor', 'status'])
+            self.assertEqual(counted, [{'doctor_id': 2, 'status': 'Scheduled', 'count': 2}])
+            rollups.rebuild()
+            self.assertEqual(rollups.appointment_stats(group_by=['doctor', 'status']), counted)
+
+
+class ArchiveTestCase(LocalAppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.seed(doctors=2, patients=2, appointments=6)
+        with self.app.app_context():
+            for appointment_id, status in ((1, 'Completed'), (2, 'Completed'), (3, 'Canceled')):
+                db.session.get(Appointment, appointment_id).status = status
+            db.session.add(Appointment(date=models.utc_now() - timedelta(days=1), status='Completed',
+                                       doctor_id=1, patient_id=1))
+            db.session.commit()
+            rollups.rebuild()
+            self.counted = rollups.appointment_stats(group_by=['doctor', 'status'])
+
+    def archive(self):
+        result = self.app.test_cli_runner().invoke(
+            args=['archive-appointments', '--older-than', '30', '--batch-size', '2'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        return result.output
+
+    def ids(self, path):
+        res = self.client.get(path, headers=self.admin_headers)
+        self.assertEqual(res.status_code, 200)
+        return [appointment['id'] for appointment in res.get_json()['appointments']]
+
+    def test_archives_old_finished_appointments(self):
+        """Old Completed / Canceled rows move; recent or Scheduled ones stay."""
+        self.assertEqual(self.ids('/appointments'), [1, 2, 3, 4, 5, 6, 7])
+        self.assertIn('3 appointments archived', self.archive())
+        self.assertIn('0 appointments archived', self.archive())
+        with self.app.app_context():
+            self.assertEqual([a.id for a in Appointment.query.order_by(Appointment.id)], [4, 5, 6, 7])
+            self.assertEqual([a.id for a in models.ArchivedAppointment.query.order_by('id')], [1, 2, 3])
+            archived = db.session.get(models.ArchivedAppointment, 1)
+            self.assertEqual((archived.date, archived.status), (datetime(2025, 1, 6, 9), 'Completed'))
+            self.assertEqual(rollups.appointment_stats(group_by=['doctor', 'status']), self.counted)
+            rollups.rebuild()
+            self.assertEqual(rollups.appointment_stats(group_by=['doctor', 'status']), self.counted)
+
+        self.assertEqual(self.ids('/appointments'), [4, 5, 6, 7])
+        res = self.client.patch('/appointments/1', json={'status': 'Scheduled'}, headers=self.admin_headers)
+        self.assertEqual(res.status_code, 404)
+
+    def test_include_archived_reads(self):
+        self.archive()
+        res = self.client.get('/appointments?include_archived=1&limit=3&expand=doctor',
+                              headers=self.admin_headers)
+        body = res.get_json()
+        self.assertEqual([a['id'] for a in body['appointments']], [1, 2, 3])
+        self.assertEqual(body['appointments'][0]['doctor']['name'], 'Dr. 0')
+        self.assertEqual(self.ids(f'/appointments?include_archived=1&after={body["next_cursor"]}'), [4, 5, 6, 7])
+        self.assertEqual(self.ids('/appointments/doctor/1'), [5, 7])
+        self.assertEqual(self.ids('/appointments/doctor/1?include_archived=true'), [1, 3, 5, 7])
+        self.assertEqual(self.ids('/appointments/doctor/1?include_archived=1&status=Canceled'), [3])
+
+        rows = lambda query: list(csv.DictReader(io.StringIO(self.client.get(
+            f'/export/appointments{query}', headers=self.admin_headers).get_data(as_text=True))))
+        self.assertEqual([row['id'] for row in rows('')], ['4', '5', '6', '7'])
+        self.assertEqual([row['id'] for row in rows('?include_archived=1&doctor_id=1')], ['1', '3', '5', '7'])
+
+    def test_deletes_cascade_to_the_archive(self):
+        self.archive()
+        self.assertEqual(self.client.delete('/patients/1', headers=self.admin_headers).status_code, 200)
+        with self.app.app_context():
+            self.assertEqual([a.id for a in models.ArchivedAppointment.query], [2])
+            counted = rollups.appointment_stats(group_by=['doctor', 'status'])
+            rollups.rebuild()
+            self.assertEqual(rollups.appointment_stats(group_by=['doctor', 'status']), counted)
+        self.assertEqual(self.client.delete('/doctors/2', headers=self.admin_headers).status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(models.ArchivedAppointment.query.count(), 0)
+
+
+class AsyncAppTestCase(LocalAppTestCase):
+    """Drives the ASGI app directly, without a server."""
+
+    def run_async(self, scenario):
+        async def main():
+            self.asgi_app = asgi.AsyncApp(
+                self.app, create_async_engine(f'sqlite+aiosqlite:///{self.db_path}'))
+            try:
+                await scenario()
+            finally:
+                await self.asgi_app.engine.dispose()
+        asyncio.run(main())
+
+    async def request(self, method, path, headers=None, body=None):
+        path, _, query = path.partition('?')
+        headers = dict(headers or {})
+        payload = json.dumps(body).encode() if body is not None else b''
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+            headers['Content-Length'] = str(len(payload))
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': method, 'scheme': 'http', 'path': path, 'root_path': '',
+            'query_string': query.encode(), 'server': ('testserver', 80),
+            'client': ('127.0.0.1', 5000),
+            'headers': [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': payload, 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        await self.asgi_app(scope, receive, send)
+        self.response_headers = dict(messages[0]['headers'])
+        status = messages[0]['status']
+        content = b''.join(m.get('body', b'') for m in messages[1:])
+        return status, json.loads(content)
+
+    def test_native_list_matches_flask(self):
+        """The async read path returns what the Flask route returns."""
+        self.seed(doctors=3, patients=2, appointments=6)
+        expected = json.loads(self.client.get('/appointments/doctor/1?limit=1&from=2025-01-06T10:00:00',
+                                              headers=self.admin_headers).data)
+
+        async def scenario():
+            status, data = await self.request('GET', '/appointments/doctor/1?limit=1&from=2025-01-06T10:00:00',
+                                              self.admin_headers)
+            self.assertEqual(status, 200)
+            self.assertEqual(data, expected)
+        self.run_async(scenario)
+
+    def test_repeated_parameters_match_flask(self):
+        """Flask reads the first of repeated parameters; so does the ASGI app."""
+        self.seed(doctors=2, patients=1, appointments=4)
+        expected = json.loads(self.client.get('/appointments?limit=1&limit=3', headers=self.admin_headers).data)
+
+        async def scenario():
+            status, data = await self.request('GET', '/appointments?limit=1&limit=3', self.admin_headers)
+            self.assertEqual((status, data), (200, expected))
+            status, _ = await self.request('GET', '/appointments?limit=', self.admin_headers)
+            self.assertEqual(status, 400)
+        self.run_async(scenario)
+
+    def test_native_routes_are_measured(self):
+        """Native reads land in the Flask route's histograms, with Server-Timing."""
+        self.seed(doctors=2, patients=1, appointments=2)
+        route = '/appointments/doctor/<int:doctor_id>'
+        before = metrics.DB_QUERIES.snapshot(route, 'GET')
+        auth_before = metrics.AUTH_SECONDS.snapshot(route, 'GET')
+
+        async def scenario():
+            status, _ = await self.request('GET', '/appointments/doctor/1', self.admin_headers)
+            self.assertEqual(status, 200)
+            self.assertRegex(self.response_headers[b'server-timing'].decode(),
+                             r'^app;dur=[\d.]+, auth;dur=[\d.]+, db;dur=[\d.]+;desc="2 queries"$')
+        self.run_async(scenario)
+        after = metrics.DB_QUERIES.snapshot(route, 'GET')
+        self.assertEqual(after['count'], before['count'] + 1)
+        self.assertEqual(after['sum'], before['sum'] + 2)
+        self.assertGreater(metrics.AUTH_SECONDS.snapshot(route, 'GET')['sum'], auth_before['sum'])
+
+    def test_native_routes_bypass_the_response_cache(self):
+        """Flask may answer from the cache; the native path reads the database."""
+        self.seed(doctors=1)
+        self.client.get('/doctors', headers=self.admin_headers)
+        with self.app.app_context():
+            db.session.add(Doctor(name='Dr. Uncached', speciality='Neurology'))
+            db.session.commit()
+        cached = json.loads(self.client.get('/doctors', headers=self.admin_headers).data)
+        self.assertEqual(len(cached['doctors']), 1)
+
+        async def scenario():
+            status, data = await self.request('GET', '/doctors', self.admin_headers)
+            self.assertEqual(len(data['doctors']), 2)
+        self.run_async(scenario)
+
+    def test_replicas_leave_every_route_to_flask(self):
+        """With read replicas the reads go through replica_reads."""
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.db_path}',
+            'DATABASE_REPLICA_URLS': [f'sqlite:///{self.db_path}'],
+            'TESTING': True
+        })
+        engine = create_async_engine(f'sqlite+aiosqlite:///{self.db_path}')
+        scope = {'type': 'http', 'method': 'GET', 'path': '/doctors', 'query_string': b'', 'headers': []}
+        self.assertIsNone(asgi.AsyncApp(app, engine).match(scope))
+        self.assertIsNotNone(asgi.AsyncApp(self.app, engine).match(scope))
+        for replica in app.extensions['replicas'].engines.values():
+            replica.dispose()
+
+    def test_auth_semantics(self):
+        """Missing tokens and missing permissions fail like requires_auth."""
+        async def scenario():
+            status, data = await self.request('GET', '/patients')
+            self.assertEqual((status, data['code']), (401, 'authorization_header_missing'))
+            headers = get_auth_header(self.key.token(['get:appointments']))
+            status, data = await self.request('GET', '/patients', headers)
+            self.assertEqual((status, data['code']), (403, 'unauthorized'))
+            status, data = await self.request('GET', '/doctors?limit=0')
+            self.assertEqual(status, 400)
+        self.run_async(scenario)
+
+    def test_writes_fall_back_to_flask(self):
+        """Routes without an async implementation are served by the Flask app."""
+        async def scenario():
+            status, data = await self.request('POST', '/patients', self.admin_headers, {'name': 'Async'})
+            self.assertEqual((status, data['patient']['name']), (200, 'Async'))
+            status, data = await self.request('GET', '/patients?fields=name', self.admin_headers)
+            self.assertEqual(data['patients'], [{'name': 'Async'}])
+        self.run_async(scenario)
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.key = local_signing_key('key-1')
+        self.calls = use_local_auth(self.key)
+
+    def test_jwks_fetched_once_for_repeated_verifications(self):
+        """The JWKS is fetched once and reused while fresh."""
+        for _ in range(5):
+            payload = auth.verify_decode_jwt(self.key.token(['get:patients']))
+            self.assertEqual(payload['permissions'], ['get:patients'])
+        self.assertEqual(self.calls['count'], 1)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        """An unknown kid triggers a refetch at most once per interval."""
+        auth.verify_decode_jwt(self.key.token())
+        rogue = local_signing_key('rogue')
+        for _ in range(3):
+            with self.assertRaises(auth.AuthError):
+                auth.verify_decode_jwt(rogue.token())
+        self.assertEqual(self.calls['count'], 1)
+
+    def test_rotated_key_is_picked_up(self):
+        """A new kid published by the JWKS source is fetched on demand."""
+        rotated = local_signing_key('key-2')
+        calls = {'count': 0}
+        key_sets = [jwks_for(self.key), jwks_for(self.key, rotated)]
+
+        def fetch():
+            calls['count'] += 1
+            return key_sets[min(calls['count'], len(key_sets)) - 1]
+
+        auth.jwks_cache = auth.JWKSCache(fetch=fetch, min_refetch_interval=0)
+        auth.verify_decode_jwt(self.key.token())
+        payload = auth.verify_decode_jwt(rotated.token(sub='rotated'))
+        self.assertEqual(payload['sub'], 'rotated')
+        self.assertEqual(calls['count'], 2)
+
+    def test_stale_keys_served_when_source_fails(self):
+        """Expired keys keep being used while the JWKS source is down."""
+        def failing_fetch():
+            raise OSError('auth0 down')
+
+        cache = auth.JWKSCache(fetch=lambda: jwks_for(self.key), ttl=0)
+        cache.refresh()
+        cache._fetch_jwks = failing_fetch
+        cache._last_attempt = None
+        self.assertIsNotNone(cache.get_key('key-1'))
+
+    def test_jwks_from_local_file(self):
+        """The JWKS source can be a local file."""
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump(jwks_for(self.key), f)
+        try:
+            auth.set_jwks_source('file://' + f.name)
+            payload = auth.verify_decode_jwt(self.key.token(sub='from-file'))
+            self.assertEqual(payload['sub'], 'from-file')
+        finally:
+            os.unlink(f.name)
+
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.key = local_signing_key('key-1')
+        use_local_auth(self.key)
+        auth.token_cache = auth.VerifiedTokenCache(maxsize=2)
+
+    def test_repeat_token_is_a_cache_hit(self):
+        """A token verified once is served from the cache afterwards."""
+        token = self.key.token(['get:patients'])
+        for _ in range(3):
+            auth.verify_decode_jwt(token)
+        self.assertEqual(auth.token_cache.stats()['hits'], 2)
+        self.assertEqual(auth.token_cache.stats()['misses'], 1)
+
+    def test_cache_is_bounded(self):
+        """The least recently used token is evicted past maxsize."""
+        tokens = [self.key.token(sub=f'user-{i}') for i in range(3)]
+        for token in tokens:
+            auth.verify_decode_jwt(token)
+        self.assertEqual(auth.token_cache.stats()['size'], 2)
+        self.assertIsNone(auth.token_cache.get(tokens[0], auth.jwks_cache.generation))
+
+    def test_entry_expires_with_token(self):
+        """An expired token is re-verified and rejected."""
+        token = self.key.token(expires_in=1)
+        auth.verify_decode_jwt(token)
+        time.sleep(2.1)
+        with self.assertRaises(auth.AuthError) as ctx:
+            auth.verify_decode_jwt(token)
+        self.assertEqual(ctx.exception.error['code'], 'token_expired')
+
+    def test_key_rotation_invalidates_entries(self):
+        """Tokens verified against a previous key set are dropped."""
+        key_sets = [jwks_for(self.key)]
+        auth.jwks_cache = auth.JWKSCache(fetch=lambda: key_sets[-1], min_refetch_interval=0)
+        token = self.key.token()
+        auth.verify_decode_jwt(token)
+
+        key_sets.append(jwks_for(local_signing_key('key-2')))
+        auth.jwks_cache.refresh()
+        with self.assertRaises(auth.AuthError):
+            auth.verify_decode_jwt(token)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,111 @@
+from datetime import datetime, time
+
+'''
+Request body validation shared by the single-row routes, the bulk routes
+and the CSV importer, so every write path applies the same rules.
+
+Each validator takes the JSON body (a dict) and returns the cleaned column
+values. With partial=True (PATCH semantics) only the non-empty fields are
+returned and nothing is required.
+'''
+
+
+class ValidationError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def _pick(body, fields, partial):
+    if not isinstance(body, dict):
+        raise ValidationError('expected a JSON object')
+    values = {field: body.get(field, None) for field in fields}
+    if partial:
+        values = {field: value for field, value in values.items() if value}
+    return values
+
+
+def _require(values, *fields):
+    missing = [field for field in fields if not values.get(field)]
+    if missing:
+        raise ValidationError(f'missing required fields: {", ".join(missing)}')
+
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValidationError(f'invalid date: {value}')
+
+
+def parse_id(field, value):
+    if isinstance(value, bool):
+        raise ValidationError(f'invalid {field}: {value}')
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValidationError(f'invalid {field}: {value}')
+
+
+def _parse_time(field, value):
+    if isinstance(value, time):
+        return value
+    try:
+        return time.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValidationError(f'invalid {field}: {value}')
+
+
+def _parse_weekdays(value):
+    if isinstance(value, str):
+        value = [day for day in value.split(',') if day.strip()]
+    try:
+        days = sorted({int(day) for day in value})
+    except (TypeError, ValueError):
+        raise ValidationError(f'invalid work_days: {value}')
+    if not days or days[0] < 0 or days[-1] > 6:
+        raise ValidationError(f'invalid work_days: {value}')
+    return ','.join(str(day) for day in days)
+
+
+def validate_doctor(body, partial=False):
+    values = _pick(body, ('name', 'speciality', 'phone', 'email',
+                          'work_start', 'work_end', 'work_days'), partial)
+    if not partial:
+        _require(values, 'name', 'speciality')
+    for field in ('work_start', 'work_end', 'work_days'):
+        if values.get(field) is None:
+            values.pop(field, None)  # keep the column default
+    for field in ('work_start', 'work_end'):
+        if field in values:
+            values[field] = _parse_time(field, values[field])
+    if 'work_days' in values:
+        values['work_days'] = _parse_weekdays(values['work_days'])
+    if 'work_start' in values and 'work_end' in values \
+            and values['work_start'] >= values['work_end']:
+        raise ValidationError('work_start must be before work_end')
+    return values
+
+
+def validate_patient(body, partial=False):
+    values = _pick(body, ('name', 'phone', 'address', 'medical_history'), partial)
+    if not partial:
+        _require(values, 'name')
+    return values
+
+
+def validate_appointment(body, partial=False):
+    fields = ('date', 'status', 'notes') if partial else \
+        ('date', 'status', 'notes', 'doctor_id', 'patient_id')
+    values = _pick(body, fields, partial)
+    if not partial:
+        _require(values, 'date', 'doctor_id', 'patient_id')
+        values['doctor_id'] = parse_id('doctor_id', values['doctor_id'])
+        values['patient_id'] = parse_id('patient_id', values['patient_id'])
+        if not values['status']:
+            values['status'] = 'Scheduled'
+    if 'date' in values:
+        values['date'] = _parse_date(values['date'])
+    return values